@@ -0,0 +1,48 @@
+import os
+import signal
+import sys
+
+# region ### CONSTANTS ###
+SAVE_SIGNAL = signal.SIGUSR1 # forwarded by the training job's batch shell when its time limit is near
+CHECKPOINT_NAME = "checkpoint_latest.pth" # the checkpoint nnUNetv2_train --c resumes from
+# endregion
+
+# region ### SIGNAL HANDLING ###
+
+def exit_on_signal(signum, frame):
+    # Before training starts there is nothing new to save, the requeued run resumes from the checkpoint already on disk
+    print("Time limit signal received before training started, exiting without saving", flush=True)
+    os._exit(0)
+
+def save_on_signal(trainer):
+    '''
+    Makes the trainer save checkpoint_latest.pth and exit as soon as it receives the signal, instead of keeping only the checkpoint nnUNet writes every 50 epochs
+    Args:
+        trainer: the nnUNet trainer, once it has started training
+    Out: None
+    '''
+    def _save(signum, frame):
+        # nnUNet stores current_epoch + 1 as the epoch to resume from, the epoch in progress is unfinished so it is trained again
+        trainer.current_epoch -= 1
+        trainer.save_checkpoint(os.path.join(trainer.output_folder, CHECKPOINT_NAME))
+        print(f"Time limit signal received, saved {CHECKPOINT_NAME} to resume from epoch {trainer.current_epoch + 1}", flush=True)
+        os._exit(0) # skip the augmentation workers' shutdown, the job is about to requeue
+    signal.signal(SAVE_SIGNAL, _save)
+
+# endregion
+
+if __name__ == '__main__':
+    # Same command line as nnUNetv2_train, e.g. python checkpoint_on_signal.py 645 3d_fullres 0 -tr nnUNetTrainerNoMirroring --c
+    signal.signal(SAVE_SIGNAL, exit_on_signal)
+    from nnunetv2.run.run_training import run_training_entry
+    from nnunetv2.training.nnUNetTrainer.nnUNetTrainer import nnUNetTrainer
+
+    # The trainer only has something new to save once an epoch has started (its network and optimizer are set up by then)
+    on_epoch_start = nnUNetTrainer.on_epoch_start
+    def _on_epoch_start(self):
+        save_on_signal(self)
+        on_epoch_start(self)
+    nnUNetTrainer.on_epoch_start = _on_epoch_start
+
+    sys.argv[0] = "nnUNetv2_train"
+    run_training_entry()
@@ -0,0 +1,90 @@
+import csv
+import time
+from pathlib import Path
+
+import numpy as np
+
+from nifti_io import load_many
+
+# region ### CONSTANTS ###
+COMPARISONS_FILE = "comparisons.csv" # one row per trained variant, in the sweeps folder, so runs of different sweeps can be compared side by side
+FIELDS = ["recorded", "sweep", "variant", "task_number", "dataset_name", "modality", "distribution", "synth_img_amt", "model_type",
+          "status", "test_dice", "test_cases", "compute_hours"]
+IMAGE_SUFFIX = ".nii.gz"
+# endregion
+
+# region ### EVALUATION ###
+
+def case_dice(prediction, label):
+    # Mean Dice over the foreground labels present in either segmentation, None if both are empty
+    prediction = np.asarray(prediction, dtype=np.int64).ravel()
+    label = np.asarray(label, dtype=np.int64).ravel()
+    size = int(max(prediction.max(initial=0), label.max(initial=0))) + 1
+    predicted = np.bincount(prediction, minlength=size)
+    labelled = np.bincount(label, minlength=size)
+    overlap = np.bincount(label[prediction == label], minlength=size)
+    present = [v for v in range(1, size) if predicted[v] or labelled[v]]
+    if not present:
+        return None
+    return float(np.mean([2 * overlap[v] / (predicted[v] + labelled[v]) for v in present]))
+
+def mean_test_dice(predictions_dir: Path, labels_dir: Path):
+    '''
+    Scores the inferred segmentations of a task against its test labels
+    Args:
+        predictions_dir: the inference output folder (<case>.nii.gz per test case)
+        labels_dir: the task's labelsTs folder
+    Out: (mean foreground Dice over the predicted cases, number of cases scored), (None, 0) if nothing was predicted
+    '''
+    scores = []
+    for label_path in sorted(Path(labels_dir).glob("*" + IMAGE_SUFFIX)):
+        prediction_path = Path(predictions_dir) / label_path.name
+        if not prediction_path.exists():
+            continue
+        score = case_dice(*load_many([prediction_path, label_path]))
+        if score is not None:
+            scores.append(score)
+    return (float(np.mean(scores)), len(scores)) if scores else (None, 0)
+
+# endregion
+
+# region ### COMPARISON STORE ###
+
+def init_comparisons(store_path: Path):
+    # Creates the comparison store (with its header) in the sweeps folder if it doesn't exist yet
+    comparisons_path = Path(store_path) / COMPARISONS_FILE
+    if not comparisons_path.exists():
+        comparisons_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(comparisons_path, "w", newline="") as f:
+            csv.writer(f).writerow(FIELDS)
+    return comparisons_path
+
+def record_comparison(store_path: Path, row):
+    # Appends one variant's outcome to the comparison store, fields missing from the row are left empty
+    comparisons_path = init_comparisons(store_path)
+    with open(comparisons_path, "a", newline="") as f:
+        csv.DictWriter(f, FIELDS).writerow({"recorded": time.strftime("%Y-%m-%dT%H:%M:%S"), **{k: row.get(k, "") for k in FIELDS[1:]}})
+
+def load_comparisons(store_path: Path, sweep=None):
+    # Reads the comparison store, keeping only the latest row per (sweep, variant), optionally for one sweep only
+    comparisons_path = Path(store_path) / COMPARISONS_FILE
+    if not comparisons_path.exists():
+        return []
+    latest = {}
+    with open(comparisons_path, newline="") as f:
+        for row in csv.DictReader(f):
+            if sweep is None or row["sweep"] == sweep:
+                latest[(row["sweep"], row["variant"])] = row
+    return list(latest.values())
+
+def print_comparison(store_path: Path, sweep=None):
+    # Prints the variants of a sweep (or of every sweep) best test Dice first
+    rows = load_comparisons(store_path, sweep)
+    rows.sort(key=lambda r: -float(r["test_dice"]) if r["test_dice"] else float("inf"))
+    print(f"{'variant':<32} {'dataset':<40} {'status':<8} {'test Dice':>9} {'cases':>5} {'hours':>6}")
+    for row in rows:
+        dice = f"{float(row['test_dice']):.4f}" if row["test_dice"] else "-"
+        print(f"{row['variant']:<32} {'Dataset' + row['task_number'] + '_' + row['dataset_name']:<40} {row['status']:<8} {dice:>9} {row['test_cases'] or '-':>5} {row['compute_hours'] or '-':>6}")
+    return rows
+
+# endregion
@@ -0,0 +1,97 @@
+import csv
+import json
+import time
+from pathlib import Path
+
+# region ### CONSTANTS ###
+CALIBRATION_FILE = "da_calibration.csv" # appended to by the calibration jobs in the task log folder
+FIELDS = ["partition", "gpu", "cpus", "workers", "iters_per_sec"]
+TUNING_FILE = "da_tuning.json" # best setting per dataset and node type, shared by every pipeline run from this checkout
+NEAR_BEST = 0.95 # settings within 5% of the fastest count as equally fast, and the one with fewer CPUs wins
+# endregion
+
+# region ### CALIBRATION RESULTS ###
+
+def init_calibration(logs_path: Path):
+    # Starts a fresh calibration file (with its header) in the task log folder
+    calibration_path = Path(logs_path) / CALIBRATION_FILE
+    with open(calibration_path, "w", newline="") as f:
+        csv.writer(f).writerow(FIELDS)
+    return calibration_path
+
+def load_calibration(logs_path: Path):
+    # Reads the calibration measurements of a task, skipping anything that isn't a complete row
+    calibration_path = Path(logs_path) / CALIBRATION_FILE
+    if not calibration_path.exists():
+        return []
+    rows = []
+    with open(calibration_path, newline="") as f:
+        for row in csv.DictReader(f):
+            try:
+                rows.append({**row, "cpus": int(row["cpus"]), "workers": int(row["workers"]), "iters_per_sec": float(row["iters_per_sec"])})
+            except (TypeError, ValueError):
+                continue
+    return rows
+
+def best_settings(rows):
+    '''
+    Picks the fastest augmentation setting for each node type, preferring fewer CPUs (then fewer workers) among settings that are about as fast
+    Args:
+        rows: calibration measurements as returned by load_calibration
+    Out: dictionary mapping partition to {"cpus", "workers", "iters_per_sec", "gpu"}
+    '''
+    best = {}
+    for partition in sorted({r["partition"] for r in rows}):
+        measured = [r for r in rows if r["partition"] == partition]
+        fastest = max(r["iters_per_sec"] for r in measured)
+        choice = min((r for r in measured if r["iters_per_sec"] >= NEAR_BEST * fastest), key=lambda r: (r["cpus"], r["workers"]))
+        best[partition] = {"cpus": choice["cpus"], "workers": choice["workers"], "iters_per_sec": choice["iters_per_sec"], "gpu": choice["gpu"]}
+    return best
+
+# endregion
+
+# region ### TUNING CACHE ###
+
+def get_tuning_path(script_dir):
+    return Path(script_dir) / "logs" / TUNING_FILE
+
+def load_tuning(script_dir, dataset):
+    '''
+    Reads the cached augmentation settings for a dataset
+    Args:
+        script_dir: the path to the directory where the pipeline lives
+        dataset: the dataset folder name, e.g. Dataset645_AnomalousInfant
+    Out: dictionary mapping partition to its tuned setting (empty if the dataset hasn't been calibrated)
+    '''
+    tuning_path = get_tuning_path(script_dir)
+    if not tuning_path.exists():
+        return {}
+    with open(tuning_path) as f:
+        return json.load(f).get(dataset, {})
+
+def save_tuning(script_dir, dataset, settings):
+    # Stores the best settings of a dataset in the cache, replacing earlier calibrations of the same node types
+    tuning_path = get_tuning_path(script_dir)
+    tuning_path.parent.mkdir(parents=True, exist_ok=True)
+    cache = {}
+    if tuning_path.exists():
+        with open(tuning_path) as f:
+            cache = json.load(f)
+    calibrated_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+    cache.setdefault(dataset, {}).update({p: {**s, "calibrated_at": calibrated_at} for p, s in settings.items()})
+    tmp_path = tuning_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2)
+    tmp_path.replace(tuning_path)
+
+def tuned_resources(tuning, num_folds=1):
+    '''
+    Converts the cached settings into resource profile overrides for a training job
+    Args:
+        tuning: dictionary mapping partition to tuned setting, as returned by load_tuning
+        num_folds: how many folds share the job (packed jobs get the tuned CPUs once per fold)
+    Out: dictionary mapping partition to profile overrides ("ntasks" and "n_proc_da", which the training templates export as nnUNet_n_proc_DA)
+    '''
+    return {p: {"ntasks": s["cpus"] * num_folds, "n_proc_da": s["workers"]} for p, s in tuning.items()}
+
+# endregion
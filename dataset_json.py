@@ -0,0 +1,111 @@
+import json
+from pathlib import Path
+
+from dataset_preflight import IMAGE_SUFFIX, index_cases, load_lut, scan_task
+
+# region ### CONSTANTS ###
+MODALITY_NAMES = {"t1": ["T1w"], "t2": ["T2w"], "t1t2": ["T1w", "T2w"]} # channel names in channel order (_0000, _0001, ...)
+# endregion
+
+# region ### LABELS ###
+
+def build_labels(label_values, lut):
+    '''
+    Builds the label list for dataset.json: every value found in the labels plus any look-up table entries in between, named from the look-up table
+    Args:
+        label_values: the label values found in labelsTr
+        lut: dictionary mapping label value to name (from the FreeSurfer style LUT), None if there is no table
+    Out: list of (value, name) in value order. Raises ValueError if the values aren't consecutive from 0, which both nnUNet versions require
+    '''
+    lut = lut or {}
+    present = set(label_values) | {0}
+    values = sorted(present | {v for v in lut if v <= max(present)})
+    gaps = sorted(set(range(values[-1] + 1)) - set(values))
+    if gaps:
+        raise ValueError(f"label values must be consecutive from 0, missing {', '.join(map(str, gaps[:10]))}{' ...' if len(gaps) > 10 else ''}")
+    names = []
+    used = set()
+    for value in values:
+        name = "background" if value == 0 else lut.get(value, f"label_{value}")
+        if name in used: # v2 uses the names as keys, so they have to be unique
+            name = f"{name}_{value}"
+        used.add(name)
+        names.append((value, name))
+    return names
+
+# endregion
+
+# region ### DATASET JSON ###
+
+def build_dataset_json(index, version, name, modality, lut=None):
+    '''
+    Builds the nnUNet dataset.json contents from the dataset index
+    Args:
+        index: the dataset index (see dataset_preflight.scan_task)
+        version: 1 or 2, the nnUNet version the file is for
+        name: the task or dataset folder name, e.g. Task645 or Dataset645_AnomalousInfant
+        modality: the task modality (t1, t2, t1t2)
+        lut: dictionary mapping label value to name
+    Out: the dataset.json contents as a dictionary
+    '''
+    train = index_cases(index, "Tr")
+    test = index_cases(index, "Ts")
+    training = sorted(case for case, files in train.items() if files["channels"] and files["label"] is not None)
+    testing = sorted(case for case, files in test.items() if files["channels"])
+    if not training:
+        raise ValueError("no training cases with both an image and a label")
+    channel_count = max(len(train[case]["channels"]) for case in training)
+    channel_names = MODALITY_NAMES.get(modality, [])[:channel_count]
+    channel_names += [f"channel_{c}" for c in range(len(channel_names), channel_count)]
+    label_values = {v for case in training for v in train[case]["label"].get("labels", [])}
+    labels = build_labels(label_values, lut)
+
+    if version == 1:
+        return {
+            "name": name,
+            "description": "",
+            "tensorImageSize": "4D",
+            "reference": "",
+            "licence": "",
+            "release": "0.0",
+            "modality": {str(c): channel for c, channel in enumerate(channel_names)},
+            "labels": {str(value): label for value, label in labels},
+            "numTraining": len(training),
+            "numTest": len(testing),
+            "training": [{"image": f"./imagesTr/{case}{IMAGE_SUFFIX}", "label": f"./labelsTr/{case}{IMAGE_SUFFIX}"} for case in training],
+            "test": [f"./imagesTs/{case}{IMAGE_SUFFIX}" for case in testing],
+        }
+    return {
+        "name": name,
+        "channel_names": {str(c): channel for c, channel in enumerate(channel_names)},
+        "labels": {label: value for value, label in labels},
+        "numTraining": len(training),
+        "file_ending": IMAGE_SUFFIX,
+    }
+
+def write_dataset_json(task_path: Path, dataset):
+    # Writes dataset.json into the task folder atomically, so nnUNet never reads a half written file
+    json_path = Path(task_path) / "dataset.json"
+    tmp_path = json_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(dataset, f, indent=4)
+    tmp_path.replace(json_path)
+    return json_path
+
+def create_dataset_json(task_path: Path, logs_path: Path, version, name, modality, lut_path=None):
+    '''
+    Writes the task's dataset.json from one (incremental) scan of the task folder, reusing the dataset index for unchanged files
+    Args:
+        task_path: the task folder
+        logs_path: the task log folder the dataset index is kept in
+        version: 1 or 2, the nnUNet version the file is for
+        name: the task or dataset folder name
+        modality: the task modality (t1, t2, t1t2)
+        lut_path: the FreeSurfer style look-up table the label names come from
+    Out: path to dataset.json. Raises ValueError if the labels can't be described for nnUNet
+    '''
+    index = scan_task(task_path, logs_path)
+    dataset = build_dataset_json(index, version, name, modality, load_lut(lut_path))
+    return write_dataset_json(task_path, dataset)
+
+# endregion
@@ -0,0 +1,286 @@
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from nifti_io import load_data, load_header
+
+# region ### CONSTANTS ###
+INDEX_FILE = "dataset_index.json" # per-task index of every image's header (and every label's values), in the task log folder
+HASH_CHUNK = 1 << 20 # bytes read at a time when hashing a file's content
+PREFLIGHT_WORKERS = min(16, os.cpu_count() or 1) # header reads are mostly gzip decompression, one process per core
+MODALITY_CHANNELS = {"t1": 1, "t2": 1, "t1t2": 2} # channel files (_0000, _0001, ...) each case needs for a modality
+SPACING_TOLERANCE = 1e-3 # relative difference allowed between an image's and its label's voxel spacing
+ORIGIN_TOLERANCE = 1e-2 # mm difference allowed between an image's and its label's origin
+MAX_PRINTED_PROBLEMS = 20
+SPLITS = ("Tr", "Ts")
+IMAGE_SUFFIX = ".nii.gz"
+CHANNEL_PATTERN = re.compile(r"^(.*)_(\d{4})\.nii\.gz$")
+# endregion
+
+# region ### HEADER SCANNING ###
+
+def read_header(path):
+    '''
+    Reads what the checks need from a NIfTI file without loading the image data (only the start of the file is decompressed)
+    Args:
+        path: the NIfTI file
+    Out: dictionary with "shape", "spacing", "axcodes" (orientation, e.g. "RAS"), "origin" and "dtype", or "error" if the file can't be read
+    '''
+    try:
+        header = load_header(path)
+        affine = header.get_best_affine()
+        return {
+            "shape": [int(s) for s in header.get_data_shape()],
+            "spacing": [round(float(z), 6) for z in header.get_zooms()[:3]],
+            "axcodes": "".join(nib.aff2axcodes(affine)),
+            "origin": [round(float(o), 4) for o in affine[:3, 3]],
+            "dtype": str(header.get_data_dtype()),
+        }
+    except Exception as e: # corrupt or truncated files raise all sorts of errors, report them like any other problem
+        return {"error": f"{type(e).__name__}: {e}"}
+
+def read_label_header(path):
+    # Reads a label file's header plus the set of values it contains (the only case where the voxel data is read)
+    entry = read_header(path)
+    if "error" in entry:
+        return entry
+    try:
+        values = np.unique(load_data(path, workers=1))
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+    entry["labels"] = [float(v) if v != int(v) else int(v) for v in values]
+    return entry
+
+def _scan_file(job):
+    # Worker entry point: (relative path, absolute path, is label) -> (relative path, index entry). Only labels are read in full (for their values), images only to the end of their header
+    relative, path, is_label = job
+    stat = os.stat(path)
+    entry = read_label_header(path) if is_label else read_header(path)
+    return relative, {**entry, "size": stat.st_size, "mtime": stat.st_mtime}
+
+def _hash_file(job):
+    # Worker entry point: (relative path, absolute path) -> (relative path, sha256 of the file's content)
+    relative, path = job
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return relative, digest.hexdigest()
+
+def load_index(logs_path: Path, task_path=None):
+    # Reads the dataset index for a task, empty if it doesn't exist or was built for a different task folder
+    index_path = Path(logs_path) / INDEX_FILE
+    if index_path.exists():
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+            if task_path is None or index.get("task_path") == str(Path(task_path).resolve()):
+                return index
+        except ValueError:
+            pass
+    return {"task_path": str(Path(task_path).resolve()) if task_path else None, "files": {}}
+
+def save_index(logs_path: Path, index):
+    # Writes the dataset index atomically so later steps never read a partly written file
+    index_path = Path(logs_path) / INDEX_FILE
+    tmp_path = index_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    tmp_path.replace(index_path)
+    return index_path
+
+def scan_task(task_path: Path, logs_path: Path, workers=PREFLIGHT_WORKERS):
+    '''
+    Brings the task's dataset index up to date: files whose size and modification time are unchanged keep their entry (and content hash, see hash_files), new or changed files have their header read in parallel and deleted files are dropped
+    Args:
+        task_path: the task folder (imagesTr/, labelsTr/, imagesTs/, labelsTs/)
+        logs_path: the task log folder the index is kept in
+        workers: number of processes reading headers
+    Out: the index, {"task_path", "scanned", "files": {relative path: entry}}
+    '''
+    task_path = Path(task_path).resolve()
+    index = load_index(logs_path, task_path)
+    files = {}
+    jobs = []
+    for split in SPLITS:
+        for kind in ("images", "labels"):
+            folder = task_path / f"{kind}{split}"
+            if not folder.exists():
+                continue
+            for path in folder.glob("*" + IMAGE_SUFFIX):
+                relative = f"{kind}{split}/{path.name}"
+                stat = path.stat()
+                cached = index["files"].get(relative)
+                if cached and cached.get("size") == stat.st_size and cached.get("mtime") == stat.st_mtime:
+                    files[relative] = cached
+                else:
+                    jobs.append((relative, str(path), kind == "labels"))
+    if jobs:
+        with ProcessPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as pool:
+            files.update(pool.map(_scan_file, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+    index = {"task_path": str(task_path), "scanned": round(time.time()), "rescanned": len(jobs), "files": files}
+    save_index(logs_path, index)
+    return index
+
+def hash_files(index, logs_path: Path, folders, workers=PREFLIGHT_WORKERS):
+    '''
+    Adds a content hash to the index entries of the given folders that don't have one yet, only for the steps that key on file content (the preprocess cache and the inference manifest), so the pre-flight check never reads whole images.
+    Hashes are kept in the index with the file's header, and scan_task drops them once the file's size or modification time changes
+    Args:
+        index: the task's dataset index, as returned by scan_task
+        logs_path: the task log folder the index is kept in
+        folders: the folders to hash, e.g. ("imagesTr", "labelsTr")
+        workers: number of processes hashing files
+    Out: the index, with a "sha256" in every entry of those folders
+    '''
+    jobs = [(relative, str(Path(index["task_path"]) / relative)) for relative, entry in index["files"].items()
+            if relative.split("/", 1)[0] in folders and "sha256" not in entry]
+    if not jobs:
+        return index
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as pool:
+        for relative, digest in pool.map(_hash_file, jobs, chunksize=max(1, len(jobs) // (workers * 4))):
+            index["files"][relative]["sha256"] = digest
+    save_index(logs_path, index)
+    return index
+
+# endregion
+
+# region ### CHECKS ###
+
+def load_lut(lut_path: Path):
+    # Label values and names defined in a FreeSurfer style look-up table ("<value> <name> <r> <g> <b> <a>" lines, # comments), None if there is no table
+    if lut_path is None or not Path(lut_path).exists():
+        return None
+    labels = {}
+    with open(lut_path) as f:
+        for line in f:
+            fields = line.split("#", 1)[0].split()
+            if len(fields) >= 2 and fields[0].isdigit():
+                labels[int(fields[0])] = fields[1]
+    return labels
+
+def index_cases(index, split):
+    # Groups the indexed files of a split by case: {case: {"channels": {channel: entry}, "label": entry or None}}
+    cases = {}
+    for relative, entry in index["files"].items():
+        folder, name = relative.split("/", 1)
+        if folder == f"images{split}":
+            match = CHANNEL_PATTERN.match(name)
+            if match:
+                cases.setdefault(match.group(1), {"channels": {}, "label": None})["channels"][int(match.group(2))] = entry
+        elif folder == f"labels{split}":
+            cases.setdefault(name[:-len(IMAGE_SUFFIX)], {"channels": {}, "label": None})["label"] = entry
+    return cases
+
+def _same_geometry(entry, reference):
+    # Describes how an image's geometry differs from a reference image of the same case, None if it matches
+    if entry["shape"][:3] != reference["shape"][:3]:
+        return f"shape {entry['shape']} vs {reference['shape']}"
+    if not np.allclose(entry["spacing"], reference["spacing"], rtol=SPACING_TOLERANCE):
+        return f"spacing {entry['spacing']} vs {reference['spacing']}"
+    if entry["axcodes"] != reference["axcodes"]:
+        return f"orientation {entry['axcodes']} vs {reference['axcodes']}"
+    if not np.allclose(entry["origin"], reference["origin"], atol=ORIGIN_TOLERANCE):
+        return f"origin {entry['origin']} vs {reference['origin']}"
+    return None
+
+def check_index(index, modality=None, lut_labels=None):
+    '''
+    Checks the indexed dataset for the problems plan and preprocess (--verify_dataset_integrity) would otherwise only find on a compute node
+    Args:
+        index: the dataset index
+        modality: the task modality (t1, t2, t1t2), used for the number of channels every case needs
+        lut_labels: the label values allowed by the look-up table, None to skip that check
+    Out: list of problem descriptions, empty if the dataset looks consistent
+    '''
+    problems = []
+    for relative, entry in sorted(index["files"].items()):
+        if "error" in entry:
+            problems.append(f"{relative}: can't be read ({entry['error']})")
+    expected_channels = MODALITY_CHANNELS.get(modality)
+
+    for split in SPLITS:
+        cases = index_cases(index, split)
+        channel_counts = {len(c["channels"]) for c in cases.values() if c["channels"]}
+        if expected_channels is None and len(channel_counts) > 1:
+            problems.append(f"images{split}: cases have different numbers of channels ({sorted(channel_counts)})")
+        for case, files in sorted(cases.items()):
+            channels = {k: v for k, v in files["channels"].items() if "error" not in v}
+            label = files["label"] if files["label"] and "error" not in files["label"] else None
+            if not files["channels"]:
+                problems.append(f"labels{split}/{case}{IMAGE_SUFFIX}: no image for this label")
+                continue
+            wanted = set(range(expected_channels if expected_channels else max(files["channels"]) + 1))
+            missing = sorted(wanted - set(files["channels"]))
+            extra = sorted(set(files["channels"]) - wanted)
+            if missing:
+                problems.append(f"images{split}/{case}: missing channel(s) {', '.join(f'_{c:04d}' for c in missing)}")
+            if extra:
+                problems.append(f"images{split}/{case}: unexpected channel(s) {', '.join(f'_{c:04d}' for c in extra)} for modality {modality}")
+            if files["label"] is None:
+                problems.append(f"images{split}/{case}: no label in labels{split}")
+            if not channels:
+                continue
+            reference_channel = min(channels)
+            reference = channels[reference_channel]
+            if len(reference["shape"]) > 3 and any(s > 1 for s in reference["shape"][3:]):
+                problems.append(f"images{split}/{case}_{reference_channel:04d}: 4D image {reference['shape']}, nnUNet expects one 3D file per channel")
+            for channel, entry in channels.items():
+                difference = _same_geometry(entry, reference) if channel != reference_channel else None
+                if difference:
+                    problems.append(f"images{split}/{case}_{channel:04d}: {difference} (channel _{reference_channel:04d})")
+            if label is not None:
+                difference = _same_geometry(label, reference)
+                if difference:
+                    problems.append(f"labels{split}/{case}: {difference} (image)")
+                non_integer = [v for v in label["labels"] if v != int(v)]
+                if non_integer:
+                    problems.append(f"labels{split}/{case}: non-integer label values, e.g. {non_integer[0]}")
+                elif lut_labels is not None:
+                    unknown = sorted(set(label["labels"]) - lut_labels)
+                    if unknown:
+                        problems.append(f"labels{split}/{case}: label value(s) not in the look-up table: {', '.join(map(str, unknown[:10]))}")
+    return problems
+
+# endregion
+
+# region ### PRE-FLIGHT ###
+
+def run_preflight(task_path: Path, logs_path: Path, modality=None, lut_path=None, workers=PREFLIGHT_WORKERS):
+    '''
+    Scans the task's headers (reusing the dataset index for unchanged files) and checks them, so dataset problems stop the pipeline in seconds instead of after a queue wait
+    Args:
+        task_path: the task folder
+        logs_path: the task log folder the index is kept in
+        modality: the task modality (t1, t2, t1t2)
+        lut_path: the FreeSurfer style look-up table the label values must come from (skipped if it doesn't exist)
+        workers: number of processes reading headers
+    Out: list of problem descriptions, empty if the dataset passed
+    '''
+    print("--- Checking Dataset ---")
+    start = time.time()
+    index = scan_task(task_path, logs_path, workers)
+    lut = load_lut(lut_path)
+    lut_labels = set(lut) if lut is not None else None
+    if lut_labels is None:
+        print(f"No look-up table at {lut_path}, label values are only checked for being integers.")
+    problems = check_index(index, modality, lut_labels)
+    index["problems"] = problems
+    save_index(logs_path, index)
+
+    print(f"Checked {len(index['files'])} files ({index['rescanned']} read, the rest unchanged since the last check) in {time.time() - start:.1f} s")
+    for problem in problems[:MAX_PRINTED_PROBLEMS]:
+        print(f"  {problem}")
+    if len(problems) > MAX_PRINTED_PROBLEMS:
+        print(f"  ... and {len(problems) - MAX_PRINTED_PROBLEMS} more (see {Path(logs_path) / INDEX_FILE})")
+    print(f"--- Dataset Check {'Failed' if problems else 'Passed'} ---")
+    return problems
+
+# endregion
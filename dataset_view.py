@@ -0,0 +1,169 @@
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+from dataset_preflight import CHANNEL_PATTERN
+
+# region ### CONSTANTS ###
+# The task folder nnUNet reads (imagesTr/, labelsTr/, imagesTs/, labelsTs/) only holds links into the sources folder next to them:
+#   sources/original/<dir>         the cases as they were handed to the pipeline (never modified)
+#   sources/resized_<model>/<dir>  the resized cases for a model type
+#   sources/synthseg/<variant>/    one SynthSeg generation set (imagesTr/, labelsTr/), e.g. t1t2_uniform_100
+# A sweep variant's task folder links into the sources folder of the task it was derived from instead of having its own
+SOURCES_DIR = "sources"
+ORIGINAL = "original"
+SYNTHSEG_DIR = "synthseg"
+VIEW_FILE = "view.json" # what the links in the task folder currently point to, in the sources folder
+COMPLETE_MARKER = ".complete" # written once a resized set has been fully written
+DATA_DIRS = ("imagesTr", "labelsTr", "imagesTs", "labelsTs")
+SYNTHSEG_DIRS = ("imagesTr", "labelsTr")
+# endregion
+
+# region ### SOURCES ###
+
+def get_sources_dir(task_path: Path):
+    # Folder holding the original, resized and SynthSeg cases the task folder links to
+    return Path(task_path) / SOURCES_DIR
+
+def get_resized_dir(task_path: Path, model_type):
+    # Folder holding the cases resized for a model type (infant or lifespan)
+    return get_sources_dir(task_path) / f"resized_{model_type}"
+
+def get_variant_name(modality, distribution, synth_img_amt):
+    # Name of a SynthSeg generation set, e.g. t1t2_uniform_100
+    return f"{modality}_{distribution}_{synth_img_amt}"
+
+def get_variant_dir(task_path: Path, variant):
+    # Folder holding one SynthSeg generation set
+    return get_sources_dir(task_path) / SYNTHSEG_DIR / variant
+
+def list_variants(task_path: Path):
+    # SynthSeg generation sets stored for a task
+    folder = get_sources_dir(task_path) / SYNTHSEG_DIR
+    return sorted(p.name for p in folder.iterdir() if p.is_dir() and not p.name.startswith(".")) if folder.exists() else []
+
+def _has_real_files(folder: Path):
+    # True if a folder holds anything other than links (i.e. it is not a view)
+    return any(not entry.is_symlink() for entry in Path(folder).iterdir())
+
+def migrate_to_sources(task_path: Path):
+    '''
+    Moves data folders that still hold real files (a task that has not been turned into a view yet) into sources/original, which is a rename and doesn't copy any data
+    Args:
+        task_path: the task folder
+    Out: the sources/original folder. Raises ValueError if a data folder holds real files but sources/original already has that folder, since merging them could lose cases
+    '''
+    task_path = Path(task_path)
+    original_dir = get_sources_dir(task_path) / ORIGINAL
+    for name in DATA_DIRS:
+        folder = task_path / name
+        if not folder.is_dir() or not _has_real_files(folder):
+            continue
+        if (original_dir / name).exists():
+            raise ValueError(f"{folder} holds files that are not links, but {original_dir / name} already exists. Move new cases into {original_dir / name} instead")
+        original_dir.mkdir(parents=True, exist_ok=True)
+        folder.rename(original_dir / name)
+        print(f"Moved {folder} to {original_dir / name}, {name} is now a folder of links")
+    return original_dir
+
+def get_original_dir(task_path: Path):
+    # Folder with the task's original cases (imagesTr/, labelsTr/, ...), the task folder itself if it hasn't been turned into a view yet
+    original_dir = get_sources_dir(task_path) / ORIGINAL
+    return original_dir if original_dir.exists() else Path(task_path)
+
+def get_base_dir(task_path: Path, model_type=None):
+    # The cases the view is built from: the resized set for the model type once it is complete, the original cases otherwise
+    resized_dir = get_resized_dir(task_path, model_type) if model_type else None
+    if resized_dir is not None and (resized_dir / COMPLETE_MARKER).exists():
+        return resized_dir
+    return get_sources_dir(task_path) / ORIGINAL
+
+def mark_complete(folder: Path):
+    # Records that a derived set (e.g. the resized cases) was fully written
+    (Path(folder) / COMPLETE_MARKER).write_text(time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+# endregion
+
+# region ### VIEW ###
+
+def _link_name(name, channels):
+    # Name of a file in the view, None to leave it out: with a channel list, image channel channels[i] is linked as channel i (e.g. [1] links _0001 as _0000)
+    match = CHANNEL_PATTERN.match(name)
+    if channels is None or match is None:
+        return name
+    channel = int(match.group(2))
+    return f"{match.group(1)}_{channels.index(channel):04d}.nii.gz" if channel in channels else None
+
+def _link_folder(target: Path, sources):
+    # Fills a new folder with relative links to every file in the (source folder, channel list) pairs (later sources win on name clashes)
+    target.mkdir(parents=True)
+    links = {}
+    for source, channels in sources:
+        if source.exists():
+            for entry in source.iterdir():
+                name = _link_name(entry.name, channels)
+                if entry.is_file() and not entry.name.startswith(".") and name is not None:
+                    links[name] = entry
+    for name, entry in links.items():
+        os.symlink(os.path.relpath(entry, target), target / name)
+    return len(links)
+
+def assemble_view(task_path: Path, model_type=None, variant=None, source_path=None, channels=None):
+    '''
+    Rebuilds the task's imagesTr/labelsTr/imagesTs/labelsTs as folders of links to the base cases (resized if available) plus, for training, a SynthSeg generation set.
+    Each folder is built next to the old one and swapped in, so switching sets costs one link per case and never touches the image data
+    Args:
+        task_path: the task folder
+        model_type: the model type whose resized cases to use, if they exist
+        variant: the SynthSeg generation set to add to imagesTr/labelsTr, None for the real cases only
+        source_path: the task folder whose sources/ the links point to (a sweep variant links into the task it was derived from), task_path if None
+        channels: the base cases' image channels to link, in order (e.g. [1] for a t2 variant of a t1t2 task), all of them if None
+    Out: dictionary describing the view ("source", "base", "variant", "links"), also written to sources/view.json. Raises ValueError if the variant doesn't exist
+    '''
+    task_path = Path(task_path)
+    source_path = Path(source_path) if source_path else task_path
+    migrate_to_sources(source_path)
+    if source_path != task_path and any((task_path / name).is_dir() and _has_real_files(task_path / name) for name in DATA_DIRS):
+        raise ValueError(f"{task_path} holds cases of its own, it can't be turned into links to {source_path}")
+    base_dir = get_base_dir(source_path, model_type)
+    variant_dir = get_variant_dir(source_path, variant) if variant else None
+    if variant_dir is not None and not variant_dir.exists():
+        raise ValueError(f"SynthSeg set {variant} doesn't exist (available: {', '.join(list_variants(source_path)) or 'none'})")
+
+    links = 0
+    task_path.mkdir(parents=True, exist_ok=True)
+    for name in DATA_DIRS:
+        # Channels are only picked from the base cases, a SynthSeg set is generated for the modality it is used with
+        sources = [(base_dir / name, channels if name.startswith("images") else None)]
+        if variant_dir is not None and name in SYNTHSEG_DIRS:
+            sources.append((variant_dir / name, None))
+        new_dir = task_path / f".{name}.new"
+        old_dir = task_path / f".{name}.old"
+        for leftover in (new_dir, old_dir): # from an interrupted swap, only ever links
+            if leftover.exists():
+                shutil.rmtree(leftover)
+        links += _link_folder(new_dir, sources)
+        folder = task_path / name
+        if folder.exists():
+            folder.rename(old_dir)
+        new_dir.rename(folder)
+        if old_dir.exists():
+            shutil.rmtree(old_dir) # only links, the data they point to stays in sources/
+
+    view = {"source": str(source_path), "base": base_dir.name, "variant": variant, "links": links, "assembled": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    get_sources_dir(task_path).mkdir(exist_ok=True)
+    with open(get_sources_dir(task_path) / VIEW_FILE, "w") as f:
+        json.dump(view, f, indent=2)
+    return view
+
+def read_view(task_path: Path):
+    # What the task folder currently links to, None if it hasn't been assembled as a view yet
+    view_path = get_sources_dir(task_path) / VIEW_FILE
+    if not view_path.exists():
+        return None
+    with open(view_path) as f:
+        return json.load(f)
+
+# endregion
@@ -0,0 +1,105 @@
+import csv
+import shutil
+import time
+from pathlib import Path
+
+# region ### CONSTANTS ###
+EARLY_STOPPING_FILE = "early_stopping.csv" # one row per fold stopped early, in the task log folder
+FIELDS = ["stopped_at", "fold", "job_id", "epoch", "best_epoch", "best_ema_pseudo_dice", "num_epochs", "epoch_time", "gpu_hours_saved"]
+EMA_WEIGHT = 0.9 # nnUNet's EMA of the mean pseudo-Dice: ema = 0.9 * previous ema + 0.1 * this epoch's mean
+# endregion
+
+# region ### PLATEAU DETECTION ###
+
+def ema_pseudo_dice(series):
+    # Recomputes nnUNet's EMA pseudo-Dice from the per-epoch mean pseudo-Dice, as a list of (epoch, ema)
+    ema = None
+    values = []
+    for entry in series:
+        if "pseudo_dice" not in entry:
+            continue
+        ema = entry["pseudo_dice"] if ema is None else EMA_WEIGHT * ema + (1 - EMA_WEIGHT) * entry["pseudo_dice"]
+        values.append((entry["epoch"], ema))
+    return values
+
+def plateau_status(series, patience, min_delta, min_epochs):
+    '''
+    Checks whether a fold's EMA pseudo-Dice has stopped improving
+    Args:
+        series: the fold's completed epochs (as in training_progress.json)
+        patience: epochs without an improvement of at least min_delta before the fold counts as plateaued
+        min_delta: smallest EMA increase that counts as an improvement
+        min_epochs: never stop a fold before this many epochs
+    Out: dictionary with "plateaued", "epoch" (latest epoch), "best_epoch" and "best_ema", or None before any validation
+    '''
+    values = ema_pseudo_dice(series)
+    if not values:
+        return None
+    best_epoch, best_ema = values[0]
+    for epoch, ema in values[1:]:
+        if ema >= best_ema + min_delta:
+            best_epoch, best_ema = epoch, ema
+    epoch = values[-1][0]
+    return {
+        "plateaued": epoch + 1 >= min_epochs and epoch - best_epoch >= patience,
+        "epoch": epoch, "best_epoch": best_epoch, "best_ema": round(best_ema, 4),
+    }
+
+# endregion
+
+# region ### STOPPING ###
+
+def can_finalize(fold_dir: Path):
+    # A fold can only be stopped early once nnUNet has saved a best checkpoint to fall back on
+    return (Path(fold_dir) / "checkpoint_best.pth").exists()
+
+def finalize_fold(fold_dir: Path):
+    '''
+    Marks a fold that was stopped early as complete by using its best checkpoint as the final one (which is what nnUNetv2_predict loads), so no --c resubmission happens
+    Args:
+        fold_dir: the nnUNet fold folder
+    Out: True if the fold now has a checkpoint_final.pth, False otherwise
+    '''
+    fold_dir = Path(fold_dir)
+    final_path = fold_dir / "checkpoint_final.pth"
+    if final_path.exists():
+        return True
+    if not can_finalize(fold_dir):
+        return False
+    tmp_path = fold_dir / "checkpoint_final.pth.tmp"
+    shutil.copyfile(fold_dir / "checkpoint_best.pth", tmp_path)
+    tmp_path.replace(final_path)
+    return True
+
+def record_early_stop(logs_path: Path, fold, job_id, status, num_epochs, epoch_time):
+    '''
+    Logs a fold that was stopped early and the GPU hours that would have gone into its remaining epochs
+    Args:
+        logs_path: the task log folder
+        fold: the fold number
+        job_id: the SLURM job that was cancelled
+        status: the fold's plateau status
+        num_epochs: the fold's full epoch budget
+        epoch_time: the fold's typical epoch duration in seconds
+    Out: GPU hours saved
+    '''
+    saved = max(num_epochs - (status["epoch"] + 1), 0) * epoch_time / 3600 # one GPU per fold
+    stopping_path = Path(logs_path) / EARLY_STOPPING_FILE
+    new_file = not stopping_path.exists()
+    with open(stopping_path, "a", newline="") as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(FIELDS)
+        writer.writerow([time.strftime("%Y-%m-%dT%H:%M:%S"), fold, job_id or "", status["epoch"], status["best_epoch"],
+                         status["best_ema"], num_epochs, epoch_time, round(saved, 1)])
+    return saved
+
+def total_gpu_hours_saved(logs_path: Path):
+    # Sum of the GPU hours saved by early stopping for a task
+    stopping_path = Path(logs_path) / EARLY_STOPPING_FILE
+    if not stopping_path.exists():
+        return 0.0
+    with open(stopping_path, newline="") as f:
+        return sum(float(row["gpu_hours_saved"]) for row in csv.DictReader(f))
+
+# endregion
@@ -0,0 +1,579 @@
+import fcntl
+import json
+import os
+import re
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+# region ### CONSTANTS ###
+EXECUTOR_ENV = "PIPELINE_EXECUTOR" # "slurm" (default) or "local"; inherited by every process the pipeline starts
+LOCAL_DIR_ENV = "LOCAL_EXECUTOR_DIR" # state folder of the local backend
+LOCAL_DIR = "local_executor" # in the logs folder of the checkout
+REGISTRY_FILE = "jobs.json" # every local job with its state, resources, log files and times
+LOCK_FILE = "jobs.lock"
+SHIM_DIR = "bin" # sbatch/squeue/scancel/sacct/scontrol stand-ins put first on PATH, so job scripts and the other modules reach the local backend
+SHIM_COMMANDS = ["sbatch", "squeue", "scancel", "sacct", "scontrol"]
+MAX_LOCAL_JOBS = max(1, (os.cpu_count() or 1) // 4) # jobs running at the same time
+LOCAL_GPUS = 1 # GPUs handed out to jobs that request a gres (one CUDA_VISIBLE_DEVICES index each)
+LOCAL_NODE = socket.gethostname().split(".")[0]
+POLL_INTERVAL = 1 # seconds between checks of the local runners
+KILL_WAIT = 30 # seconds between SIGTERM and SIGKILL when a job is cancelled or runs out of time (like SLURM's KillWait)
+QUEUED_STATES = ("PENDING", "RUNNING")
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+STATE_CODES = {"PD": "PENDING", "R": "RUNNING", "CD": "COMPLETED", "F": "FAILED", "CA": "CANCELLED", "TO": "TIMEOUT", "NF": "NODE_FAIL"}
+# sbatch options that take their value as the next argument when not written as --option=value
+VALUE_OPTIONS = {"-p", "-J", "-o", "-e", "-t", "-c", "-n", "-N", "-A", "-d", "--partition", "--job-name", "--output", "--error", "--time",
+                 "--cpus-per-task", "--ntasks", "--nodes", "--account", "--gres", "--mem", "--signal", "--dependency", "--exclude"}
+OPTION_NAMES = {"-p": "partition", "-J": "job-name", "-o": "output", "-e": "error", "-t": "time", "-c": "cpus-per-task", "-n": "ntasks",
+                "-N": "nodes", "-A": "account", "-W": "wait", "-d": "dependency"}
+# squeue/sacct options that take a value, by the name they are read under
+QUERY_OPTIONS = {"-j": "jobs", "--job": "jobs", "--jobs": "jobs", "-n": "name", "--name": "name", "-p": "partition", "--partition": "partition",
+                 "-t": "states", "--states": "states", "-s": "states", "--state": "states", "-o": "format", "--format": "format",
+                 "-S": "starttime", "--starttime": "starttime", "-E": "endtime", "--endtime": "endtime", "-u": "user", "--user": "user"}
+# endregion
+
+# region ### SLURM BACKEND ###
+
+class SlurmExecutor:
+    '''
+    Runs the pipeline's job scripts on the cluster with the SLURM command line tools
+    '''
+    name = "slurm"
+
+    def __init__(self):
+        self._waiting = {} # job id -> the sbatch -W process that returns when the job ends
+
+    def submit(self, script, args=(), options=()):
+        '''
+        Submits a job script
+        Args:
+            script: path to the job script
+            args: arguments passed to the script
+            options: sbatch options, e.g. ["-p", "msigpu"]; with -W the job is followed by the blocking sbatch process until wait is called
+        Out: the job id
+        '''
+        process = subprocess.Popen(["sbatch", *options, str(script), *[str(a) for a in args]], stdout=subprocess.PIPE)
+        job_id = process.stdout.readline().strip().split()[-1].decode("utf-8") # "Submitted batch job <id>"
+        if "-W" in options or "--wait" in options:
+            self._waiting[job_id] = process
+        else:
+            process.wait()
+        return job_id
+
+    def state(self, job_id):
+        # The job's queue state ("PENDING", "RUNNING", ...), None once it has left the queue
+        result = subprocess.run(["squeue", "-h", "-j", str(job_id), "-o", "%T"], capture_output=True, text=True)
+        return result.stdout.strip() or None
+
+    def is_queued(self, job_id):
+        # True while the job is pending or running
+        if str(job_id) in self._waiting:
+            return self._waiting[str(job_id)].poll() is None
+        result = subprocess.run(["squeue", "--job", str(job_id)], capture_output=True, text=True)
+        return str(job_id) in result.stdout
+
+    def wait(self, job_id, interval=10):
+        # Blocks until the job has left the queue
+        if str(job_id) in self._waiting:
+            self._waiting.pop(str(job_id)).wait()
+        while self.is_queued(job_id):
+            time.sleep(interval)
+
+    def cancel(self, job_id):
+        # Cancels a pending or running job
+        subprocess.run(["scancel", str(job_id)])
+
+    def find_job(self, job_name):
+        # Id of a queued job with the given name, None if there is none
+        result = subprocess.run(["squeue", "--name", job_name, "--format", "%.18i"], capture_output=True, text=True)
+        lines = result.stdout.strip().splitlines()
+        return lines[1].strip() if len(lines) > 1 else None
+
+    def log_paths(self, job_id):
+        # The job's (stdout, stderr) files while SLURM still knows the job, (None, None) otherwise
+        result = subprocess.run(["scontrol", "show", "job", str(job_id)], capture_output=True, text=True)
+        fields = dict(re.findall(r"(StdOut|StdErr)=(\S+)", result.stdout))
+        return fields.get("StdOut"), fields.get("StdErr")
+
+# endregion
+
+# region ### LOCAL BACKEND ###
+
+def parse_duration(value):
+    # Seconds in a SLURM time limit ("24:00:00", "1-00:00:00", "90" minutes), None for no limit
+    if value in (None, "", "UNLIMITED", "infinite"):
+        return None
+    days, _, clock = str(value).rpartition("-")
+    parts = [int(p) for p in clock.split(":")]
+    if len(parts) == 1:
+        return int(days or 0) * 86400 + parts[0] * 60
+    while len(parts) < 3:
+        parts.insert(0, 0)
+    return int(days or 0) * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+def format_duration(seconds):
+    # SLURM's elapsed time format: "M:SS", "H:MM:SS" or "D-HH:MM:SS"
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return f"{days}-{hours:02d}:{minutes:02d}:{seconds:02d}"
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+def parse_options(argv):
+    '''
+    Splits an sbatch command line into its options and the script with its arguments
+    Args:
+        argv: the arguments after "sbatch"
+    Out: (dictionary of option name -> value (True for flags), script path or None when the script comes on stdin, list of script arguments)
+    '''
+    options, i = {}, 0
+    while i < len(argv) and argv[i].startswith("-"):
+        arg = argv[i]
+        if "=" in arg:
+            name, value = arg.split("=", 1)
+        elif arg in VALUE_OPTIONS and i + 1 < len(argv):
+            name, value = arg, argv[i + 1]
+            i += 1
+        else:
+            name, value = arg, True
+        options[OPTION_NAMES.get(name, name.lstrip("-"))] = value
+        i += 1
+    return options, (argv[i] if i < len(argv) else None), argv[i + 1:]
+
+def parse_directives(text):
+    # The #SBATCH options at the top of a job script (SLURM stops reading them at the first command)
+    argv = []
+    for line in text.splitlines()[1:]:
+        stripped = line.strip()
+        if stripped and not stripped.startswith("#"):
+            break
+        if stripped.startswith("#SBATCH"):
+            argv += shlex.split(stripped[len("#SBATCH"):], comments=True)
+    return parse_options(argv)[0]
+
+def gres_gpus(gres):
+    # Number of GPUs in a gres request such as "gpu:a100:4" or "gpu:1"
+    if not gres or not str(gres).startswith("gpu"):
+        return 0
+    last = str(gres).split(":")[-1]
+    return int(last) if last.isdigit() else 1
+
+def is_pid_alive(pid):
+    # Checks whether a runner process still exists
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class LocalExecutor:
+    '''
+    Runs the same job scripts on this machine under a bounded pool: at most max_jobs jobs (and max_gpus GPU requests) run at once, the rest wait in first come first served order.
+    Jobs live in a registry in the state folder, so every process (the pipeline, the job scripts, the sbatch/squeue/scancel/sacct/scontrol stand-ins) sees the same queue.
+    Each job gets a runner process that waits for a slot, runs the script with the SLURM environment variables it reads, and enforces its time limit, --signal and requeues
+    '''
+    name = "local"
+
+    def __init__(self, state_dir: Path):
+        self.state_dir = Path(state_dir)
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def _locked_registry(self):
+        # Opens the registry under an exclusive lock (same pattern as the GPU governor's state file)
+        with open(self.state_dir / LOCK_FILE, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            registry_path = self.state_dir / REGISTRY_FILE
+            registry = {"next_id": 1, "max_jobs": MAX_LOCAL_JOBS, "max_gpus": LOCAL_GPUS, "jobs": {}}
+            if registry_path.exists() and registry_path.stat().st_size > 0:
+                with open(registry_path) as f:
+                    registry = json.load(f)
+            try:
+                yield registry
+            finally:
+                tmp_path = registry_path.with_suffix(".tmp")
+                with open(tmp_path, "w") as f:
+                    json.dump(registry, f, indent=2)
+                tmp_path.replace(registry_path)
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def configure(self, max_jobs=None, max_gpus=None):
+        # Sets the size of the pool
+        with self._locked_registry() as registry:
+            if max_jobs is not None:
+                registry["max_jobs"] = max_jobs
+            if max_gpus is not None:
+                registry["max_gpus"] = max_gpus
+
+    def jobs(self):
+        # Snapshot of every job in the registry
+        with self._locked_registry() as registry:
+            self._drop_stale(registry)
+            return registry["jobs"]
+
+    def _drop_stale(self, registry):
+        # Jobs whose runner died (e.g. the machine rebooted) end as NODE_FAIL, like jobs on a node that went down
+        for job in registry["jobs"].values():
+            if job["state"] in QUEUED_STATES and job.get("runner") and not is_pid_alive(job["runner"]):
+                job.update(state="NODE_FAIL", end=time.time())
+
+    def submit(self, script, args=(), options=(), script_text=None):
+        '''
+        Queues a job script
+        Args:
+            script: path to the job script (None if script_text is given, e.g. a script piped to sbatch)
+            args: arguments passed to the script
+            options: sbatch options, they override the script's #SBATCH lines (-W is handled by wait, not here)
+            script_text: the script itself, instead of reading it from script
+        Out: the job id
+        '''
+        text = Path(script).read_text() if script_text is None else script_text
+        settings = {**parse_directives(text), **parse_options(list(options))[0]}
+        with self._locked_registry() as registry:
+            job_id = str(registry["next_id"])
+            registry["next_id"] += 1
+            (self.state_dir / "scripts").mkdir(exist_ok=True)
+            saved_script = self.state_dir / "scripts" / f"{job_id}.sh"
+            saved_script.write_text(text)
+            cwd = os.getcwd()
+            output = settings.get("output", "slurm-%j.out")
+            registry["jobs"][job_id] = {
+                "id": job_id, "name": settings.get("job-name") or (Path(script).name if script else "sbatch"),
+                "script": str(saved_script), "args": [str(a) for a in args], "cwd": cwd,
+                "partition": settings.get("partition", "local"), "account": settings.get("account", ""),
+                "cpus": int(settings.get("cpus-per-task") or settings.get("ntasks") or 1), "ntasks": int(settings.get("ntasks") or 1),
+                "gpus": gres_gpus(settings.get("gres")), "time_limit": parse_duration(settings.get("time")),
+                "signal": settings.get("signal"), "append": settings.get("open-mode") == "append", "output": str(Path(cwd) / output.replace("%j", job_id)),
+                "error": str(Path(cwd) / settings.get("error", output).replace("%j", job_id)),
+                "state": "PENDING", "submit": time.time(), "start": None, "end": None, "exit_code": None, "restarts": 0, "requeue": False,
+                "runner": None, "pid": None, "gpu_ids": []
+            }
+        runner = subprocess.Popen([sys.executable, str(Path(__file__).resolve()), "run", job_id], env={**os.environ, LOCAL_DIR_ENV: str(self.state_dir)},
+                                  stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        with self._locked_registry() as registry:
+            registry["jobs"][job_id]["runner"] = runner.pid
+        return job_id
+
+    def state(self, job_id):
+        # The job's queue state ("PENDING" or "RUNNING"), None once it has ended
+        job = self.jobs().get(str(job_id))
+        return job["state"] if job and job["state"] in QUEUED_STATES else None
+
+    def is_queued(self, job_id):
+        # True while the job is pending or running
+        return self.state(job_id) is not None
+
+    def wait(self, job_id, interval=POLL_INTERVAL):
+        # Blocks until the job has ended
+        while self.is_queued(job_id):
+            time.sleep(interval)
+
+    def _terminate(self, pid):
+        # Sends SIGTERM to a running job's process group. Called after the registry is written, since the caller may be inside the job (e.g. scontrol requeue from a trap)
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except (ProcessLookupError, TypeError):
+            pass
+
+    def cancel(self, job_id):
+        # Cancels a pending job, or terminates a running job's whole process group
+        with self._locked_registry() as registry:
+            job = registry["jobs"].get(str(job_id))
+            if job is None or job["state"] not in QUEUED_STATES:
+                return
+            job.update(state="CANCELLED", requeue=False, end=time.time())
+            pid = job["pid"]
+        self._terminate(pid)
+
+    def requeue(self, job_id):
+        # Ends a running job and puts it back in the queue under the same id (scontrol requeue)
+        with self._locked_registry() as registry:
+            job = registry["jobs"].get(str(job_id))
+            if job is None or job["state"] != "RUNNING":
+                return
+            job["requeue"] = True
+            pid = job["pid"]
+        self._terminate(pid)
+
+    def find_job(self, job_name):
+        # Id of a queued job with the given name, None if there is none
+        queued = [job for job in self.jobs().values() if job["name"] == job_name and job["state"] in QUEUED_STATES]
+        return queued[-1]["id"] if queued else None
+
+    def log_paths(self, job_id):
+        # The job's (stdout, stderr) files
+        job = self.jobs().get(str(job_id))
+        return (job["output"], job["error"]) if job else (None, None)
+
+    # --- Runner side ---
+
+    def _claim_slot(self, job_id):
+        # Starts the job if it is the oldest pending job that fits in the pool; returns the job, "wait", or None if it was cancelled
+        with self._locked_registry() as registry:
+            self._drop_stale(registry)
+            job = registry["jobs"][job_id]
+            if job["state"] != "PENDING":
+                return None
+            running = [j for j in registry["jobs"].values() if j["state"] == "RUNNING"]
+            used_gpus = {g for j in running for g in j["gpu_ids"]}
+            gpus = min(job["gpus"], registry["max_gpus"])
+            free_gpus = [g for g in range(registry["max_gpus"]) if g not in used_gpus]
+            fits = lambda j: len(free_gpus) >= min(j["gpus"], registry["max_gpus"])
+            first = min((j for j in registry["jobs"].values() if j["state"] == "PENDING" and fits(j)), key=lambda j: (j["submit"], int(j["id"])), default=None)
+            if len(running) >= registry["max_jobs"] or first is None or first["id"] != job_id:
+                return "wait"
+            job.update(state="RUNNING", start=time.time(), gpu_ids=free_gpus[:gpus], runner=os.getpid())
+            return dict(job)
+
+    def _environment(self, job):
+        # The SLURM variables the job scripts read, plus a private TMPDIR (the node-local scratch)
+        tmp_dir = self.state_dir / "tmp" / job["id"]
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        env = {**os.environ, "SLURM_JOB_ID": job["id"], "SLURM_JOB_NAME": job["name"], "SLURM_SUBMIT_DIR": job["cwd"],
+               "SLURM_JOB_PARTITION": job["partition"], "SLURM_CPUS_PER_TASK": str(job["cpus"]), "SLURM_NTASKS": str(job["ntasks"]),
+               "SLURM_RESTART_COUNT": str(job["restarts"]), "SLURM_JOB_NODELIST": LOCAL_NODE, "TMPDIR": str(tmp_dir)}
+        if job["gpus"]:
+            env["CUDA_VISIBLE_DEVICES"] = ",".join(str(g) for g in job["gpu_ids"])
+        return env
+
+    def run(self, job_id):
+        '''
+        Runner process of one job: waits for a slot, runs the script, and records how it ended. Requeued jobs run again under the same id
+        Args:
+            job_id: the job to run
+        Out: None
+        '''
+        while True:
+            job = self._claim_slot(job_id)
+            if job == "wait":
+                time.sleep(POLL_INTERVAL)
+                continue
+            if job is None:
+                return
+            interpreter = Path(job["script"]).read_text().splitlines()[0]
+            command = shlex.split(interpreter[2:]) if interpreter.startswith("#!") else ["/bin/bash"]
+            mode = "a" if job["restarts"] or job["append"] else "w"
+            with open(job["output"], mode) as out, open(job["error"], mode) if job["error"] != job["output"] else out as err:
+                process = subprocess.Popen(command + [job["script"]] + job["args"], cwd=job["cwd"], env=self._environment(job),
+                                           stdin=subprocess.DEVNULL, stdout=out, stderr=err, start_new_session=True)
+                with self._locked_registry() as registry:
+                    registry["jobs"][job_id]["pid"] = process.pid
+                timed_out = self._supervise(job, process)
+            with self._locked_registry() as registry:
+                job = registry["jobs"][job_id]
+                if job["requeue"]:
+                    job.update(state="PENDING", requeue=False, restarts=job["restarts"] + 1, pid=None, gpu_ids=[])
+                    continue
+                if job["state"] == "RUNNING":
+                    job["state"] = "TIMEOUT" if timed_out else ("COMPLETED" if process.returncode == 0 else "FAILED")
+                job.update(end=time.time(), exit_code=process.returncode, pid=None, gpu_ids=[])
+            return
+
+    def _supervise(self, job, process):
+        # Waits for the job's process, sending its --signal before the time limit and killing it at the limit; returns True if it timed out
+        signal_name, lead, batch_only = None, 0, False
+        if job["signal"]:
+            spec = job["signal"]
+            batch_only = spec.startswith("B:")
+            signal_name, _, lead = spec.split(":", 1)[-1].partition("@")
+            lead = int(lead or 60)
+        started, signalled, killed_at = time.time(), False, None
+        while process.poll() is None:
+            elapsed = time.time() - started
+            limit = job["time_limit"]
+            if limit is not None and signal_name and not signalled and elapsed >= limit - lead:
+                sig = getattr(signal, signal_name if signal_name.startswith("SIG") else f"SIG{signal_name}")
+                (os.kill(process.pid, sig) if batch_only else os.killpg(process.pid, sig))
+                signalled = True
+            if limit is not None and elapsed >= limit and killed_at is None:
+                os.killpg(process.pid, signal.SIGTERM)
+                killed_at = time.time()
+            if killed_at is not None and time.time() - killed_at > KILL_WAIT:
+                os.killpg(process.pid, signal.SIGKILL)
+            time.sleep(POLL_INTERVAL)
+        return killed_at is not None
+
+# endregion
+
+# region ### SELECTION ###
+
+_executors = {} # one instance per backend and process, so SLURM jobs submitted with -W can be waited on later
+
+def get_executor():
+    # The backend chosen for this process tree (see activate_local_executor), SLURM by default
+    if os.environ.get(EXECUTOR_ENV) == "local":
+        key = os.environ[LOCAL_DIR_ENV]
+        return _executors.setdefault(key, LocalExecutor(key))
+    return _executors.setdefault("slurm", SlurmExecutor())
+
+def install_shims(state_dir: Path):
+    # Writes the sbatch/squeue/scancel/sacct/scontrol stand-ins that forward to this module, returns their folder
+    shim_dir = Path(state_dir) / SHIM_DIR
+    shim_dir.mkdir(parents=True, exist_ok=True)
+    for command in SHIM_COMMANDS:
+        shim = shim_dir / command
+        shim.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{Path(__file__).resolve()}" {command} "$@"\n')
+        shim.chmod(0o755)
+    return shim_dir
+
+def activate_local_executor(state_dir: Path, max_jobs=None, max_gpus=None):
+    '''
+    Switches this process and everything it starts to the local backend: jobs run on this machine, and the SLURM commands called by the job scripts and the other modules go to the local registry
+    Args:
+        state_dir: the local backend's state folder, e.g. logs/local_executor
+        max_jobs: jobs running at the same time (unchanged if None)
+        max_gpus: GPUs handed out to jobs (unchanged if None)
+    Out: the LocalExecutor
+    '''
+    executor = LocalExecutor(state_dir)
+    executor.configure(max_jobs, max_gpus)
+    os.environ[EXECUTOR_ENV] = "local"
+    os.environ[LOCAL_DIR_ENV] = str(Path(state_dir).resolve())
+    os.environ["PATH"] = f"{install_shims(state_dir)}{os.pathsep}{os.environ.get('PATH', '')}"
+    return executor
+
+# endregion
+
+# region ### SLURM COMMAND STAND-INS ###
+
+def _format_row(fmt, values):
+    # Fills a squeue format such as "%.18i %.9P %T" from a dictionary of field letter -> value
+    def field(match):
+        spec, letter = match.group(1), match.group(2)
+        value = str(values.get(letter, ""))
+        width = int(spec.lstrip(".") or 0)
+        return value.rjust(width) if spec.startswith(".") else value.ljust(width)
+    return re.sub(r"%(\.?\d*)([a-zA-Z])", field, fmt)
+
+def _job_time(timestamp):
+    # A job timestamp the way sacct prints it
+    return datetime.fromtimestamp(timestamp).strftime(TIME_FORMAT) if timestamp else "Unknown"
+
+def parse_query(argv):
+    # Splits a squeue/sacct command line into the options of QUERY_OPTIONS (name -> value) and the flags given
+    options, flags, i = {}, set(), 0
+    while i < len(argv):
+        arg = argv[i]
+        name, _, value = arg.partition("=")
+        if name in QUERY_OPTIONS and value:
+            options[QUERY_OPTIONS[name]] = value
+        elif arg in QUERY_OPTIONS and i + 1 < len(argv):
+            options[QUERY_OPTIONS[arg]] = argv[i + 1]
+            i += 1
+        elif arg.startswith("-"):
+            flags.add(arg)
+        i += 1
+    return options, flags
+
+def _values(options, name):
+    # Comma separated values of a query option as a set, empty if it was not given
+    return set(options.get(name, "").split(",")) - {""}
+
+def _states(value):
+    # State filter of squeue -t / sacct -s, with SLURM's short codes expanded
+    return {STATE_CODES.get(s.upper(), s.upper()) for s in value.split(",")} if value else None
+
+def squeue(executor, argv):
+    # squeue stand-in: -h, -j/--job, -n/--name, -p, -t and -o/--format
+    options, flags = parse_query(argv)
+    ids, names, partitions = _values(options, "jobs"), _values(options, "name"), _values(options, "partition")
+    states = _states(options.get("states"))
+    fmt = options.get("format", "%.18i %.9P %.30j %.8T %.10M")
+    if not {"-h", "--noheader"} & flags:
+        print(_format_row(fmt, {"i": "JOBID", "P": "PARTITION", "j": "NAME", "T": "STATE", "t": "ST", "M": "TIME", "D": "NODES", "R": "NODELIST(REASON)"}))
+    for job in executor.jobs().values():
+        if job["state"] not in QUEUED_STATES or (ids and job["id"] not in ids) or (names and job["name"] not in names) \
+                or (partitions and job["partition"] not in partitions) or (states and job["state"] not in states):
+            continue
+        print(_format_row(fmt, {"i": job["id"], "P": job["partition"], "j": job["name"], "T": job["state"], "t": "R" if job["state"] == "RUNNING" else "PD",
+                                "M": format_duration(time.time() - job["start"]) if job["start"] else "0:00", "D": 1,
+                                "R": LOCAL_NODE if job["state"] == "RUNNING" else "(Resources)"}))
+
+def sacct(executor, argv):
+    # sacct stand-in: -j, -X, -n, -P, -o/--format, -S/--starttime, -s/--state and --name
+    options, flags = parse_query([a for a in argv if a not in ("-n", "--noheader")]) # -n is --noheader for sacct, not --name
+    ids, names = _values(options, "jobs"), _values(options, "name")
+    since = options.get("starttime")
+    since = datetime.fromisoformat(since).timestamp() if since else None
+    states = _states(options.get("states"))
+    fields = options.get("format", "JobID,JobName,Partition,State,ExitCode").split(",")
+    parsable = bool({"-P", "--parsable2"} & flags)
+    rows = [fields] if not {"-n", "--noheader"} & set(argv) else []
+    for job in executor.jobs().values():
+        if (ids and job["id"] not in ids) or (names and job["name"] not in names) or (since and job["submit"] < since) or (states and job["state"] not in states):
+            continue
+        end = job["end"] or time.time()
+        values = {
+            "JobID": job["id"], "JobName": job["name"], "Partition": job["partition"], "Account": job["account"], "State": job["state"],
+            "ExitCode": f"{job['exit_code'] if job['exit_code'] is not None else 0}:0", "NodeList": LOCAL_NODE if job["start"] else "None assigned",
+            "Submit": _job_time(job["submit"]), "Start": _job_time(job["start"]), "End": _job_time(job["end"]),
+            "Elapsed": format_duration(end - job["start"]) if job["start"] else "00:00:00",
+            "ElapsedRaw": int(end - job["start"]) if job["start"] else 0, "AllocCPUS": job["cpus"], "Restarts": job["restarts"],
+            "Timelimit": format_duration(job["time_limit"]) if job["time_limit"] else "UNLIMITED",
+            "AllocTRES": f"cpu={job['cpus']}" + (f",gres/gpu={job['gpus']}" if job["gpus"] else ""),
+        }
+        rows.append([str(values.get(f, "")) for f in fields])
+    for row in rows:
+        print("|".join(row) if parsable else " ".join(v.ljust(12) for v in row))
+
+def sbatch(executor, argv):
+    # sbatch stand-in: submits (the script from stdin if none is given), --test-only prints an immediate start estimate, -W waits for the job and returns its exit code
+    options, script, args = parse_options(argv)
+    if options.get("test-only"):
+        print(f"sbatch: Job 0 to start at {datetime.now().strftime(TIME_FORMAT)} using 1 processors on nodes {LOCAL_NODE} in partition {options.get('partition', 'local')}",
+              file=sys.stderr)
+        return 0
+    option_argv = argv[:len(argv) - len(args) - (1 if script else 0)]
+    job_id = executor.submit(script, args, option_argv, script_text=sys.stdin.read() if script is None else None)
+    print(job_id if options.get("parsable") else f"Submitted batch job {job_id}", flush=True)
+    if options.get("wait"):
+        executor.wait(job_id)
+        return executor.jobs()[job_id]["exit_code"] or 0
+    return 0
+
+def scontrol(executor, argv):
+    # scontrol stand-in: "show hostnames", "show job" and "requeue"
+    if argv[:2] == ["show", "hostnames"]:
+        print(LOCAL_NODE)
+    elif argv[:2] == ["show", "job"] and len(argv) > 2:
+        output, error = executor.log_paths(argv[2])
+        job = executor.jobs().get(argv[2])
+        if job:
+            print(f"JobId={job['id']} JobName={job['name']} JobState={job['state']} Partition={job['partition']} StdOut={output} StdErr={error}")
+    elif argv[:1] == ["requeue"]:
+        for job_id in argv[1:]:
+            executor.requeue(job_id)
+    return 0
+
+# endregion
+
+if __name__ == '__main__':
+    # Entry point of the shims ("<command> args...") and of the local runners ("run <job id>")
+    command, argv = sys.argv[1], sys.argv[2:]
+    executor = LocalExecutor(os.environ[LOCAL_DIR_ENV])
+    if command == "run":
+        executor.run(argv[0])
+    elif command == "sbatch":
+        exit(sbatch(executor, argv))
+    elif command == "squeue":
+        squeue(executor, argv)
+    elif command == "scancel":
+        for job_id in argv:
+            executor.cancel(job_id)
+    elif command == "sacct":
+        sacct(executor, argv)
+    elif command == "scontrol":
+        exit(scontrol(executor, argv))
@@ -0,0 +1,55 @@
+import subprocess
+
+from partition_selection import candidate_partitions
+from retry_policy import scale_memory
+
+# region ### CONSTANTS ###
+LAYOUTS = ["spread", "packed"] # spread = one single-GPU job per fold, packed = several folds per multi-GPU job
+PACK_QUEUE_DEPTH = 5 # pack folds once at least this many jobs are pending on every single-GPU training partition
+# endregion
+
+# region ### FOLD LAYOUT ###
+
+def fold_groups(folds, layout, folds_per_job):
+    '''
+    Groups folds into the jobs that will train them
+    Args:
+        folds: the fold numbers to train
+        layout: "spread" or "packed"
+        folds_per_job: how many folds a packed job holds (GPUs per node)
+    Out: list of fold lists, one per job. A group with a single fold always runs as a regular single-GPU job
+    '''
+    folds = list(folds)
+    if layout != "packed" or folds_per_job < 2:
+        return [[fold] for fold in folds]
+    return [folds[i:i + folds_per_job] for i in range(0, len(folds), folds_per_job)]
+
+def packed_resources(profile, num_folds):
+    # Resource overrides for a packed job that trains num_folds folds side by side, one GPU (plus its tasks and memory) per fold
+    return {
+        "gres": f"gpu:{profile['gpu_type']}:{num_folds}",
+        "ntasks": profile["ntasks_per_fold"] * num_folds,
+        "mem": scale_memory(profile["mem_per_fold"], num_folds),
+    }
+
+def pending_jobs(partition):
+    # Number of jobs currently pending on a partition (all users)
+    result = subprocess.run(["squeue", "-h", "-p", partition, "-t", "PENDING", "-o", "%i"], capture_output=True, text=True)
+    return len(result.stdout.split())
+
+def choose_fold_layout(profiles):
+    '''
+    Picks between spreading the folds over single-GPU jobs and packing them onto 4-GPU nodes, from the current queue depth. Packing pays off when the single-GPU partitions are backed up
+    (five folds would wait through five scheduling decisions) and the packed partition is less busy
+    Args:
+        profiles: resource profiles as returned by load_profiles
+    Out: "spread" or "packed"
+    '''
+    spread_depth = min(pending_jobs(p) for p in candidate_partitions(profiles["model_training"]))
+    packed_partition = profiles["model_training_packed"]["partition"]
+    packed_depth = pending_jobs(packed_partition)
+    layout = "packed" if spread_depth >= PACK_QUEUE_DEPTH and packed_depth < spread_depth else "spread"
+    print(f"Fold layout: {layout} ({spread_depth} jobs pending for single-GPU training, {packed_depth} pending on {packed_partition})")
+    return layout
+
+# endregion
@@ -0,0 +1,90 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+# region ### CONSTANTS ###
+SPLITS_FILE = "splits_final.json"
+NUM_FOLDS = 5
+SPLIT_SEED = 12345 # nnUNet's own KFold seed, so the splits are the same ones nnUNet would have made
+PLANS_FOLDER = "nnUNetPlans_3d_fullres"
+# Files in nnUNet_preprocessed/<dataset> that every fold reads (or would otherwise create) when it starts
+SHARED_ARTIFACTS = ["dataset.json", "dataset_fingerprint.json", "nnUNetPlans.json", SPLITS_FILE]
+# endregion
+
+# region ### SPLITS ###
+
+def get_case_identifiers(preprocessed_dir: Path):
+    # Sorted case identifiers of the preprocessed training cases (every case has a .pkl properties file, whatever the data format)
+    plans_dir = Path(preprocessed_dir) / PLANS_FOLDER
+    if not plans_dir.exists():
+        return []
+    return sorted(p.name[:-len(".pkl")] for p in plans_dir.iterdir() if p.name.endswith(".pkl"))
+
+def make_splits(identifiers, num_folds=NUM_FOLDS, seed=SPLIT_SEED):
+    '''
+    Splits the cases into train/val folds the same way nnUNet does (sklearn KFold with shuffling and a fixed seed on the sorted case identifiers)
+    Args:
+        identifiers: the case identifiers
+        num_folds: number of folds
+        seed: random seed for the shuffle
+    Out: list with one {"train": [...], "val": [...]} dictionary per fold
+    '''
+    keys = sorted(identifiers)
+    indices = np.arange(len(keys))
+    np.random.RandomState(seed).shuffle(indices)
+    fold_sizes = [len(keys) // num_folds + (1 if i < len(keys) % num_folds else 0) for i in range(num_folds)]
+
+    splits = []
+    start = 0
+    for size in fold_sizes:
+        val_idx = set(indices[start:start + size].tolist())
+        splits.append({
+            "train": [keys[i] for i in range(len(keys)) if i not in val_idx],
+            "val": [keys[i] for i in range(len(keys)) if i in val_idx],
+        })
+        start += size
+    return splits
+
+def create_splits(preprocessed_dir: Path):
+    '''
+    Writes splits_final.json into the preprocessed dataset folder so no fold has to create it (folds that start at the same time would otherwise race to write it). An existing file is never replaced
+    Args:
+        preprocessed_dir: the dataset folder inside nnUNet_preprocessed
+    Out: path to the splits file, None if there are no preprocessed cases yet
+    '''
+    splits_path = Path(preprocessed_dir) / SPLITS_FILE
+    if splits_path.exists():
+        return splits_path
+    identifiers = get_case_identifiers(preprocessed_dir)
+    if len(identifiers) < NUM_FOLDS:
+        return None
+    tmp_path = splits_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(make_splits(identifiers), f, sort_keys=True, indent=4)
+    tmp_path.replace(splits_path)
+    print(f"Created {splits_path} ({len(identifiers)} cases, {NUM_FOLDS} folds)")
+    return splits_path
+
+# endregion
+
+# region ### FOLD READINESS ###
+
+def missing_shared_artifacts(preprocessed_dir: Path):
+    '''
+    Lists the shared files that are not in place yet for all folds to start at once: the plans, fingerprint, dataset.json and splits, and the unpacked .npy copy of every compressed case (nnUNet unpacks on startup, which folds would race on)
+    Args:
+        preprocessed_dir: the dataset folder inside nnUNet_preprocessed
+    Out: list of missing paths (empty when every fold can start immediately)
+    '''
+    preprocessed_dir = Path(preprocessed_dir)
+    missing = [preprocessed_dir / name for name in SHARED_ARTIFACTS if not (preprocessed_dir / name).exists()]
+    plans_dir = preprocessed_dir / PLANS_FOLDER
+    if not plans_dir.exists():
+        return missing + [plans_dir]
+    for npz in plans_dir.glob("*.npz"):
+        if not npz.with_suffix(".npy").exists():
+            missing.append(npz.with_suffix(".npy"))
+    return missing
+
+# endregion
@@ -0,0 +1,185 @@
+import fcntl
+import json
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# region ### CONSTANTS ###
+LIMITS_FILE = "gpu_limits.config"
+STATE_FILE = "gpu_governor_state.json"
+LOCK_FILE = "gpu_governor.lock"
+DEFAULT_LIMIT_KEY = "default"
+PRIORITIES = {"critical": 0, "normal": 1, "exploratory": 2} # Lower rank is released first
+# endregion
+
+# region ### UTILITY FUNCTIONS ###
+
+def load_limits(limits_path: Path):
+    '''
+    Reads the per-partition GPU caps from a key=value file (same format as the GUI presets), e.g. "msigpu=4"
+    Args:
+        limits_path: path to the limits file
+    Out: dictionary mapping partition name (or "default") to the max number of GPUs held at once, plus an optional "state_dir" entry
+    '''
+    limits = {}
+    if not limits_path.exists():
+        return limits
+    with open(limits_path) as f:
+        for line in f:
+            parts = line.strip().split('=', 1)
+            if len(parts) != 2 or line.strip().startswith('#'):
+                continue
+            key, value = parts[0].strip(), parts[1].strip()
+            if key == "state_dir":
+                limits[key] = value
+            elif value.isdigit():
+                limits[key] = int(value)
+    return limits
+
+def is_pid_alive(pid):
+    # Checks whether the pipeline process that holds a ticket still exists on this machine
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def held_gpus(entries, partition=None):
+    # GPUs held by slot entries (on one partition if given); entries from before slots were weighted hold one GPU
+    return sum(e.get("gpus", 1) for e in entries if partition is None or e["partition"] == partition)
+
+def is_job_queued(job_id):
+    # Checks whether a SLURM job is still pending or running (same squeue check the pipelines use)
+    result = subprocess.run(['squeue', '--job', str(job_id)], capture_output=True, text=True)
+    return str(job_id) in result.stdout
+
+# endregion
+
+# region ### GOVERNOR ###
+
+class GpuGovernor:
+    '''
+    Local admission controller that caps the number of GPUs held by queued or running jobs per partition across every pipeline that shares the same state directory (i.e. the whole faird account when run from the shared GUI checkout).
+    A job holds one slot per GPU it requests, so a packed 4-GPU job counts as four. Submissions wait in a fair-share queue: critical pipelines go first, then whichever pipeline currently holds the fewest GPUs, then first come first served.
+    '''
+
+    def __init__(self, script_dir, pipeline, priority="normal", poll_interval=30):
+        self.script_dir = Path(script_dir)
+        self.limits = load_limits(self.script_dir / LIMITS_FILE)
+        self.state_dir = Path(self.limits.get("state_dir", self.script_dir / "logs"))
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        self.pipeline = pipeline
+        self.priority = priority if priority in PRIORITIES else "normal"
+        self.poll_interval = poll_interval
+
+    def limit_for(self, partition):
+        # Returns the cap for a partition, None means the partition is not governed
+        return self.limits.get(partition, self.limits.get(DEFAULT_LIMIT_KEY))
+
+    @contextmanager
+    def _locked_state(self):
+        # Opens the shared state file under an exclusive lock so several pipelines can safely update it at once
+        with open(self.state_dir / LOCK_FILE, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state_path = self.state_dir / STATE_FILE
+            state = {"next_ticket": 1, "running": [], "waiting": []}
+            if state_path.exists() and state_path.stat().st_size > 0:
+                with open(state_path) as f:
+                    state = json.load(f)
+            try:
+                yield state
+            finally:
+                tmp_path = state_path.with_suffix(".tmp")
+                with open(tmp_path, "w") as f:
+                    json.dump(state, f, indent=2)
+                tmp_path.replace(state_path)
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _drop_stale(self, state):
+        # Frees slots whose SLURM job has left the queue, and drops entries whose pipeline process has died
+        running = []
+        for entry in state["running"]:
+            if entry.get("job_id"):
+                if is_job_queued(entry["job_id"]):
+                    running.append(entry)
+            elif is_pid_alive(entry["pid"]):
+                running.append(entry)
+        state["running"] = running
+        state["waiting"] = [w for w in state["waiting"] if is_pid_alive(w["pid"])]
+
+    def _next_in_line(self, state, partition):
+        # Picks the waiting ticket that should get the next free slot on this partition (fair-share order)
+        held = {}
+        for entry in state["running"]:
+            held[entry["pipeline"]] = held.get(entry["pipeline"], 0) + entry.get("gpus", 1)
+        candidates = [w for w in state["waiting"] if w["partition"] == partition]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda w: (PRIORITIES[w["priority"]], held.get(w["pipeline"], 0), w["enqueued"]))["ticket"]
+
+    def acquire(self, partition, gpus=1):
+        '''
+        Blocks until enough GPU slots on the given partition are free and it is this pipeline's turn in the fair-share queue
+        Args:
+            partition: the SLURM partition the job will be submitted to
+            gpus: how many GPUs the job requests (a job asking for more than the cap runs once the partition is otherwise empty)
+        Out: the ticket number holding the slots (None if the partition is not governed)
+        '''
+        limit = self.limit_for(partition)
+        if limit is None:
+            return None
+        gpus = min(gpus, limit)
+
+        with self._locked_state() as state:
+            ticket = state["next_ticket"]
+            state["next_ticket"] += 1
+            state["waiting"].append({
+                "ticket": ticket, "partition": partition, "pipeline": self.pipeline, "gpus": gpus,
+                "priority": self.priority, "pid": os.getpid(), "enqueued": time.time()
+            })
+
+        print_counter = 0
+        while True:
+            with self._locked_state() as state:
+                self._drop_stale(state)
+                in_use = held_gpus(state["running"], partition)
+                if in_use + gpus <= limit and self._next_in_line(state, partition) == ticket:
+                    state["waiting"] = [w for w in state["waiting"] if w["ticket"] != ticket]
+                    state["running"].append({
+                        "ticket": ticket, "partition": partition, "pipeline": self.pipeline, "gpus": gpus,
+                        "pid": os.getpid(), "job_id": None, "since": time.time()
+                    })
+                    return ticket
+            if print_counter % 20 == 0:
+                print(f"Waiting for {gpus} free GPU slot(s) on {partition} ({in_use}/{limit} in use)...")
+            print_counter += 1
+            time.sleep(self.poll_interval)
+
+    def attach(self, ticket, job_id):
+        '''
+        Binds a held slot to a SLURM job id, after which the slot is freed automatically as soon as the job leaves the queue
+        Args:
+            ticket: the ticket returned by acquire
+            job_id: the SLURM job id that is using the slot
+        Out: None
+        '''
+        if ticket is None or job_id is None:
+            return
+        with self._locked_state() as state:
+            for entry in state["running"]:
+                if entry["ticket"] == ticket:
+                    entry["job_id"] = str(job_id)
+
+    def release(self, ticket):
+        # Explicitly gives a slot back (e.g. once the pipeline has seen the job finish)
+        if ticket is None:
+            return
+        with self._locked_state() as state:
+            state["running"] = [r for r in state["running"] if r["ticket"] != ticket]
+            state["waiting"] = [w for w in state["waiting"] if w["ticket"] != ticket]
+
+# endregion
@@ -0,0 +1,153 @@
+import csv
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+
+from comparison_store import case_dice
+from dataset_preflight import index_cases
+from nifti_io import load_many
+
+# region ### CONSTANTS ###
+MANIFEST_FILE = "inference_manifest.json" # in the inference output folder: per test case, the input and model it was predicted from and its Dice
+CASE_DICE_FILE = "case_dice.csv" # per-case Dice written to the results folder from the manifest
+IMAGE_SUFFIX = ".nii.gz"
+# endregion
+
+# region ### FINGERPRINTS ###
+
+def case_fingerprints(index, split="Ts"):
+    '''
+    Fingerprints every test case from the dataset index: the input is the hash of all its channel files, the label the hash of its label file
+    Args:
+        index: the task's dataset index (see dataset_preflight.scan_task), with a sha256 per test file (see dataset_preflight.hash_files)
+        split: the split to fingerprint
+    Out: dictionary of case -> {"input", "label" (None if the case has no label), "files" (the image file names)}
+    '''
+    fingerprints = {}
+    for case, files in index_cases(index, split).items():
+        if not files["channels"]:
+            continue
+        channels = sorted(files["channels"].items())
+        digest = hashlib.sha256("".join(entry.get("sha256", "") for _, entry in channels).encode()).hexdigest()
+        label = files["label"].get("sha256") if files["label"] else None
+        fingerprints[case] = {"input": digest, "label": label, "files": [f"{case}_{channel:04d}{IMAGE_SUFFIX}" for channel, _ in channels]}
+    return fingerprints
+
+def model_fingerprint(checkpoints, settings=""):
+    # Fingerprint of the model used for inference from the size and modification time of every checkpoint it ensembles, None if one is missing
+    digest = hashlib.sha256(settings.encode())
+    for checkpoint in checkpoints:
+        if not Path(checkpoint).exists():
+            return None
+        stat = Path(checkpoint).stat()
+        digest.update(f"{checkpoint}:{stat.st_size}:{stat.st_mtime}".encode())
+    return digest.hexdigest()
+
+# endregion
+
+# region ### MANIFEST ###
+
+def load_manifest(output_dir: Path):
+    # Reads the inference manifest of an output folder, empty if there is none yet
+    manifest_path = Path(output_dir) / MANIFEST_FILE
+    if not manifest_path.exists():
+        return {"cases": {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def save_manifest(output_dir: Path, manifest):
+    # Writes the inference manifest atomically
+    manifest_path = Path(output_dir) / MANIFEST_FILE
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    tmp_path.replace(manifest_path)
+
+def plan_inference(manifest, cases, model, output_dir: Path):
+    '''
+    Works out which test cases have to be predicted: cases that are new, whose images changed, that were predicted with a different model or whose prediction is missing.
+    Predictions of cases that are no longer in imagesTs, and stale predictions of the cases about to be predicted, are deleted
+    Args:
+        manifest: the output folder's inference manifest (updated in place)
+        cases: the case fingerprints
+        model: the model fingerprint, None if it is unknown (everything is predicted)
+        output_dir: the inference output folder
+    Out: (sorted list of cases to predict, list of removed cases)
+    '''
+    output_dir = Path(output_dir)
+    removed = sorted(set(manifest["cases"]) - set(cases))
+    for case in removed:
+        (output_dir / f"{case}{IMAGE_SUFFIX}").unlink(missing_ok=True)
+        del manifest["cases"][case]
+    pending = []
+    for case, fingerprint in cases.items():
+        entry = manifest["cases"].get(case)
+        if model is None or entry is None or entry["input"] != fingerprint["input"] or entry["model"] != model or not (output_dir / f"{case}{IMAGE_SUFFIX}").exists():
+            pending.append(case)
+            (output_dir / f"{case}{IMAGE_SUFFIX}").unlink(missing_ok=True)
+            manifest["cases"].pop(case, None)
+    return sorted(pending), removed
+
+def stage_inputs(staging_dir: Path, images_dir: Path, cases, pending):
+    # Creates (or refreshes) a folder linking only the channel files of the cases to predict, used as nnUNet's input folder
+    staging_dir = Path(staging_dir)
+    if staging_dir.exists():
+        shutil.rmtree(staging_dir)
+    staging_dir.mkdir(parents=True)
+    for case in pending:
+        for name in cases[case]["files"]:
+            os.symlink((Path(images_dir) / name).resolve(), staging_dir / name)
+    return staging_dir
+
+def record_predictions(manifest, cases, model, pending, output_dir: Path):
+    # Adds the cases that were predicted to the manifest, returns the ones nnUNet didn't write a prediction for
+    missing = []
+    for case in pending:
+        if model is not None and (Path(output_dir) / f"{case}{IMAGE_SUFFIX}").exists():
+            manifest["cases"][case] = {"input": cases[case]["input"], "model": model, "predicted": round(time.time())}
+        else:
+            missing.append(case)
+    return missing
+
+# endregion
+
+# region ### EVALUATION ###
+
+def update_evaluation(manifest, cases, output_dir: Path, labels_dir: Path):
+    '''
+    Computes the Dice of the predictions that are new or whose label changed since they were last evaluated, keeping the stored Dice of every other case
+    Args:
+        manifest: the output folder's inference manifest (updated in place)
+        cases: the case fingerprints
+        output_dir: the inference output folder
+        labels_dir: the task's labelsTs folder
+    Out: list of cases that were (re-)evaluated
+    '''
+    evaluated = []
+    for case, entry in manifest["cases"].items():
+        label = cases.get(case, {}).get("label")
+        if label is None or entry.get("evaluated") == [entry["input"], entry["model"], label]:
+            continue
+        prediction, truth = load_many([Path(output_dir) / f"{case}{IMAGE_SUFFIX}", Path(labels_dir) / f"{case}{IMAGE_SUFFIX}"])
+        entry["dice"] = case_dice(prediction, truth)
+        entry["evaluated"] = [entry["input"], entry["model"], label]
+        evaluated.append(case)
+    return evaluated
+
+def write_case_dice(manifest, results_dir: Path):
+    # Writes every evaluated case's Dice to case_dice.csv in the results folder and returns the mean
+    results_dir = Path(results_dir)
+    results_dir.mkdir(parents=True, exist_ok=True)
+    rows = sorted((case, entry["dice"]) for case, entry in manifest["cases"].items() if entry.get("dice") is not None)
+    with open(results_dir / CASE_DICE_FILE, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["case", "dice"])
+        writer.writerows((case, round(dice, 4)) for case, dice in rows)
+    return float(np.mean([dice for _, dice in rows])) if rows else None
+
+# endregion
@@ -0,0 +1,103 @@
+import subprocess
+import time
+from pathlib import Path
+
+from training_logs import parse_training_log, typical_epoch_time
+
+# region ### CONSTANTS ###
+DEFAULT_STALL_TIMEOUT = 7200 # seconds without progress before a job counts as stalled when its epoch time isn't known yet
+DEFAULT_STALL_EPOCHS = 4     # once the epoch time is known, a job is stalled after this many epoch lengths without progress
+MIN_STALL_TIMEOUT = 1800     # never call a job stalled sooner than this, however short its epochs are
+# endregion
+
+# region ### UTILITY FUNCTIONS ###
+
+def get_job_state(job_id):
+    # Returns the squeue state of a job (e.g. "PENDING", "RUNNING"), None once it has left the queue
+    result = subprocess.run(['squeue', '-h', '-j', str(job_id), '-o', '%T'], capture_output=True, text=True)
+    lines = result.stdout.strip().splitlines()
+    return lines[0].strip() if lines else None
+
+def path_signature(path):
+    # Size and modification time of a file or directory (a directory changes when files are written into it), None if it doesn't exist
+    try:
+        stat = Path(path).stat()
+    except (OSError, TypeError):
+        return None
+    return (stat.st_size, stat.st_mtime)
+
+def watchdog_for(profile):
+    # Builds a watchdog using the no-progress limits of a step's resource profile
+    return JobWatchdog(profile.get("stall_timeout", DEFAULT_STALL_TIMEOUT), profile.get("stall_epochs", DEFAULT_STALL_EPOCHS))
+
+# endregion
+
+# region ### WATCHDOG ###
+
+class JobWatchdog:
+    '''
+    Notices SLURM jobs that are RUNNING but no longer making progress (e.g. a dataloader deadlock or a hung filesystem), so they can be cancelled and resubmitted instead of waiting out the time limit.
+    Progress is any change to the watched log files or output folders, seen by polling them like a log tailer. The allowed quiet period scales with the epoch time observed in the nnUNet training log.
+    '''
+
+    def __init__(self, stall_timeout=DEFAULT_STALL_TIMEOUT, stall_epochs=DEFAULT_STALL_EPOCHS):
+        self.stall_timeout = stall_timeout
+        self.stall_epochs = stall_epochs
+        self.jobs = {}
+
+    def watch(self, job_id, paths, training_log=None):
+        '''
+        Starts tracking a job
+        Args:
+            job_id: the SLURM job id
+            paths: callable returning the files/folders whose changes count as progress (a callable so paths that only appear later, e.g. the training_log in the fold folder, are picked up)
+            training_log: callable returning the nnUNet training log to read the epoch time from (None for jobs without epochs, e.g. inference)
+        Out: None
+        '''
+        self.jobs[str(job_id)] = {"paths": paths, "training_log": training_log, "signatures": {}, "last_progress": None, "epoch": None}
+
+    def forget(self, job_id):
+        # Stops tracking a job once it has ended
+        self.jobs.pop(str(job_id), None)
+
+    def threshold(self, job_id):
+        # Seconds without progress after which the job counts as stalled
+        job = self.jobs[str(job_id)]
+        epoch_time = None
+        if job["training_log"] is not None:
+            progress = parse_training_log(job["training_log"]())
+            job["epoch"] = progress["epoch"]
+            epoch_time = typical_epoch_time(progress["epoch_times"])
+        if epoch_time is None:
+            return self.stall_timeout
+        return max(self.stall_epochs * epoch_time, MIN_STALL_TIMEOUT)
+
+    def is_stalled(self, job_id):
+        '''
+        Records any progress since the last check and reports whether the job has gone quiet for too long. Time spent PENDING (including after a self-requeue) never counts
+        Args:
+            job_id: a job id passed to watch
+        Out: True if the job is running and has made no progress for longer than its threshold, False otherwise
+        '''
+        job = self.jobs.get(str(job_id))
+        if job is None:
+            return False
+        now = time.time()
+        if get_job_state(job_id) != "RUNNING":
+            job["last_progress"] = None
+            return False
+
+        signatures = {str(p): path_signature(p) for p in job["paths"]() if p is not None}
+        if job["last_progress"] is None or signatures != job["signatures"]:
+            job["signatures"] = signatures
+            job["last_progress"] = now
+            return False
+
+        quiet = now - job["last_progress"]
+        limit = self.threshold(job_id)
+        if quiet > limit:
+            print(f"Job {job_id} has made no progress for {quiet / 60:.0f} min (limit {limit / 60:.0f} min, last epoch seen: {job['epoch']})")
+            return True
+        return False
+
+# endregion
@@ -0,0 +1,217 @@
+import argparse
+import gzip
+import io
+import os
+import struct
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+# region ### CONSTANTS ###
+IO_WORKERS = min(8, os.cpu_count() or 1) # threads per file (zlib releases the GIL, so blocks really run in parallel)
+BLOCK_SIZE = 4 << 20 # uncompressed bytes per gzip member when writing
+FINAL_LEVEL = 6 # zlib level for files that are kept (gzip's default)
+INTERMEDIATE_LEVEL = 1 # zlib level for files that are read again soon and then deleted (what nibabel writes by default)
+# Each member written here carries its compressed size in a gzip extra field (like BGZF), so readers can find the members without decompressing.
+# Any gzip reader still reads the file as one stream; files from other tools are single members and are decompressed in one go
+EXTRA_ID = b"DC"
+MEMBER_HEADER = struct.Struct("<4sIBBH2sHI") # magic+method+flags, mtime, xfl, os, xlen, subfield id, subfield length, member size
+NIFTI2_HEADER_SIZE = 540
+HEADER_READ = 64 << 10 # bytes decompressed to decode a header and its extensions
+IMAGE_SUFFIX = ".nii.gz"
+# Shapes of the volumes the benchmark generates: infant scans at 0.8 mm and lifespan scans at 1 mm
+BENCHMARK_SHAPES = {"infant": (208, 300, 320), "lifespan": (256, 256, 256)}
+# endregion
+
+# region ### CODEC ###
+
+def _compress_block(block, level):
+    # One gzip member holding a block, with its total size in the extra field
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(block) + compressor.flush()
+    size = MEMBER_HEADER.size + len(body) + 8
+    header = MEMBER_HEADER.pack(b"\x1f\x8b\x08\x04", 0, 0, 255, 8, EXTRA_ID, 4, size)
+    return header + body + struct.pack("<II", zlib.crc32(block), len(block) & 0xFFFFFFFF)
+
+def compress(data, level=FINAL_LEVEL, workers=IO_WORKERS):
+    '''
+    Gzips a buffer in independent blocks on several threads (the output is a valid multi-member gzip file)
+    Args:
+        data: the bytes to compress
+        level: zlib compression level (FINAL_LEVEL or INTERMEDIATE_LEVEL)
+        workers: number of threads
+    Out: the compressed bytes
+    '''
+    view = memoryview(data)
+    blocks = [view[i:i + BLOCK_SIZE] for i in range(0, len(view), BLOCK_SIZE)] or [view]
+    with ThreadPoolExecutor(workers) as pool:
+        return b"".join(pool.map(lambda block: _compress_block(block, level), blocks))
+
+def _member_offsets(data):
+    # Start and end of every member if the whole file was written by compress, else None
+    offsets, position = [], 0
+    while position < len(data):
+        if len(data) - position < MEMBER_HEADER.size:
+            return None
+        magic, _, _, _, xlen, subfield, length, size = MEMBER_HEADER.unpack_from(data, position)
+        if magic != b"\x1f\x8b\x08\x04" or xlen != 8 or subfield != EXTRA_ID or length != 4:
+            return None
+        offsets.append((position, position + size))
+        position += size
+    return offsets
+
+def decompress(data, workers=IO_WORKERS):
+    # Gunzips a buffer, block-parallel if it was written by compress, otherwise in one go
+    offsets = _member_offsets(data)
+    if offsets is None or len(offsets) == 1:
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS) if offsets else gzip.decompress(data)
+    view = memoryview(data)
+    with ThreadPoolExecutor(workers) as pool:
+        return b"".join(pool.map(lambda span: zlib.decompress(view[span[0]:span[1]], 16 + zlib.MAX_WBITS), offsets))
+
+# endregion
+
+# region ### NIFTI ###
+
+def _image_class(data):
+    # NIfTI-1 and NIfTI-2 are told apart by the header size stored in their first four bytes (in either byte order)
+    sizes = struct.unpack_from("<i", data)[0], struct.unpack_from(">i", data)[0]
+    return nib.Nifti2Image if NIFTI2_HEADER_SIZE in sizes else nib.Nifti1Image
+
+def load(path, raw=None, mmap=True, workers=IO_WORKERS):
+    '''
+    Loads a NIfTI image. .nii.gz files are read whole and decompressed in memory (block-parallel for files written by save); uncompressed .nii files are memory-mapped
+    Args:
+        path: the .nii or .nii.gz file
+        raw: the file's bytes if the caller has already read them (e.g. to hash them)
+        mmap: memory-map uncompressed files instead of reading them
+        workers: number of threads used to decompress
+    Out: the nibabel image
+    '''
+    path = Path(path)
+    if not path.name.endswith(IMAGE_SUFFIX):
+        return nib.load(str(path), mmap=mmap)
+    data = decompress(path.read_bytes() if raw is None else raw, workers)
+    return _image_class(data).from_bytes(data)
+
+def load_data(path, raw=None, mmap=True, workers=IO_WORKERS):
+    # Voxel data of a NIfTI file as an array (scaling applied the way nibabel's dataobj does)
+    return np.asanyarray(load(path, raw, mmap, workers).dataobj)
+
+def load_header(path, raw=None):
+    # Header-only read: decompresses just the start of a .nii.gz file (falls back to nibabel if its extensions don't fit in that)
+    path = Path(path)
+    if not path.name.endswith(IMAGE_SUFFIX):
+        return nib.load(str(path)).header
+    if raw is None:
+        with open(path, "rb") as f:
+            raw = f.read(HEADER_READ)
+    try:
+        data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(raw[:HEADER_READ], HEADER_READ)
+        return _image_class(data).header_class.from_fileobj(io.BytesIO(data))
+    except Exception:
+        return nib.load(str(path)).header
+
+def save(img, path, level=FINAL_LEVEL, workers=IO_WORKERS):
+    '''
+    Saves a NIfTI image. .nii.gz files are compressed block-parallel at the given level and written atomically; .nii files are written uncompressed (for intermediates that are memory-mapped by load)
+    Args:
+        img: the nibabel image
+        path: the output .nii or .nii.gz file
+        level: zlib compression level, FINAL_LEVEL for files that are kept, INTERMEDIATE_LEVEL for files that are read again soon and deleted
+        workers: number of threads used to compress
+    Out: the path written
+    '''
+    path = Path(path)
+    tmp_path = path.with_name(f".tmp.{path.name}") # keeps the extension, which nibabel picks the format from
+    if path.name.endswith(IMAGE_SUFFIX):
+        tmp_path.write_bytes(compress(img.to_bytes(), level, workers))
+    else:
+        img.to_filename(str(tmp_path))
+    tmp_path.replace(path)
+    return path
+
+def load_many(paths, workers=IO_WORKERS):
+    # Voxel data of several files read on parallel threads (for stages that compare files pairwise, e.g. predictions and labels)
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(lambda p: load_data(p, workers=1), paths))
+
+# endregion
+
+# region ### BENCHMARK ###
+
+def synthetic_volume(shape, seed=0):
+    '''
+    Makes a head-like image and label pair for benchmarking: an ellipsoid of smoothly varying intensity with noise on a zero background, and a label map of a few dozen regions inside it
+    Args:
+        shape: the volume shape, e.g. BENCHMARK_SHAPES["infant"]
+        seed: random seed
+    Out: (image as float32, label as uint8)
+    '''
+    rng = np.random.default_rng(seed)
+    grids = np.meshgrid(*[np.linspace(-1, 1, n, dtype=np.float32) for n in shape], indexing="ij")
+    radius = sum((g / r) ** 2 for g, r in zip(grids, (0.8, 0.9, 0.85)))
+    head = radius < 1
+    image = np.where(head, 600 + 300 * np.cos(3 * grids[0]) * np.sin(2 * grids[1]) + 40 * rng.standard_normal(shape, dtype=np.float32), 0).astype(np.float32)
+    centers = rng.uniform(-0.7, 0.7, size=(40, 3)).astype(np.float32)
+    label = np.zeros(shape, dtype=np.uint8)
+    nearest = np.full(shape, np.inf, dtype=np.float32)
+    for i, center in enumerate(centers, start=1):
+        distance = sum((g - c) ** 2 for g, c in zip(grids, center))
+        closer = head & (distance < nearest)
+        label[closer], nearest[closer] = i, distance[closer]
+    return image, label
+
+def run_benchmark(kind, workers=IO_WORKERS, repeats=3):
+    '''
+    Times reading and writing a synthetic infant or lifespan image and label with nibabel and with this module, at both compression levels and as memory-mapped .nii
+    Args:
+        kind: "infant" or "lifespan"
+        workers: threads used by this module
+        repeats: runs per measurement (the fastest is reported)
+    Out: list of (method, file, seconds to write, seconds to read, size in MB)
+    '''
+    image, label = synthetic_volume(BENCHMARK_SHAPES[kind])
+    affine = np.diag([0.8, 0.8, 0.8, 1] if kind == "infant" else [1, 1, 1, 1])
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, array in (("image", image), ("label", label)):
+            img = nib.Nifti1Image(array, affine)
+            methods = [
+                ("nibabel", f"{name}.nii.gz", lambda p: nib.save(img, str(p)), lambda p: np.asanyarray(nib.load(str(p)).dataobj)),
+                (f"nifti_io final (level {FINAL_LEVEL})", f"{name}.nii.gz", lambda p: save(img, p, FINAL_LEVEL, workers), lambda p: load_data(p, workers=workers)),
+                (f"nifti_io intermediate (level {INTERMEDIATE_LEVEL})", f"{name}.nii.gz", lambda p: save(img, p, INTERMEDIATE_LEVEL, workers), lambda p: load_data(p, workers=workers)),
+                ("nifti_io .nii, memory-mapped", f"{name}.nii", lambda p: save(img, p), lambda p: np.asarray(load(p).dataobj).sum()),
+            ]
+            for method, file_name, write, read in methods:
+                path = Path(tmp) / file_name
+                write_times, read_times = [], []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    write(path)
+                    write_times.append(time.perf_counter() - start)
+                    start = time.perf_counter()
+                    read(path)
+                    read_times.append(time.perf_counter() - start)
+                rows.append((method, name, min(write_times), min(read_times), path.stat().st_size / 1e6))
+                path.unlink()
+    return rows
+
+# endregion
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks NIfTI reads and writes with nibabel and with the parallel gzip codec")
+    parser.add_argument('--kind', nargs='+', default=list(BENCHMARK_SHAPES), choices=list(BENCHMARK_SHAPES))
+    parser.add_argument('--workers', type=int, default=IO_WORKERS)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    for kind in args.kind:
+        print(f"--- {kind} {BENCHMARK_SHAPES[kind]}, {args.workers} worker(s) ---")
+        for method, name, write, read, size in run_benchmark(kind, args.workers, args.repeats):
+            print(f"{name:6} {method:34} write {write:6.2f} s  read {read:6.2f} s  {size:7.1f} MB")
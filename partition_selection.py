@@ -0,0 +1,151 @@
+import csv
+import re
+import subprocess
+import time
+from datetime import datetime
+from pathlib import Path
+
+# region ### CONSTANTS ###
+CHOICES_FILE = "partition_choices.csv"
+FIELDS = ["decided_at", "step", "job_id", "chosen", "estimated_start", "actual_start", "estimates"]
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# e.g. "sbatch: Job 3983482 to start at 2024-05-01T12:34:56 using 6 processors on nodes agt01 in partition msigpu"
+TEST_ONLY_PATTERN = re.compile(r"to start at (\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})")
+# endregion
+
+# region ### PROBING ###
+
+def candidate_partitions(profile):
+    # A profile may list several interchangeable partitions. Overriding only "partition" (so it is no longer in the list) pins the step to it
+    partitions = profile.get("partitions") or []
+    if profile["partition"] not in partitions:
+        return [profile["partition"]]
+    return partitions
+
+def build_probe_command(profile, partition, sbatch="sbatch"):
+    '''
+    Builds an sbatch --test-only command that asks SLURM when a job with the profile's resources would start on a partition, without submitting anything
+    Args:
+        profile: the resource profile of the step being submitted
+        partition: the candidate partition to probe
+        sbatch: the sbatch executable (can point at a stand-in script for testing)
+    Out: the command as a list of arguments
+    '''
+    cmd = [sbatch, "--test-only", "-p", partition, "-A", profile["account"], f"--time={profile['time']}"]
+    for field, flag in [("nodes", "--nodes"), ("mem", "--mem"), ("mem_per_cpu", "--mem-per-cpu"), ("cpus_per_task", "--cpus-per-task"),
+                        ("ntasks", "--ntasks"), ("gres", "--gres"), ("tmp", "--tmp")]:
+        if field in profile:
+            cmd.append(f"{flag}={profile[field]}")
+    cmd.append("--wrap=true")
+    return cmd
+
+def parse_test_only(output):
+    # Extracts the estimated start time from sbatch --test-only output (printed on stderr), None if SLURM rejected the request
+    match = TEST_ONLY_PATTERN.search(output)
+    if not match:
+        return None
+    return datetime.strptime(match.group(1), TIME_FORMAT)
+
+def probe_partitions(profile, sbatch="sbatch"):
+    '''
+    Asks SLURM for the estimated start time of the step on each of its candidate partitions
+    Args:
+        profile: the resource profile of the step being submitted
+        sbatch: the sbatch executable (can point at a stand-in script for testing)
+    Out: dictionary mapping partition to estimated start (None if the partition can't run the job)
+    '''
+    estimates = {}
+    for partition in candidate_partitions(profile):
+        result = subprocess.run(build_probe_command(profile, partition, sbatch), capture_output=True, text=True)
+        estimates[partition] = parse_test_only(result.stderr + result.stdout)
+    return estimates
+
+def choose_partition(profile, sbatch="sbatch"):
+    '''
+    Picks the candidate partition with the earliest estimated start. Profiles with a single partition are not probed
+    Args:
+        profile: the resource profile of the step being submitted
+        sbatch: the sbatch executable (can point at a stand-in script for testing)
+    Out: (chosen partition, dictionary of estimates per partition)
+    '''
+    candidates = candidate_partitions(profile)
+    if len(candidates) == 1:
+        return candidates[0], {}
+    estimates = probe_partitions(profile, sbatch)
+    usable = {p: t for p, t in estimates.items() if t is not None}
+    if not usable:
+        print(f"Could not estimate start times on {', '.join(candidates)}, using {candidates[0]}")
+        return candidates[0], estimates
+    chosen = min(usable, key=lambda p: (usable[p], candidates.index(p)))
+    return chosen, estimates
+
+# endregion
+
+# region ### DECISION LOG ###
+
+def log_partition_choice(logs_path: Path, step, job_id, chosen, estimates):
+    '''
+    Records a partition decision in partition_choices.csv so estimated and actual start times can be compared later
+    Args:
+        logs_path: the task log folder
+        step: the pipeline step that was submitted
+        job_id: the SLURM job id of the submitted job
+        chosen: the partition the job was submitted to
+        estimates: dictionary of estimated start per probed partition
+    Out: None
+    '''
+    if not estimates:
+        return
+    choices_path = Path(logs_path) / CHOICES_FILE
+    new_file = not choices_path.exists()
+    with open(choices_path, "a", newline="") as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(FIELDS)
+        estimated = estimates.get(chosen)
+        writer.writerow([
+            time.strftime(TIME_FORMAT), step, job_id or "", chosen,
+            estimated.strftime(TIME_FORMAT) if estimated else "", "",
+            ";".join(f"{p}={t.strftime(TIME_FORMAT) if t else 'unavailable'}" for p, t in estimates.items())
+        ])
+    print(f"Submitting {step} to {chosen} (estimated start {estimated or 'unknown'})")
+
+def get_actual_start(job_id):
+    # Looks up when a job actually started running, None if it hasn't started yet
+    result = subprocess.run(["sacct", "-j", str(job_id), "-X", "-n", "-P", "-o", "Start"], capture_output=True, text=True)
+    lines = result.stdout.strip().splitlines()
+    if not lines or lines[0] in ("", "Unknown", "None"):
+        return None
+    return lines[0]
+
+def fill_actual_starts(logs_path: Path):
+    '''
+    Fills in the actual start time of every logged decision whose job has started since it was submitted, and prints how far off each estimate was
+    Args:
+        logs_path: the task log folder
+    Out: None
+    '''
+    choices_path = Path(logs_path) / CHOICES_FILE
+    if not choices_path.exists():
+        return
+    with open(choices_path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    changed = False
+    for row in rows:
+        if row["actual_start"] or not row["job_id"]:
+            continue
+        actual = get_actual_start(row["job_id"])
+        if actual:
+            row["actual_start"] = actual
+            changed = True
+            if row["estimated_start"]:
+                error = datetime.strptime(actual, TIME_FORMAT) - datetime.strptime(row["estimated_start"], TIME_FORMAT)
+                print(f"{row['step']} job {row['job_id']} on {row['chosen']} started {error.total_seconds() / 60:+.0f} min from its estimate")
+    if changed:
+        with open(choices_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+# endregion
@@ -0,0 +1,435 @@
+import argparse
+import csv
+import heapq
+import itertools
+import re
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from fold_packing import fold_groups
+from gpu_governor import LIMITS_FILE, load_limits
+from partition_selection import TIME_FORMAT, candidate_partitions
+from retry_policy import BACKOFF_BASE, BACKOFF_MAX, DEFAULT_RULES, parse_state
+from slurm_templates import load_profiles, uses_gpu
+from sweep import PIPELINE_STEPS, PRESETS_DIR, build_dag, expand_variants, load_sweep
+from training_progress import parse_slurm_time
+
+# region ### CONSTANTS ###
+HISTORY_FILE = "sacct_history.csv" # past job records (in the logs folder), refreshed with --fetch_since
+SACCT_FIELDS = ["JobID", "JobName", "Partition", "Submit", "Start", "End", "State", "AllocTRES"]
+# Job names of the V2 scripts -> the resource profile (step) they run
+JOB_STEPS = [
+    (re.compile(r"^create_min_maxes$"), "min_max"),
+    (re.compile(r"^SynthSeg_image_generation$"), "SynthSeg_img"),
+    (re.compile(r"^fingerprint_v2$"), "fingerprint"),
+    (re.compile(r"^plan_v2$"), "plan"),
+    (re.compile(r"^preprocess_v2$"), "preprocess"),
+    (re.compile(r"^\d+_\d+_Train_nnUNetv2$"), "model_training"),
+    (re.compile(r"^\d+(_\d+){2,}_Train_nnUNetv2$"), "model_training_packed"),
+    (re.compile(r"^\d+_infer_v2$"), "inference"),
+]
+TRAINING_STEPS = ("model_training", "model_training_packed")
+# The pipeline steps that are SLURM jobs, as the profiles they submit in order. The others (resize, copy, dataset.json) run in the pipeline process and take minutes next to the jobs
+STEP_JOBS = {"min_max": ["min_max"], "SynthSeg_img": ["SynthSeg_img"], "p_and_p": ["fingerprint", "plan", "preprocess"]}
+MIN_SAMPLES = 3 # fewer records than this and the fallbacks below are used
+# Fallbacks for steps with no history yet (seconds): rough medians of our infant runs, replace them by fetching sacct records
+FALLBACK_RUN = {"min_max": 3600, "SynthSeg_img": 12 * 3600, "fingerprint": 1800, "plan": 300, "preprocess": 2 * 3600,
+                "model_training": 60 * 3600, "inference": 3600}
+FALLBACK_WAIT = 1800
+FOLD_0_SETUP = 1800 # seconds fold 0 runs before its initial setup has written the shared artifacts and the other folds are submitted
+RESUME_OVERHEAD = 600 # seconds a resumed fold spends reloading its checkpoint and unpacking data before training again
+INFERENCE_OVERHEAD = 600 # seconds of every inference job spent on setup and loading the model, paid again by each shard
+RUNS = 500 # Monte Carlo repetitions per configuration
+# endregion
+
+# region ### HISTORY ###
+
+def get_step(job_name):
+    # The profile a job ran for, from its name, None for jobs that aren't pipeline steps
+    for pattern, step in JOB_STEPS:
+        if pattern.match(job_name):
+            return step
+    return None
+
+def parse_time(value):
+    # sacct timestamp as seconds since the epoch, None for "Unknown"/"None"
+    try:
+        return datetime.strptime(value, TIME_FORMAT).timestamp()
+    except ValueError:
+        return None
+
+def fetch_history(history_path: Path, since):
+    '''
+    Downloads the account's job records since a date from sacct, including every requeued run of a job (--duplicates), and merges them into the history file
+    Args:
+        history_path: the history file
+        since: start date, e.g. "2026-01-01"
+    Out: number of records in the history file
+    '''
+    result = subprocess.run(["sacct", "-X", "-D", "-P", "-n", "-S", since, "-o", ",".join(SACCT_FIELDS)], capture_output=True, text=True)
+    records = {(r["JobID"], r["Submit"], r["Start"]): r for r in load_history(history_path)}
+    for line in result.stdout.strip().splitlines():
+        values = line.split("|")
+        if len(values) == len(SACCT_FIELDS) and get_step(values[1]):
+            record = dict(zip(SACCT_FIELDS, values))
+            records[(record["JobID"], record["Submit"], record["Start"])] = record
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(history_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SACCT_FIELDS)
+        writer.writeheader()
+        writer.writerows(sorted(records.values(), key=lambda r: r["Submit"]))
+    return len(records)
+
+def load_history(history_path: Path):
+    # Reads the saved job records
+    if not Path(history_path).exists():
+        return []
+    with open(history_path, newline="") as f:
+        return list(csv.DictReader(f))
+
+def learn_distributions(records):
+    '''
+    Turns job records into samples of queue waits and run times. A training fold's run time is the sum of all its runs (requeues and resubmissions)
+    up to the one that completed it, minus the resume overhead of each restart; folds that were cancelled or never completed are left out
+    Args:
+        records: job records as read by load_history
+    Out: {"wait": {(step, partition): [seconds, ...]}, "run": {step: [seconds, ...]}}
+    '''
+    waits, runs, folds = {}, {}, {}
+    for record in sorted(records, key=lambda r: r["Submit"]):
+        step = get_step(record["JobName"])
+        submit, start, end = parse_time(record["Submit"]), parse_time(record["Start"]), parse_time(record["End"])
+        if step is None or start is None:
+            continue
+        waits.setdefault((step, record["Partition"]), []).append(max(0.0, start - submit))
+        if end is None:
+            continue
+        state = parse_state(record["State"])
+        if step in TRAINING_STEPS:
+            segments = folds.setdefault(record["JobName"], [])
+            segments.append(end - start)
+            if state == "COMPLETED":
+                runs.setdefault(step, []).append(max(sum(segments) - RESUME_OVERHEAD * (len(segments) - 1), 0.0))
+            if state in ("COMPLETED", "CANCELLED"): # the next job with this name trains the fold again from scratch
+                folds.pop(record["JobName"])
+        elif state == "COMPLETED":
+            runs.setdefault(step, []).append(end - start)
+    return {"wait": waits, "run": runs}
+
+def print_distributions(distributions):
+    # Prints how many records each step has and their median queue wait and run time
+    for step in sorted({s for s, _ in distributions["wait"]} | set(distributions["run"])):
+        runs = distributions["run"].get(step, [])
+        waits = {p: w for (s, p), w in distributions["wait"].items() if s == step}
+        wait_text = ", ".join(f"{p} {np.median(w) / 3600:.1f} h ({len(w)})" for p, w in waits.items())
+        run_text = f"{np.median(runs) / 3600:.1f} h ({len(runs)})" if runs else "none"
+        print(f"{step:22} run {run_text:16} wait {wait_text}")
+
+# endregion
+
+# region ### SIMULATION ###
+
+class PipelineSimulation:
+    '''
+    One simulated run of a sweep DAG (or of a single pipeline) from empty queue to the last inference job. It replays the orchestrator's decisions:
+    each node's steps run one after the other, nodes start when their dependencies are done (nodes sharing a lock one at a time, at most max_parallel at once),
+    GPU jobs pass the GPU governor's per-partition caps, every submission goes to the candidate partition with the earliest start,
+    fold 0 runs alone until its setup is done, training jobs requeue themselves before the time limit and are resubmitted with backoff after their last requeue,
+    and inference is split into shards. Queue waits and run times are drawn from the learned distributions
+    '''
+
+    def __init__(self, profiles, distributions, limits, rng, layout="spread", shards=1, gating=True):
+        self.profiles = profiles
+        self.distributions = distributions
+        self.limits = limits
+        self.rng = rng
+        self.layout = layout
+        self.shards = shards
+        self.gating = gating
+        self.clock = 0.0
+        self.events = []
+        self.counter = itertools.count()
+        self.gpu_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.held_gpus = {} # partition -> GPUs held by jobs through the governor (one slot per GPU)
+        self.governor_queue = {} # partition -> (GPUs, callback) of submissions waiting for governor slots, first come first served
+
+    def at(self, delay, callback):
+        # Schedules a callback delay seconds from now
+        heapq.heappush(self.events, (self.clock + delay, next(self.counter), callback))
+
+    def run(self):
+        # Processes events until nothing is left, returns the makespan in seconds
+        while self.events:
+            self.clock, _, callback = heapq.heappop(self.events)
+            callback()
+        return self.clock
+
+    # --- Sampling ---
+
+    def sample_run(self, step):
+        # A run time for a step from its history, or its fallback
+        samples = self.distributions["run"].get(step, [])
+        if len(samples) < MIN_SAMPLES and step == "model_training_packed":
+            return max(self.sample_run("model_training") for _ in range(self.profiles[step]["folds_per_job"]))
+        return float(self.rng.choice(samples)) if len(samples) >= MIN_SAMPLES else float(FALLBACK_RUN.get(step, FALLBACK_WAIT))
+
+    def sample_wait(self, step, partition):
+        # A queue wait for a step on a partition, falling back to any step's waits on that partition
+        samples = self.distributions["wait"].get((step, partition), [])
+        if len(samples) < MIN_SAMPLES:
+            samples = [w for (_, p), waits in self.distributions["wait"].items() if p == partition for w in waits]
+        return float(self.rng.choice(samples)) if len(samples) >= MIN_SAMPLES else float(FALLBACK_WAIT)
+
+    # --- Jobs ---
+
+    def submit(self, step, work, on_end, gpus=None, on_start=None, timeouts=0):
+        '''
+        Submits a job: waits for governor slots (one per GPU) if it uses a GPU, then for the earliest of its candidate partitions
+        Args:
+            step: the resource profile the job runs with
+            work: seconds of running the job needs
+            on_end: called once the work is done
+            gpus: GPUs the job holds while running (1 for a GPU profile if None)
+            on_start: called when the job first starts running
+            timeouts: how often this work already hit the time limit (for resubmissions)
+        Out: None
+        '''
+        profile = self.profiles[step]
+        waits = {p: self.sample_wait(step, p) for p in candidate_partitions(profile)}
+        partition = min(waits, key=waits.get)
+        job = {"step": step, "profile": profile, "partition": partition, "remaining": work, "requeues": 0, "timeouts": timeouts, "on_end": on_end, "on_start": on_start,
+               "gpus": (gpus if gpus is not None else 1) if uses_gpu(profile) else 0}
+        if job["gpus"]:
+            self.acquire(partition, job["gpus"], lambda: self.queue(job, waits[partition]))
+        else:
+            self.queue(job, waits[partition])
+
+    def limit_for(self, partition):
+        # The governor's GPU cap for a partition, None if it isn't governed
+        return self.limits.get(partition, self.limits.get("default"))
+
+    def acquire(self, partition, gpus, callback):
+        # GPU governor: runs callback once the job's GPUs fit under the partition's cap and no earlier submission is waiting (a job asking for more than the cap runs alone)
+        limit = self.limit_for(partition)
+        if limit is None:
+            callback()
+            return
+        self.governor_queue.setdefault(partition, []).append((min(gpus, limit), callback))
+        self.admit(partition)
+
+    def release(self, partition, gpus):
+        # Frees a job's governor slots and hands them to the waiting submissions
+        if self.limit_for(partition) is None:
+            return
+        self.held_gpus[partition] -= min(gpus, self.limit_for(partition))
+        self.admit(partition)
+
+    def admit(self, partition):
+        # Starts waiting submissions in order for as long as the first one fits under the cap
+        waiting = self.governor_queue.get(partition, [])
+        while waiting and self.held_gpus.get(partition, 0) + waiting[0][0] <= self.limit_for(partition):
+            gpus, callback = waiting.pop(0)
+            self.held_gpus[partition] = self.held_gpus.get(partition, 0) + gpus
+            callback()
+
+    def queue(self, job, wait=None):
+        # The job sits in the SLURM queue for a sampled wait, then starts
+        wait = self.sample_wait(job["step"], job["partition"]) if wait is None else wait
+        self.wait_seconds += wait
+        self.at(wait, lambda: self.start(job))
+
+    def start(self, job):
+        # Runs the job until its work is done or it reaches its time limit (minus the requeue signal lead while it can still requeue itself)
+        profile = job["profile"]
+        can_requeue = job["requeues"] < profile.get("max_requeues", 0)
+        limit = parse_slurm_time(profile["time"]) - (profile.get("requeue_signal_lead", 0) if can_requeue else 0)
+        ran = min(job["remaining"], limit)
+        if job["on_start"]:
+            on_start, job["on_start"] = job["on_start"], None
+            on_start()
+        self.at(ran, lambda: self.end(job, ran, can_requeue))
+
+    def end(self, job, ran, can_requeue):
+        # Finishes the job, requeues it (same job, same governor slot) or resubmits it after the retry policy's TIMEOUT backoff
+        self.gpu_seconds += job["gpus"] * ran
+        job["remaining"] -= ran
+        if job["remaining"] <= 0:
+            if job["gpus"]:
+                self.release(job["partition"], job["gpus"])
+            job["on_end"]()
+            return
+        job["remaining"] += RESUME_OVERHEAD
+        if can_requeue:
+            job["requeues"] += 1
+            self.queue(job)
+            return
+        if job["gpus"]:
+            self.release(job["partition"], job["gpus"])
+        job["timeouts"] += 1
+        if job["timeouts"] > DEFAULT_RULES["TIMEOUT"]["budget"]:
+            raise RuntimeError(f"{job['step']} needs more than {DEFAULT_RULES['TIMEOUT']['budget']} resubmissions, check its time limit")
+        delay = min(BACKOFF_BASE * 2 ** (job["timeouts"] - 1), BACKOFF_MAX)
+        self.at(delay, lambda: self.submit(job["step"], job["remaining"], job["on_end"], job["gpus"] or None, timeouts=job["timeouts"]))
+
+    # --- Steps ---
+
+    def run_jobs(self, steps, on_end):
+        # Runs single jobs one after the other (e.g. fingerprint, plan, preprocess)
+        if not steps:
+            on_end()
+            return
+        self.submit(steps[0], self.sample_run(steps[0]), lambda: self.run_jobs(steps[1:], on_end))
+
+    def train(self, on_end):
+        # Trains five folds: fold 0 alone until its setup is done when gating, then the rest spread or packed as the pipeline groups them
+        remaining = {"jobs": 0}
+        def _job_done():
+            remaining["jobs"] -= 1
+            if remaining["jobs"] == 0:
+                on_end()
+        def _submit(folds):
+            remaining["jobs"] += 1
+            if len(folds) == 1:
+                self.submit("model_training", self.sample_run("model_training"), _job_done, on_start=_after_fold_0 if folds == [0] and self.gating else None)
+            else:
+                self.submit("model_training_packed", self.sample_run("model_training_packed"), _job_done, gpus=len(folds))
+        def _after_fold_0():
+            self.at(FOLD_0_SETUP, lambda: [_submit(f) for f in fold_groups(range(1, 5), self.layout, self.profiles["model_training_packed"]["folds_per_job"])])
+        if self.gating:
+            _submit([0])
+        else:
+            for folds in fold_groups(range(5), self.layout, self.profiles["model_training_packed"]["folds_per_job"]):
+                _submit(folds)
+
+    def infer(self, on_end):
+        # Predicts the test set in shards that run side by side, each paying the model loading overhead
+        work = self.sample_run("inference")
+        shard_work = INFERENCE_OVERHEAD + max(work - INFERENCE_OVERHEAD, 0) / self.shards
+        remaining = {"shards": self.shards}
+        def _shard_done():
+            remaining["shards"] -= 1
+            if remaining["shards"] == 0:
+                on_end()
+        for _ in range(self.shards):
+            self.submit("inference", shard_work, _shard_done)
+
+    def run_steps(self, steps, on_end):
+        # Runs a node's pipeline steps in order
+        if not steps:
+            on_end()
+            return
+        step, rest = steps[0], steps[1:]
+        next_step = lambda: self.run_steps(rest, on_end)
+        if step == "model_training":
+            self.train(next_step)
+        elif step == "inference":
+            self.infer(next_step)
+        else:
+            self.run_jobs(STEP_JOBS.get(step, []), next_step)
+
+    def run_dag(self, dag, max_parallel):
+        '''
+        Simulates a whole DAG the way run_sweep schedules it
+        Args:
+            dag: nodes as built by sweep.build_dag (or a single node for one pipeline)
+            max_parallel: nodes running at the same time
+        Out: the makespan in seconds
+        '''
+        done, running = set(), set()
+        def _schedule():
+            for name, node in dag.items():
+                if name in done or name in running or len(running) >= max_parallel:
+                    continue
+                locked = node["lock"] is not None and any(dag[r]["lock"] == node["lock"] for r in running)
+                if all(dep in done for dep in node["deps"]) and not locked:
+                    running.add(name)
+                    self.run_steps(list(node["steps"]), lambda name=name: _finish(name))
+        def _finish(name):
+            running.discard(name)
+            done.add(name)
+            _schedule()
+        _schedule()
+        return self.run()
+
+# endregion
+
+# region ### COMPARISON ###
+
+def pipeline_dag(steps):
+    # A single pipeline run as a one-node DAG
+    return {"pipeline": {"deps": [], "lock": None, "steps": steps}}
+
+def simulate(dag, profiles, distributions, limits, configurations, runs=RUNS, max_parallel=1, seed=0):
+    '''
+    Runs the simulation many times for each configuration. Run i of every configuration draws from the same random stream, so differences between configurations come from the configurations rather than from luck
+    Args:
+        dag: the nodes to simulate (pipeline_dag or sweep.build_dag)
+        profiles: resource profiles as returned by load_profiles
+        distributions: as returned by learn_distributions
+        limits: GPU governor caps as returned by load_limits
+        configurations: list of {"layout", "shards", "gating"} dictionaries
+        runs: repetitions per configuration
+        max_parallel: DAG nodes running at the same time (the sweep's --max_parallel)
+        seed: random seed
+    Out: list of (configuration, {"makespan", "gpu_hours", "wait_hours"} arrays in hours)
+    '''
+    results = []
+    for configuration in configurations:
+        makespans, gpu_hours, wait_hours = [], [], []
+        for run in range(runs):
+            simulation = PipelineSimulation(profiles, distributions, limits, np.random.default_rng([seed, run]), **configuration)
+            makespans.append(simulation.run_dag(dag, max_parallel) / 3600)
+            gpu_hours.append(simulation.gpu_seconds / 3600)
+            wait_hours.append(simulation.wait_seconds / 3600)
+        results.append((configuration, {"makespan": np.array(makespans), "gpu_hours": np.array(gpu_hours), "wait_hours": np.array(wait_hours)}))
+    return results
+
+def print_results(results):
+    # Prints the expected makespan (mean, median, 90th percentile) and GPU hours of each configuration, fastest first
+    print(f"{'layout':8} {'shards':>6} {'gating':>6}   {'makespan h (mean / p50 / p90)':>30}   {'GPU h':>7}   {'queued h':>8}")
+    for configuration, result in sorted(results, key=lambda r: r[1]["makespan"].mean()):
+        makespan = result["makespan"]
+        print(f"{configuration['layout']:8} {configuration['shards']:>6} {'yes' if configuration['gating'] else 'no':>6}   "
+              f"{makespan.mean():10.1f} / {np.percentile(makespan, 50):6.1f} / {np.percentile(makespan, 90):6.1f}   "
+              f"{result['gpu_hours'].mean():7.1f}   {result['wait_hours'].mean():8.1f}")
+
+# endregion
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Predicts the makespan and GPU hours of V2 pipeline runs from past sacct records, without submitting anything")
+    parser.add_argument('--sweep', default=None) # simulate a sweep definition (JSON) instead of a single pipeline
+    parser.add_argument('--steps', nargs='+', default=PIPELINE_STEPS, choices=PIPELINE_STEPS) # steps of the single pipeline to simulate
+    parser.add_argument('--layouts', nargs='+', default=["spread", "packed"], choices=["spread", "packed"]) # fold layouts to compare
+    parser.add_argument('--shards', nargs='+', type=int, default=[1]) # inference shard counts to compare
+    parser.add_argument('--no_gating', action='store_true') # the shared preprocessing artifacts already exist, so all folds are submitted at once
+    parser.add_argument('--max_parallel', type=int, default=4) # sweep nodes running at the same time
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fetch_since', default=None) # first download job records since this date (e.g. 2026-01-01) from sacct
+    parser.add_argument('--history', default=None) # job records to learn from (logs/sacct_history.csv by default)
+    args = parser.parse_args()
+
+    script_dir = Path(__file__).resolve().parent
+    history_path = Path(args.history) if args.history else script_dir / "logs" / HISTORY_FILE
+    if args.fetch_since:
+        print(f"{fetch_history(history_path, args.fetch_since)} job record(s) in {history_path}")
+    distributions = learn_distributions(load_history(history_path))
+    print_distributions(distributions)
+    missing = [step for step in FALLBACK_RUN if len(distributions["run"].get(step, [])) < MIN_SAMPLES]
+    if missing:
+        print(f"Too few records for {', '.join(missing)}, using the fallback run times in pipeline_simulator.py")
+
+    profiles = load_profiles(script_dir / PRESETS_DIR)
+    limits = load_limits(script_dir / LIMITS_FILE)
+    if args.sweep:
+        sweep = load_sweep(args.sweep, script_dir)
+        dag = build_dag(sweep, expand_variants(sweep))
+    else:
+        dag = pipeline_dag(args.steps)
+    configurations = [{"layout": layout, "shards": shards, "gating": not args.no_gating} for layout in args.layouts for shards in args.shards]
+    print(f"--- {len(dag)} node(s), {args.runs} simulated run(s) per configuration ---")
+    print_results(simulate(dag, profiles, distributions, limits, configurations, args.runs, args.max_parallel, args.seed))
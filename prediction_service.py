@@ -0,0 +1,309 @@
+import argparse
+import fcntl
+import json
+import os
+import socket
+import time
+import traceback
+import uuid
+from pathlib import Path
+
+from inference_manifest import IMAGE_SUFFIX, model_fingerprint
+
+# region ### CONSTANTS ###
+SERVICE_SUFFIX = "_service" # the queue lives in <results_path>/<Dataset>_service, next to the _infer and _results folders
+REQUESTS_DIR = "requests" # one JSON file per case waiting to be predicted, written by clients
+CLAIMED_DIR = "claimed" # requests the worker has taken (moved here with an atomic rename)
+DONE_DIR = "done" # one JSON file per finished request with its status, read (and removed) by the client that sent it
+HEARTBEAT_FILE = "worker.json" # the worker's model, device and last heartbeat
+LOCK_FILE = "worker.lock" # held by the worker for as long as it runs, so only one worker serves a queue
+STOP_FILE = "stop" # created to ask the worker to exit after its current batch
+JOB_FILE = "job_id.txt" # SLURM job id of the last worker the pipeline submitted, so a queued worker isn't submitted twice
+CHECKPOINT_NAME = "checkpoint_final.pth"
+MODEL_SETTINGS = "3d_fullres nnUNetTrainerNoMirroring" # same configuration as nnUNetv2_predict in infer_v2_agate.sh
+POLL_INTERVAL = 2 # seconds between queue scans (worker) and result scans (client)
+HEARTBEAT_TIMEOUT = 120 # a worker whose heartbeat is older than this is considered dead
+IDLE_TIMEOUT = 1800 # the worker exits after this many seconds without requests
+MAX_BATCH = 16 # requests predicted in one call, so one large submission doesn't hold up the heartbeat for too long
+# endregion
+
+# region ### QUEUE ###
+
+def get_service_dir(results_path, dataset_folder):
+    # The prediction service's queue folder for a dataset
+    return Path(results_path) / f"{dataset_folder}{SERVICE_SUFFIX}"
+
+def model_settings(folds):
+    # Settings string of the ensembled model, identical to the one the pipeline fingerprints its inference model with
+    return f"{MODEL_SETTINGS} folds={list(folds)}"
+
+def write_json(path: Path, data):
+    # Writes a JSON file atomically, so the other side of the queue never reads half a file
+    tmp_path = Path(path).with_name(f".{Path(path).name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    tmp_path.replace(path)
+
+def read_json(path: Path):
+    # Reads a JSON file of the queue, None if it is gone (e.g. another process just moved it)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def init_queue(service_dir: Path):
+    # Creates the queue folders
+    for name in (REQUESTS_DIR, CLAIMED_DIR, DONE_DIR):
+        (Path(service_dir) / name).mkdir(parents=True, exist_ok=True)
+
+# endregion
+
+# region ### CLIENT ###
+
+def service_status(service_dir: Path, model=None):
+    '''
+    Checks whether a worker is serving the queue
+    Args:
+        service_dir: the service's queue folder
+        model: the model fingerprint the caller needs (see inference_manifest.model_fingerprint), None to accept any model
+    Out: the worker's heartbeat if it is alive (and serves that model), else None
+    '''
+    heartbeat = read_json(Path(service_dir) / HEARTBEAT_FILE)
+    if heartbeat is None or time.time() - heartbeat["heartbeat"] > HEARTBEAT_TIMEOUT:
+        return None
+    if model is not None and heartbeat["model"] != model:
+        return None
+    return heartbeat
+
+def wait_for_service(service_dir: Path, model=None, timeout=IDLE_TIMEOUT, is_starting=None):
+    # Waits until a worker serving the model is up, giving up after timeout seconds or once is_starting() says its job is gone; returns its heartbeat or None
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        heartbeat = service_status(service_dir, model)
+        if heartbeat is not None:
+            return heartbeat
+        if is_starting is not None and not is_starting():
+            return None
+        time.sleep(POLL_INTERVAL)
+    return None
+
+def submit_cases(service_dir: Path, cases, images_dir: Path, output_dir: Path):
+    '''
+    Queues test cases for the worker
+    Args:
+        service_dir: the service's queue folder
+        cases: dictionary of case -> list of its channel file names (in channel order)
+        images_dir: the folder holding the channel files
+        output_dir: the folder the predictions are written to (as <case>.nii.gz)
+    Out: dictionary of request id -> case
+    '''
+    init_queue(service_dir)
+    requests = {}
+    for case, files in cases.items():
+        request_id = f"{case}-{uuid.uuid4().hex[:8]}"
+        write_json(Path(service_dir) / REQUESTS_DIR / f"{request_id}.json", {
+            "id": request_id,
+            "inputs": [str((Path(images_dir) / name).resolve()) for name in files],
+            "output": str(Path(output_dir) / f"{case}{IMAGE_SUFFIX}"),
+            "submitted": time.time()
+        })
+        requests[request_id] = case
+    return requests
+
+def wait_for_results(service_dir: Path, request_ids, model=None):
+    '''
+    Waits for the worker to finish a set of requests. Requests that are still waiting when the worker dies (or stops serving the model) are taken back out of the queue
+    Args:
+        service_dir: the service's queue folder
+        request_ids: the ids returned by submit_cases
+        model: the model fingerprint the requests were submitted for
+    Out: dictionary of request id -> result ({"status": "ok"/"failed", ...}); requests that never finished are missing
+    '''
+    service_dir = Path(service_dir)
+    results = {}
+    waiting = set(request_ids)
+    while waiting:
+        for request_id in list(waiting):
+            done_path = service_dir / DONE_DIR / f"{request_id}.json"
+            result = read_json(done_path)
+            if result is not None:
+                results[request_id] = result
+                done_path.unlink(missing_ok=True)
+                waiting.discard(request_id)
+        if waiting and service_status(service_dir, model) is None:
+            for request_id in waiting:
+                for folder in (REQUESTS_DIR, CLAIMED_DIR):
+                    (service_dir / folder / f"{request_id}.json").unlink(missing_ok=True)
+            print(f"WARNING: The prediction service stopped with {len(waiting)} request(s) unfinished")
+            break
+        if waiting:
+            time.sleep(POLL_INTERVAL)
+    return results
+
+def record_service_job(service_dir: Path, job_id):
+    # Remembers the SLURM job id of a submitted worker
+    Path(service_dir).mkdir(parents=True, exist_ok=True)
+    (Path(service_dir) / JOB_FILE).write_text(str(job_id))
+
+def get_service_job(service_dir: Path):
+    # SLURM job id of the last submitted worker, None if there is none
+    job_path = Path(service_dir) / JOB_FILE
+    if not job_path.exists():
+        return None
+    return job_path.read_text().strip() or None
+
+def stop_service(service_dir: Path):
+    # Asks the worker to exit once its current batch is done
+    Path(service_dir).mkdir(parents=True, exist_ok=True)
+    (Path(service_dir) / STOP_FILE).touch()
+
+# endregion
+
+# region ### WORKER ###
+
+def load_predictor(model_dir: Path, folds, device):
+    '''
+    Loads the trained model once with nnUNet's predictor (same settings as nnUNetv2_predict)
+    Args:
+        model_dir: the trainer folder in nnUNet_results, e.g. .../Dataset700_X/nnUNetTrainerNoMirroring__nnUNetPlans__3d_fullres
+        folds: the folds to ensemble
+        device: "cuda" or "cpu"
+    Out: function predicting a batch: (list of lists of input files, list of output files) -> None
+    '''
+    import torch
+    from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+
+    if device == "cpu":
+        torch.set_num_threads(os.cpu_count() or 1)
+    predictor = nnUNetPredictor(tile_step_size=0.5, use_gaussian=True, use_mirroring=True, device=torch.device(device))
+    predictor.initialize_from_trained_model_folder(str(model_dir), use_folds=tuple(folds), checkpoint_name=CHECKPOINT_NAME)
+    workers = max(1, min(3, (os.cpu_count() or 1) // 2))
+
+    def predict(inputs, outputs):
+        # nnUNet takes the output file names without their extension
+        predictor.predict_from_files([list(i) for i in inputs], [o[:-len(IMAGE_SUFFIX)] for o in outputs], save_probabilities=False,
+                                     overwrite=True, num_processes_preprocessing=workers, num_processes_segmentation_export=workers)
+    return predict
+
+def requeue_claimed(service_dir: Path):
+    # Puts requests a previous worker had claimed but not finished back into the queue
+    for claimed in (Path(service_dir) / CLAIMED_DIR).glob("*.json"):
+        claimed.rename(Path(service_dir) / REQUESTS_DIR / claimed.name)
+
+def claim_requests(service_dir: Path, limit=MAX_BATCH):
+    # Takes up to limit waiting requests, oldest first, returns their contents
+    service_dir = Path(service_dir)
+    waiting = sorted((p for p in (service_dir / REQUESTS_DIR).glob("*.json")), key=lambda p: p.stat().st_mtime)
+    claimed = []
+    for request_path in waiting[:limit]:
+        target = service_dir / CLAIMED_DIR / request_path.name
+        try:
+            request_path.rename(target)
+        except FileNotFoundError: # the client took it back
+            continue
+        request = read_json(target)
+        if request is not None:
+            claimed.append(request)
+    return claimed
+
+def finish_request(service_dir: Path, request, status, started, error=None):
+    # Publishes a request's result and removes its claim
+    write_json(Path(service_dir) / DONE_DIR / f"{request['id']}.json", {
+        "id": request["id"], "status": status, "output": request["output"], "error": error,
+        "seconds": round(time.time() - started, 2), "queued_seconds": round(started - request["submitted"], 2)
+    })
+    (Path(service_dir) / CLAIMED_DIR / f"{request['id']}.json").unlink(missing_ok=True)
+
+def predict_batch(service_dir: Path, predict, requests):
+    # Predicts a batch in one call; if that fails each request is retried on its own so one bad case doesn't fail the others
+    started = time.time()
+    try:
+        predict([r["inputs"] for r in requests], [r["output"] for r in requests])
+        for request in requests:
+            status = "ok" if Path(request["output"]).exists() else "failed"
+            finish_request(service_dir, request, status, started, None if status == "ok" else "no prediction was written")
+        return
+    except Exception:
+        if len(requests) == 1:
+            finish_request(service_dir, requests[0], "failed", started, traceback.format_exc(limit=3))
+            return
+    for request in requests:
+        predict_batch(service_dir, predict, [request])
+
+def serve(service_dir: Path, model_dir: Path, folds, device="cuda", idle_timeout=IDLE_TIMEOUT, predict=None):
+    '''
+    Runs the prediction worker: loads the model once, then predicts the cases clients put in the queue until it has been idle for idle_timeout seconds, is asked to stop, or the checkpoints on disk change (e.g. after retraining)
+    Args:
+        service_dir: the service's queue folder
+        model_dir: the trainer folder in nnUNet_results
+        folds: the folds to ensemble
+        device: "cuda" or "cpu"
+        idle_timeout: seconds without requests before the worker exits
+        predict: batch prediction function to use instead of loading the model with nnUNet (see load_predictor)
+    Out: number of requests served, None if another worker already serves this queue
+    '''
+    service_dir = Path(service_dir)
+    init_queue(service_dir)
+    with open(service_dir / LOCK_FILE, "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not (service_dir / STOP_FILE).exists():
+                print(f"Another worker is already serving {service_dir}")
+                return None
+            print("Waiting for the previous worker to stop...")
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        (service_dir / STOP_FILE).unlink(missing_ok=True)
+        requeue_claimed(service_dir)
+
+        checkpoints = [Path(model_dir) / f"fold_{fold}" / CHECKPOINT_NAME for fold in folds]
+        model = model_fingerprint(checkpoints, model_settings(folds))
+        loading = time.time()
+        if predict is None:
+            predict = load_predictor(model_dir, folds, device)
+        print(f"Loaded folds {list(folds)} of {model_dir} on {device} in {time.time() - loading:.1f}s, serving {service_dir}")
+
+        heartbeat = {"pid": os.getpid(), "host": socket.gethostname(), "job_id": os.environ.get("SLURM_JOB_ID"), "device": device,
+                     "model_dir": str(model_dir), "folds": list(folds), "model": model, "started": time.time(), "served": 0}
+        last_request = time.time()
+        try:
+            while True:
+                heartbeat["heartbeat"] = time.time()
+                write_json(service_dir / HEARTBEAT_FILE, heartbeat)
+                if (service_dir / STOP_FILE).exists():
+                    print("Stop requested")
+                    break
+                if model_fingerprint(checkpoints, model_settings(folds)) != model:
+                    print("The checkpoints changed on disk, exiting so a worker with the new model can take over")
+                    break
+                requests = claim_requests(service_dir)
+                if requests:
+                    predict_batch(service_dir, predict, requests)
+                    heartbeat["served"] += len(requests)
+                    print(f"Predicted {len(requests)} case(s), {heartbeat['served']} in total")
+                    last_request = time.time()
+                    continue
+                if time.time() - last_request > idle_timeout:
+                    print(f"Idle for {idle_timeout}s, exiting")
+                    break
+                time.sleep(POLL_INTERVAL)
+        finally:
+            (service_dir / HEARTBEAT_FILE).unlink(missing_ok=True)
+            requeue_claimed(service_dir)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return heartbeat["served"]
+
+# endregion
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Warm nnUNet v2 prediction worker that serves a file-based queue")
+    parser.add_argument('model_dir') # the trainer folder in nnUNet_results
+    parser.add_argument('service_dir') # the queue folder, <results_path>/<Dataset>_service
+    parser.add_argument('--folds', type=int, nargs='+', default=[0, 1, 2, 3, 4])
+    parser.add_argument('--device', default='cuda', choices=['cuda', 'cpu'])
+    parser.add_argument('--idle_timeout', type=float, default=IDLE_TIMEOUT)
+    args = parser.parse_args()
+
+    if serve(args.service_dir, args.model_dir, args.folds, args.device, args.idle_timeout) is None:
+        exit(1)
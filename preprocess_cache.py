@@ -0,0 +1,166 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# region ### CONSTANTS ###
+CACHE_DIR = "preprocessed_cache" # next to nnUNet_raw/nnUNet_preprocessed, so every task on the same project storage shares it
+ENTRY_FILE = "cache_entry.json" # per entry: key, dataset it was made from, size, last use
+LOCK_FILE = "cache.lock"
+CACHE_LIMIT_GB = 2000 # entries are evicted, least recently used first, once the cache holds more than this
+PLANS_FILE = "nnUNetPlans.json"
+# Files that belong to a task rather than to its preprocessed data: dataset.json is copied from the task, the splits are written for each task by create_splits
+TASK_FILES = ("dataset.json", "splits_final.json")
+# endregion
+
+# region ### CACHE KEY ###
+
+def preprocess_key(index, dataset_json_path: Path, config):
+    '''
+    Hash of everything plan and preprocess reads: the training images and labels (by content, from the dataset index), dataset.json (without its name) and the nnUNet configuration (the plan and preprocess commands and the nnUNet install they run)
+    Args:
+        index: the task's dataset index (see dataset_preflight.scan_task), with a sha256 per training file (see dataset_preflight.hash_files)
+        dataset_json_path: the task's dataset.json
+        config: dictionary describing the nnUNet configuration
+    Out: hex digest identifying the preprocessed output
+    '''
+    with open(dataset_json_path) as f:
+        dataset = {k: v for k, v in json.load(f).items() if k != "name"}
+    files = sorted((relative, entry["sha256"]) for relative, entry in index["files"].items() if relative.split("/", 1)[0] in ("imagesTr", "labelsTr"))
+    contents = json.dumps({"files": files, "dataset": dataset, "config": config}, sort_keys=True)
+    return hashlib.sha256(contents.encode()).hexdigest()
+
+# endregion
+
+# region ### CACHE ###
+
+def get_cache_dir(raw_data_base_path):
+    # The shared cache folder on the project storage
+    return Path(raw_data_base_path) / CACHE_DIR
+
+@contextmanager
+def cache_lock(cache_dir: Path):
+    # Holds an exclusive lock on the cache so pipelines don't evict an entry another one is linking from
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with open(cache_dir / LOCK_FILE, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def link_tree(src: Path, dst: Path, skip=()):
+    # Recreates a folder tree with hard links to the files (copies where the two folders are on different file systems), returns the total size in bytes
+    size = 0
+    for root, _, files in os.walk(src):
+        relative = Path(root).relative_to(src)
+        (Path(dst) / relative).mkdir(parents=True, exist_ok=True)
+        for name in files:
+            if relative == Path(".") and name in skip:
+                continue
+            source, target = Path(root) / name, Path(dst) / relative / name
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copy2(source, target)
+            size += source.stat().st_size
+    return size
+
+def read_entry(entry_dir: Path):
+    # Reads a cache entry's description, None if the entry is incomplete
+    entry_path = Path(entry_dir) / ENTRY_FILE
+    if not entry_path.exists():
+        return None
+    with open(entry_path) as f:
+        return json.load(f)
+
+def write_entry(entry_dir: Path, entry):
+    # Writes a cache entry's description atomically
+    entry_path = Path(entry_dir) / ENTRY_FILE
+    tmp_path = entry_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(entry, f, indent=2)
+    tmp_path.replace(entry_path)
+
+def restore(cache_dir: Path, key, preprocessed_dir: Path, dataset_folder, dataset_json_path: Path):
+    '''
+    Links a cached preprocessed tree into place for a task, if the cache has one for its key. The plans are copied with the task's dataset name (nnUNet uses it for the results folder) and dataset.json is copied from the task
+    Args:
+        cache_dir: the shared cache folder
+        key: the task's preprocess key
+        preprocessed_dir: the task's folder in nnUNet_preprocessed (replaced if it exists)
+        dataset_folder: the task's dataset folder name, e.g. Dataset700_AnomalousInfant
+        dataset_json_path: the task's dataset.json
+    Out: the cache entry's description, None if the key isn't cached
+    '''
+    entry_dir = Path(cache_dir) / key
+    with cache_lock(cache_dir):
+        entry = read_entry(entry_dir)
+        if entry is None:
+            return None
+        preprocessed_dir = Path(preprocessed_dir)
+        if preprocessed_dir.exists():
+            shutil.rmtree(preprocessed_dir)
+        link_tree(entry_dir, preprocessed_dir, skip=(ENTRY_FILE, PLANS_FILE))
+        with open(entry_dir / PLANS_FILE) as f:
+            plans = json.load(f)
+        plans["dataset_name"] = dataset_folder
+        with open(preprocessed_dir / PLANS_FILE, "w") as f:
+            json.dump(plans, f, indent=4)
+        shutil.copy2(dataset_json_path, preprocessed_dir / "dataset.json")
+        entry["last_used"] = round(time.time())
+        entry["uses"] = entry.get("uses", 0) + 1
+        write_entry(entry_dir, entry)
+    return entry
+
+def store(cache_dir: Path, key, preprocessed_dir: Path, dataset_folder, limit_gb=CACHE_LIMIT_GB):
+    '''
+    Adds a freshly preprocessed tree to the cache (as hard links, so it takes no extra space while the task keeps its copy), then evicts old entries beyond the size limit
+    Args:
+        cache_dir: the shared cache folder
+        key: the task's preprocess key
+        preprocessed_dir: the task's folder in nnUNet_preprocessed
+        dataset_folder: the task's dataset folder name, recorded in the entry
+        limit_gb: size limit of the cache
+    Out: list of evicted keys
+    '''
+    entry_dir = Path(cache_dir) / key
+    tmp_dir = Path(cache_dir) / f".{key}.tmp"
+    with cache_lock(cache_dir):
+        if read_entry(entry_dir) is None:
+            for leftover in (tmp_dir, entry_dir):
+                if leftover.exists():
+                    shutil.rmtree(leftover)
+            size = link_tree(preprocessed_dir, tmp_dir, skip=TASK_FILES)
+            write_entry(tmp_dir, {"key": key, "dataset": dataset_folder, "size": size, "created": round(time.time()),
+                                  "last_used": round(time.time()), "uses": 0})
+            tmp_dir.rename(entry_dir)
+        return evict(cache_dir, limit_gb, keep=key)
+
+def list_entries(cache_dir: Path):
+    # Complete cache entries, least recently used first
+    cache_dir = Path(cache_dir)
+    entries = [read_entry(p) for p in cache_dir.iterdir() if p.is_dir() and not p.name.startswith(".")] if cache_dir.exists() else []
+    return sorted((e for e in entries if e is not None), key=lambda e: e["last_used"])
+
+def evict(cache_dir: Path, limit_gb=CACHE_LIMIT_GB, keep=None):
+    # Removes the least recently used entries until the cache is within its size limit (never the entry just used), call with the cache lock held
+    entries = list_entries(cache_dir)
+    total = sum(e["size"] for e in entries)
+    evicted = []
+    for entry in entries:
+        if total <= limit_gb * 1e9:
+            break
+        if entry["key"] == keep:
+            continue
+        shutil.rmtree(Path(cache_dir) / entry["key"])
+        total -= entry["size"]
+        evicted.append(entry["key"])
+    return evicted
+
+# endregion
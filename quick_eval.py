@@ -0,0 +1,116 @@
+import csv
+import os
+from pathlib import Path
+
+# region ### CONSTANTS ###
+QUICK_EVAL_FILE = "quick_eval.csv" # appended to by the quick evaluation jobs in the task log folder
+FIELDS = ["fold", "job_id", "checkpoint", "epoch", "cases", "dice"]
+IMAGE_SUFFIX = ".nii.gz"
+# endregion
+
+# region ### TEST SUBSET ###
+
+def select_subset(images_dir: Path, labels_dir: Path, size):
+    '''
+    Picks a small subset of the labelled test cases, stratified by image size (sorted by the size of the first channel's file and sampled evenly across it) so small and large heads are both represented
+    Args:
+        images_dir: the imagesTs folder (files named <case>_0000.nii.gz, ...)
+        labels_dir: the labelsTs folder (files named <case>.nii.gz)
+        size: number of cases to pick
+    Out: sorted list of case identifiers
+    '''
+    cases = []
+    for label in Path(labels_dir).glob("*" + IMAGE_SUFFIX):
+        case = label.name[:-len(IMAGE_SUFFIX)]
+        image = Path(images_dir) / f"{case}_0000{IMAGE_SUFFIX}"
+        if image.exists():
+            cases.append((image.stat().st_size, case))
+    cases.sort()
+    if len(cases) <= size:
+        return sorted(case for _, case in cases)
+    step = (len(cases) - 1) / (size - 1) if size > 1 else 0
+    return sorted({cases[round(i * step)][1] for i in range(size)})
+
+def build_subset(subset_dir: Path, images_dir: Path, labels_dir: Path, cases):
+    '''
+    Creates (or refreshes) a folder with imagesTs/ and labelsTs/ that link to the selected cases, so the quick evaluation can run on it like on a full test set
+    Args:
+        subset_dir: where to create the subset
+        images_dir: the full imagesTs folder
+        labels_dir: the full labelsTs folder
+        cases: the case identifiers to include
+    Out: path to the subset folder
+    '''
+    subset_dir = Path(subset_dir)
+    for name in ("imagesTs", "labelsTs"):
+        folder = subset_dir / name
+        folder.mkdir(parents=True, exist_ok=True)
+        for link in folder.iterdir():
+            link.unlink()
+    for case in cases:
+        for image in Path(images_dir).glob(f"{case}_[0-9][0-9][0-9][0-9]{IMAGE_SUFFIX}"):
+            os.symlink(image.resolve(), subset_dir / "imagesTs" / image.name)
+        os.symlink((Path(labels_dir) / f"{case}{IMAGE_SUFFIX}").resolve(), subset_dir / "labelsTs" / f"{case}{IMAGE_SUFFIX}")
+    return subset_dir
+
+# endregion
+
+# region ### RESULTS ###
+
+def init_quick_eval(logs_path: Path):
+    # Creates the quick evaluation results file (with its header) in the task log folder if it doesn't exist yet
+    results_path = Path(logs_path) / QUICK_EVAL_FILE
+    if not results_path.exists():
+        with open(results_path, "w", newline="") as f:
+            csv.writer(f).writerow(FIELDS)
+    return results_path
+
+def load_quick_evals(logs_path: Path, fold=None):
+    # Reads the quick evaluation results, ordered by epoch, optionally for one fold only
+    results_path = Path(logs_path) / QUICK_EVAL_FILE
+    if not results_path.exists():
+        return []
+    rows = []
+    with open(results_path, newline="") as f:
+        for row in csv.DictReader(f):
+            try:
+                rows.append({**row, "fold": int(row["fold"]), "epoch": int(row["epoch"]), "dice": float(row["dice"])})
+            except (TypeError, ValueError):
+                continue
+    return sorted((r for r in rows if fold is None or r["fold"] == fold), key=lambda r: r["epoch"])
+
+def dice_trend(rows):
+    # Least-squares slope of the quick evaluation Dice, per 100 epochs (None with fewer than two evaluations)
+    if len(rows) < 2:
+        return None
+    epochs = [r["epoch"] for r in rows]
+    dices = [r["dice"] for r in rows]
+    mean_epoch, mean_dice = sum(epochs) / len(epochs), sum(dices) / len(dices)
+    spread = sum((e - mean_epoch) ** 2 for e in epochs)
+    if spread == 0:
+        return None
+    return 100 * sum((e - mean_epoch) * (d - mean_dice) for e, d in zip(epochs, dices)) / spread
+
+def print_quick_eval_trend(logs_path: Path, folds):
+    '''
+    Prints each fold's quick evaluation Dice history and trend, flagging folds that stopped improving
+    Args:
+        logs_path: the task log folder
+        folds: the fold numbers to report
+    Out: list of folds whose Dice is not improving (at least three evaluations and a flat or falling trend)
+    '''
+    not_improving = []
+    for fold in folds:
+        rows = load_quick_evals(logs_path, fold)
+        if not rows:
+            continue
+        history = " -> ".join(f"{r['dice']:.3f} (ep {r['epoch']})" for r in rows[-4:])
+        trend = dice_trend(rows)
+        trend_text = f", trend {trend:+.3f} per 100 epochs" if trend is not None else ""
+        print(f"Fold {fold} quick-eval Dice: {history}{trend_text}")
+        if len(rows) >= 3 and trend is not None and trend <= 0:
+            not_improving.append(fold)
+            print(f"WARNING: Fold {fold} quick-eval Dice is not improving, consider stopping this configuration")
+    return not_improving
+
+# endregion
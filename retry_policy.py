@@ -0,0 +1,127 @@
+import re
+import subprocess
+import time
+
+# region ### CONSTANTS ###
+# Order matters: when the job and its steps report different states, the first match wins (e.g. an OOM-killed batch step inside a FAILED job)
+END_STATES = ["OUT_OF_MEMORY", "NODE_FAIL", "PREEMPTED", "TIMEOUT", "FAILED", "CANCELLED", "COMPLETED"]
+ACTIVE_STATES = ["PENDING", "RUNNING", "REQUEUED", "COMPLETING", "CONFIGURING", "SUSPENDED", "RESIZING"]
+
+# What to do for each way a job can end. budget = max retries for that end state, resume = resubmit with the continue flag,
+# mem_factor = multiply the requested memory, exclude_node = keep the retry off the node(s) the job ran on
+DEFAULT_RULES = {
+    "TIMEOUT":       {"budget": 20, "resume": True},
+    "PREEMPTED":     {"budget": 5,  "resume": True},
+    "NODE_FAIL":     {"budget": 3,  "resume": True, "exclude_node": True},
+    "OUT_OF_MEMORY": {"budget": 3,  "resume": True, "mem_factor": 1.5},
+    "FAILED":        {"budget": 2,  "resume": True},
+    "STALLED":       {"budget": 3,  "resume": True, "exclude_node": True}, # cancelled by the watchdog after making no progress
+}
+BACKOFF_BASE = 60   # seconds before the first retry of an end state, doubled for every further retry
+BACKOFF_MAX = 1800
+# endregion
+
+# region ### JOB STATE ###
+
+def parse_state(raw_state):
+    # sacct reports e.g. "CANCELLED by 12345" or "OUT_OF_ME+" in narrow columns; normalize to one of END_STATES / ACTIVE_STATES
+    raw_state = raw_state.strip().split()[0].rstrip("+") if raw_state.strip() else ""
+    for state in END_STATES + ACTIVE_STATES:
+        if state.startswith(raw_state) and raw_state:
+            return state
+    return raw_state
+
+def expand_nodelist(nodelist):
+    # Expands a SLURM nodelist such as "agt[01-02,05]" into individual node names using scontrol
+    if not nodelist or nodelist in ("None assigned", "(null)"):
+        return []
+    result = subprocess.run(["scontrol", "show", "hostnames", nodelist], capture_output=True, text=True)
+    return result.stdout.split() or [nodelist]
+
+def get_job_end_state(job_id, attempts=5, interval=10):
+    '''
+    Classifies how a SLURM job ended using sacct, looking at the job and all of its steps
+    Args:
+        job_id: the SLURM job id
+        attempts: how many times to ask sacct before giving up (accounting can lag a few seconds behind squeue)
+        interval: seconds between attempts
+    Out: dictionary with "state" (one of END_STATES) and "nodes" (list of nodes the job ran on), or None if the end state is unknown
+    '''
+    if not job_id:
+        return None
+    for _ in range(attempts):
+        result = subprocess.run(["sacct", "-j", str(job_id), "-n", "-P", "-o", "JobID,State,NodeList"], capture_output=True, text=True)
+        rows = [line.split("|") for line in result.stdout.strip().splitlines() if line.count("|") == 2]
+        states = [parse_state(state) for _, state, _ in rows]
+        if states and not any(state in ACTIVE_STATES for state in states):
+            for state in END_STATES:
+                if state in states:
+                    nodes = next((nodelist for _, _, nodelist in rows if nodelist), "")
+                    return {"state": state, "nodes": expand_nodelist(nodes)}
+        time.sleep(interval)
+    return None
+
+# endregion
+
+# region ### RETRY POLICY ###
+
+def scale_memory(value, factor):
+    # Scales a SLURM memory string such as "90g" or "32GB", keeping its unit (rounded up to a whole number)
+    match = re.match(r"^(\d+(?:\.\d+)?)([A-Za-z]*)$", str(value).strip())
+    if not match:
+        return value
+    return f"{int(-(-float(match.group(1)) * factor // 1))}{match.group(2)}"
+
+class RetryPolicy:
+    '''
+    Decides whether and how to resubmit a job that ended without completing, with separate retry budgets per job and end state and exponential backoff.
+    Resource changes (more memory after OUT_OF_MEMORY, excluded nodes after NODE_FAIL) accumulate per job key and are exposed as profile overrides for the next submission.
+    '''
+
+    def __init__(self, rules=None, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX):
+        self.rules = rules or DEFAULT_RULES
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.attempts = {}
+        self.overrides = {}
+
+    def overrides_for(self, key):
+        # Resource profile overrides to apply to the next submission of this job
+        return dict(self.overrides.get(key, {}))
+
+    def next_action(self, key, end_state, profile):
+        '''
+        Works out the retry for a job that ended without completing
+        Args:
+            key: identifies the logical job across resubmissions, e.g. "fold_3" or a script name
+            end_state: the result of get_job_end_state
+            profile: the step's resource profile (before any overrides), used to scale memory
+        Out: dictionary with "resume" (use the continue flag), "delay" (seconds to wait before resubmitting) and "overrides" (profile overrides), or None if the job should not be retried
+        '''
+        state = end_state["state"]
+        rule = self.rules.get(state)
+        if rule is None:
+            print(f"{key} ended with state {state}, which is not retried")
+            return None
+
+        attempt = self.attempts.get((key, state), 0) + 1
+        if attempt > rule["budget"]:
+            print(f"{key} ended with state {state} and has used all {rule['budget']} retries for it")
+            return None
+        self.attempts[(key, state)] = attempt
+
+        overrides = self.overrides.setdefault(key, {})
+        if rule.get("mem_factor"):
+            for field in ("mem", "mem_per_cpu"):
+                current = overrides.get(field, profile.get(field))
+                if current:
+                    overrides[field] = scale_memory(current, rule["mem_factor"])
+        if rule.get("exclude_node") and end_state["nodes"]:
+            overrides["exclude"] = sorted(set(overrides.get("exclude", [])) | set(end_state["nodes"]))
+
+        delay = min(self.backoff_base * 2 ** (attempt - 1), self.backoff_max)
+        changes = ", ".join(f"{k}={v}" for k, v in overrides.items()) or "same resources"
+        print(f"{key} ended with state {state}: retry {attempt}/{rule['budget']} in {delay}s ({changes})")
+        return {"resume": rule.get("resume", False), "delay": delay, "overrides": dict(overrides)}
+
+# endregion
@@ -2,7 +2,7 @@
 sbatch <<EOT
 #!/bin/sh
 
-#SBATCH --job-name=$2_infer 
+#SBATCH --job-name=$2_infer${7:+_$7} 
 #SBATCH --mem=256g       
 #SBATCH --time=24:00:00          # (HH:MM:SS)
 
@@ -26,5 +26,5 @@ export RESULTS_FOLDER="$4"
 
 
 
-nnUNet_predict -i $5 -o /projects/standard/faird/shared/data/nnUNet_lundq163/$2_infer/ -t $2 -tr nnUNetTrainerV2_noMirroring -m 3d_fullres --disable_tta
+nnUNet_predict -i $5 -o ${6:-/projects/standard/faird/shared/data/nnUNet_lundq163/$2_infer/} -t $2 -tr nnUNetTrainerV2_noMirroring -m 3d_fullres --disable_tta
 EOT
@@ -0,0 +1,165 @@
+import copy
+import json
+from pathlib import Path
+
+from jinja2 import Environment, FileSystemLoader, StrictUndefined
+
+# region ### CONSTANTS ###
+PROFILES_FILE = "resource_profiles.json"
+TEMPLATE_EXTENSION = ".j2"
+
+# Environment setup shared by the nnUNet v2 steps and by the SynthSeg steps
+NNUNET_V2_ENV = [
+    "module load gcc cuda/11.2",
+    "module load python3/3.12.4_anaconda2024.06-1_libmamba",
+]
+SYNTHSEG_ENV = [
+    "source /projects/standard/faird/shared/code/external/envs/miniconda3/load_miniconda3.sh",
+    "conda activate SynthSeg-fixed-perms",
+]
+
+# Default resource profile for each pipeline step. Any field can be overridden per step in <presets dir>/resource_profiles.json
+# "partitions" lists interchangeable partitions; at submission the one with the earliest estimated start (sbatch --test-only) is used
+DEFAULT_PROFILES = {
+    # The SynthSeg steps run on a copy of their inputs in node-local scratch (the --tmp space) and copy their outputs back; set "stage": false to read and write the task folder directly
+    "min_max": {
+        "partition": "msismall", "account": "faird", "time": "8:00:00",
+        "mem_per_cpu": "8GB", "cpus_per_task": 4, "tmp": "20gb",
+        "stage": True,
+        "env_setup": SYNTHSEG_ENV,
+    },
+    "SynthSeg_img": {
+        "partition": "msismall", "account": "faird", "time": "96:00:00",
+        "mem_per_cpu": "32GB", "cpus_per_task": 4, "tmp": "20gb",
+        "stage": True,
+        "env_setup": SYNTHSEG_ENV,
+    },
+    # Plan and preprocess is CPU-bound, so its three sub-steps run on CPU partitions; preprocessing gets many cores and runs one worker per core
+    "fingerprint": {
+        "partition": "msismall", "account": "faird", "time": "4:00:00",
+        "mem": "64g", "cpus_per_task": 16,
+        "env_setup": NNUNET_V2_ENV,
+    },
+    "plan": {
+        "partition": "msismall", "account": "faird", "time": "1:00:00",
+        "mem": "16g", "cpus_per_task": 2,
+        "env_setup": NNUNET_V2_ENV,
+    },
+    "preprocess": {
+        "partition": "msismall", "partitions": ["msismall", "msilarge"], "account": "faird", "time": "12:00:00",
+        "mem": "128g", "cpus_per_task": 32,
+        "env_setup": NNUNET_V2_ENV,
+    },
+    "model_training": {
+        "partition": "msigpu", "partitions": ["msigpu", "a100-4"], "account": "faird", "time": "24:00:00",
+        "mem": "90g", "gres": "gpu:a100:1", "ntasks": 6,
+        "requeue_signal_lead": 600, "max_requeues": 10, # seconds before the time limit the job checkpoints and requeues itself
+        "stall_timeout": 7200, "stall_epochs": 4, # no-progress limit before the first epoch time is known, then in epoch lengths
+        "plateau_patience": 100, "plateau_min_delta": 0.001, "plateau_min_epochs": 250, # early stopping (--early_stopping) on the EMA pseudo-Dice
+        "env_setup": NNUNET_V2_ENV,
+    },
+    # Short training runs that measure iterations/s for several augmentation worker counts; the pipeline submits one per candidate partition and CPU count
+    "da_calibration": {
+        "partition": "msigpu", "partitions": ["msigpu", "a100-4"], "account": "faird", "time": "1:00:00",
+        "mem": "90g", "gres": "gpu:a100:1", "ntasks": 6,
+        "calibration_cpus": [6, 12, 16], "calibration_iterations": 50,
+        "env_setup": NNUNET_V2_ENV,
+    },
+    # Periodic evaluation of training checkpoints on a few test cases (--quick_eval); runs on CPU by default, set "device": "cuda" plus a gres for a GPU slot
+    "quick_eval": {
+        "partition": "msismall", "account": "faird", "time": "2:00:00",
+        "mem": "32g", "cpus_per_task": 8,
+        "device": "cpu", "subset_size": 5, "interval": 21600, # seconds between rounds of evaluations
+        "env_setup": NNUNET_V2_ENV,
+    },
+    # Several folds in one job on a 4-GPU node, one GPU per fold. mem/gres/ntasks are for a full job and are scaled down when fewer folds are packed
+    "model_training_packed": {
+        "partition": "a100-4", "account": "faird", "time": "24:00:00", "nodes": 1,
+        "mem": "360g", "gres": "gpu:a100:4", "ntasks": 24,
+        "folds_per_job": 4, "mem_per_fold": "90g", "ntasks_per_fold": 6, "gpu_type": "a100",
+        "requeue_signal_lead": 600, "max_requeues": 10,
+        "stall_timeout": 7200, "stall_epochs": 4,
+        "env_setup": NNUNET_V2_ENV,
+    },
+    "inference": {
+        "partition": "a100-4", "partitions": ["a100-4", "msigpu"], "account": "faird", "time": "8:00:00",
+        "mem": "64g", "gres": "gpu:a100:1", "ntasks": 1,
+        "stall_timeout": 3600,
+        "env_setup": NNUNET_V2_ENV,
+    },
+    # Long-lived worker that keeps the trained model loaded and predicts queued test cases (--prediction_service); set "device": "cpu" and drop the gres to run it on a CPU partition
+    "prediction_service": {
+        "partition": "a100-4", "partitions": ["a100-4", "msigpu"], "account": "faird", "time": "24:00:00",
+        "mem": "64g", "gres": "gpu:a100:1", "ntasks": 4,
+        "device": "cuda", "idle_timeout": 1800, # seconds without requests before the worker exits and frees its GPU
+        "start_timeout": 3600, # seconds the pipeline waits for the worker to come up before submitting a normal inference job instead
+        "env_setup": NNUNET_V2_ENV,
+    },
+}
+# endregion
+
+# region ### PROFILES ###
+
+def load_profiles(presets_dir: Path):
+    '''
+    Loads the per-step resource profiles, starting from the defaults and applying any overrides saved next to the presets
+    Args:
+        presets_dir: the presets folder for the pipeline version (e.g. automation_presets_v2), which may contain a resource_profiles.json
+    Out: dictionary mapping step name (e.g. "model_training") to its resource profile
+    '''
+    profiles = copy.deepcopy(DEFAULT_PROFILES)
+    overrides_path = Path(presets_dir) / PROFILES_FILE
+    if overrides_path.exists():
+        with open(overrides_path) as f:
+            overrides = json.load(f)
+        for step, fields in overrides.items():
+            profiles.setdefault(step, {}).update(fields)
+    return profiles
+
+def uses_gpu(profile):
+    # A step only counts against the GPU governor if its profile requests a GPU
+    return bool(profile.get("gres"))
+
+def gpu_count(profile):
+    # GPUs a step's job requests, from the count at the end of its gres (e.g. 4 for "gpu:a100:4"), 0 if it requests none
+    if not uses_gpu(profile):
+        return 0
+    count = str(profile["gres"]).rsplit(":", 1)[-1]
+    return int(count) if count.isdigit() else 1
+
+# endregion
+
+# region ### RENDERING ###
+
+def render_script(template_dir: Path, template_name, dest: Path, profile, **context):
+    '''
+    Renders one SLURM script template with a step's resource profile
+    Args:
+        template_dir: directory containing the .j2 templates
+        template_name: file name of the template, e.g. "NnUnetTrain_v2_agate.sh.j2"
+        dest: where to write the rendered script
+        profile: the resource profile for the step the script runs
+        context: any extra template variables
+    Out: None
+    '''
+    env = Environment(loader=FileSystemLoader(str(template_dir)), undefined=StrictUndefined,
+                      keep_trailing_newline=True, trim_blocks=True, lstrip_blocks=True)
+    text = env.get_template(template_name).render(profile=profile, **context)
+    dest.write_text(text)
+    dest.chmod(0o755)
+
+def render_scripts(template_dir: Path, task_logs: Path, scripts, profiles, **context):
+    '''
+    Renders every SLURM script used by a pipeline into the task log folder
+    Args:
+        template_dir: directory containing the .j2 templates
+        task_logs: the task log folder the rendered scripts are written to (and submitted from)
+        scripts: dictionary mapping rendered script name to the step whose profile it uses
+        profiles: resource profiles as returned by load_profiles
+        context: any extra template variables
+    Out: None
+    '''
+    for script, step in scripts.items():
+        render_script(template_dir, script + TEMPLATE_EXTENSION, task_logs / script, profiles[step], step=step, **context)
+
+# endregion
@@ -0,0 +1,188 @@
+import json
+import re
+import shutil
+import time
+import traceback
+from pathlib import Path
+
+from quick_eval import select_subset
+from step_timings import record_timing
+
+# region ### CONSTANTS ###
+SMOKE_DIR = "smoke" # the smoke task (data, SLURM scripts and job logs) is rebuilt under logs/<task>/smoke on every run
+SMOKE_RESULTS_FILE = "smoke_test.json" # outcome of the latest smoke test, in the task log folder
+SMOKE_TRAIN_CASES = 5 # nnUNet's 5-fold split needs at least 5 training cases
+SMOKE_TEST_CASES = 2
+SMOKE_SYNTH_IMAGES = "1" # SynthSeg images generated per age group
+SMOKE_EPOCHS = 2 # training is stopped once this many epochs have finished and a best checkpoint exists
+SMOKE_MAX_EPOCHS = 10 # ... or fails if there is still no best checkpoint after this many
+IMAGE_SUFFIX = ".nii.gz"
+CHANNEL_PATTERN = re.compile(r"^(.*)_(\d{4})\.nii\.gz$")
+# endregion
+
+# region ### SMOKE TASK ###
+
+def build_smoke_task(task_path: Path, smoke_task_path: Path, train_cases=SMOKE_TRAIN_CASES, test_cases=SMOKE_TEST_CASES):
+    '''
+    Creates a small copy of a task with a few training and test cases (spread across image sizes), laid out like the original (imagesTr/, labelsTr/, imagesTs/, labelsTs/).
+    The cases are copied rather than linked because resizing and the dataset conversion scripts may rewrite files in place
+    Args:
+        task_path: the real task folder
+        smoke_task_path: where to create the smoke task (replaced if it exists)
+        train_cases: number of training cases to copy
+        test_cases: number of test cases to copy
+    Out: dictionary with the copied case identifiers under "train" and "test"
+    '''
+    task_path, smoke_task_path = Path(task_path), Path(smoke_task_path)
+    if smoke_task_path.exists():
+        shutil.rmtree(smoke_task_path)
+    selected = {}
+    for split, size in (("Tr", train_cases), ("Ts", test_cases)):
+        images_dir, labels_dir = task_path / f"images{split}", task_path / f"labels{split}"
+        cases = select_subset(images_dir, labels_dir, size)
+        if len(cases) < size:
+            raise ValueError(f"{task_path} only has {len(cases)} labelled case(s) in images{split}/labels{split}, the smoke test needs {size}")
+        (smoke_task_path / f"images{split}").mkdir(parents=True)
+        (smoke_task_path / f"labels{split}").mkdir(parents=True)
+        for case in cases:
+            for image in images_dir.glob(f"{case}_[0-9][0-9][0-9][0-9]{IMAGE_SUFFIX}"):
+                shutil.copy2(image, smoke_task_path / f"images{split}" / image.name)
+            shutil.copy2(labels_dir / f"{case}{IMAGE_SUFFIX}", smoke_task_path / f"labels{split}" / f"{case}{IMAGE_SUFFIX}")
+        selected["train" if split == "Tr" else "test"] = cases
+    return selected
+
+def image_channels(images_dir: Path):
+    # Maps each case in an images folder to the set of channel indices it has (from the _0000, _0001, ... suffixes)
+    channels = {}
+    for image in Path(images_dir).glob("*" + IMAGE_SUFFIX):
+        match = CHANNEL_PATTERN.match(image.name)
+        if match:
+            channels.setdefault(match.group(1), set()).add(int(match.group(2)))
+    return channels
+
+def count_files(folder: Path):
+    # Number of NIfTI files in a folder, 0 if it doesn't exist
+    return len(list(Path(folder).glob("*" + IMAGE_SUFFIX))) if Path(folder).exists() else 0
+
+# endregion
+
+# region ### STEP CHECKS ###
+# Each check returns an error message, or None if the step's output looks right
+
+def check_cases(task_path: Path, cases):
+    # Every copied case is still present (with its label) after the images were resized
+    task_path = Path(task_path)
+    for split, key in (("Tr", "train"), ("Ts", "test")):
+        images = image_channels(task_path / f"images{split}")
+        missing = [c for c in cases[key] if c not in images or not (task_path / f"labels{split}" / f"{c}{IMAGE_SUFFIX}").exists()]
+        if missing:
+            return f"{len(missing)} case(s) missing from images{split}/labels{split} (e.g. {missing[0]})"
+    return None
+
+def check_file(path: Path):
+    # The step wrote the file it is expected to
+    if not Path(path).exists() or Path(path).stat().st_size == 0:
+        return f"{path} was not created"
+    return None
+
+def check_augmented(task_path: Path, cases):
+    # SynthSeg images were generated and moved into imagesTr/labelsTr next to the real cases
+    task_path = Path(task_path)
+    if (task_path / "SynthSeg_generated").exists():
+        return "SynthSeg_generated/ is still in the task folder"
+    images = image_channels(task_path / "imagesTr")
+    if len(images) <= len(cases["train"]):
+        return "no SynthSeg images were added to imagesTr"
+    if count_files(task_path / "labelsTr") != len(images):
+        return f"imagesTr has {len(images)} cases but labelsTr has {count_files(task_path / 'labelsTr')} labels"
+    return None
+
+def check_dataset_json(task_path: Path):
+    '''
+    Checks the dataset.json written by the dataset conversion script against the task's files: the channels it declares (v2 "channel_names", v1 "modality") must be exactly the _XXXX suffixes every training image has, and numTraining must match labelsTr
+    Args:
+        task_path: the task folder holding dataset.json
+    Out: error message, None if the file is consistent
+    '''
+    json_path = Path(task_path) / "dataset.json"
+    if not json_path.exists():
+        return f"{json_path} was not created"
+    try:
+        with open(json_path) as f:
+            dataset = json.load(f)
+    except ValueError as e:
+        return f"{json_path} is not valid JSON ({e})"
+    declared = dataset.get("channel_names", dataset.get("modality"))
+    if not declared:
+        return "dataset.json does not declare any channels (channel_names/modality)"
+    expected = set(range(len(declared)))
+    for case, channels in image_channels(Path(task_path) / "imagesTr").items():
+        if channels != expected:
+            return f"dataset.json declares {len(declared)} channel(s) ({', '.join(map(str, declared.values()))}) but {case} has channels {sorted(channels)}"
+    labels = count_files(Path(task_path) / "labelsTr")
+    if dataset.get("numTraining") != labels:
+        return f"dataset.json has numTraining={dataset.get('numTraining')} but labelsTr has {labels} labels"
+    return None
+
+def check_predictions(output_dir: Path, cases):
+    # Inference wrote one segmentation per test case
+    predicted = count_files(output_dir)
+    if predicted < len(cases["test"]):
+        return f"{predicted} of {len(cases['test'])} test case(s) were predicted in {output_dir}"
+    return None
+
+# endregion
+
+# region ### SMOKE TEST RUNNER ###
+
+class SmokeTest:
+    '''
+    Runs the pipeline steps on the smoke task one after another, timing each one and checking its output, and stops at the first step that fails.
+    Step runtimes (queue time included) are appended to the task's step_timings.csv as smoke_<step> and the outcome is written to smoke_test.json
+    '''
+
+    def __init__(self, logs_path):
+        self.logs_path = Path(logs_path)
+        self.results = []
+
+    def run(self, name, step, check=None):
+        '''
+        Runs one step
+        Args:
+            name: the step name used in the report
+            step: callable running the step (pipeline steps exit(1) on errors)
+            check: optional callable returning an error message if the step's output is wrong
+        Out: True if the step passed, False otherwise
+        '''
+        print(f"=== Smoke test: {name} ===")
+        start = time.time()
+        error = None
+        try:
+            step()
+        except SystemExit as e:
+            error = f"step exited with status {e.code}"
+        except Exception as e:
+            traceback.print_exc()
+            error = f"{type(e).__name__}: {e}"
+        if error is None and check is not None:
+            error = check()
+        seconds = time.time() - start
+        record_timing(self.logs_path, f"smoke_{name}", seconds, exit_code=0 if error is None else 1)
+        self.results.append({"step": name, "seconds": round(seconds, 1), "error": error})
+        if error is not None:
+            print(f"SMOKE TEST FAILED at {name}: {error}")
+        return error is None
+
+    def report(self):
+        # Prints the per-step timings, writes smoke_test.json and returns whether every step passed
+        passed = bool(self.results) and all(r["error"] is None for r in self.results)
+        print("--- Smoke Test Summary ---")
+        for result in self.results:
+            status = "ok" if result["error"] is None else "FAILED"
+            print(f"{result['step']:<16} {result['seconds'] / 60:6.1f} min  {status}")
+        print(f"Total {sum(r['seconds'] for r in self.results) / 60:.1f} min, smoke test {'passed' if passed else 'failed'}")
+        with open(self.logs_path / SMOKE_RESULTS_FILE, "w") as f:
+            json.dump({"finished": round(time.time()), "passed": passed, "steps": self.results}, f, indent=2)
+        return passed
+
+# endregion
@@ -0,0 +1,66 @@
+import csv
+from pathlib import Path
+
+# region ### CONSTANTS ###
+TIMINGS_FILE = "step_timings.csv"
+FIELDS = ["step", "job_id", "partition", "cpus", "workers", "seconds", "exit_code"]
+# endregion
+
+# region ### STEP TIMINGS ###
+
+def init_timings(logs_path: Path):
+    '''
+    Creates the step timings file (with its header) in the task log folder if it doesn't exist yet. The SLURM scripts append one row per timed command, and rows are kept across runs so configurations can be compared
+    Args:
+        logs_path: the task log folder
+    Out: path to the timings file
+    '''
+    timings_path = Path(logs_path) / TIMINGS_FILE
+    if not timings_path.exists():
+        with open(timings_path, "w", newline="") as f:
+            csv.writer(f).writerow(FIELDS)
+    return timings_path
+
+def record_timing(logs_path: Path, step, seconds, job_id="", partition="", cpus="", workers="", exit_code=0):
+    # Appends a timing row from the Python side (for steps that are not timed inside a SLURM script)
+    timings_path = init_timings(logs_path)
+    with open(timings_path, "a", newline="") as f:
+        csv.writer(f).writerow([step, job_id, partition, cpus, workers, round(seconds, 1), exit_code])
+
+def load_timings(logs_path: Path, step=None):
+    '''
+    Reads the recorded timings for a task, skipping failed runs
+    Args:
+        logs_path: the task log folder
+        step: only return rows for this step (all steps if None)
+    Out: list of timing rows as dictionaries
+    '''
+    timings_path = Path(logs_path) / TIMINGS_FILE
+    if not timings_path.exists():
+        return []
+    with open(timings_path, newline="") as f:
+        rows = [r for r in csv.DictReader(f) if r["exit_code"] == "0"]
+    return [r for r in rows if step is None or r["step"] == step]
+
+def summarize_timings(logs_path: Path, step):
+    '''
+    Averages the recorded runtimes of a step for each configuration (partition, CPUs, workers) it has been run with
+    Args:
+        logs_path: the task log folder
+        step: the step to summarize, e.g. "preprocess"
+    Out: list of (partition, cpus, workers, mean seconds, number of runs), fastest first
+    '''
+    grouped = {}
+    for row in load_timings(logs_path, step):
+        key = (row["partition"], row["cpus"], row["workers"])
+        grouped.setdefault(key, []).append(float(row["seconds"]))
+    summary = [(*key, sum(times) / len(times), len(times)) for key, times in grouped.items()]
+    return sorted(summary, key=lambda s: s[3])
+
+def print_timing_summary(logs_path: Path, steps):
+    # Prints the per-configuration runtimes of the given steps to the terminal
+    for step in steps:
+        for partition, cpus, workers, mean, runs in summarize_timings(logs_path, step):
+            print(f"{step}: partition={partition} cpus={cpus} workers={workers} -> {mean / 60:.1f} min (avg of {runs} run(s))")
+
+# endregion
@@ -0,0 +1,309 @@
+import argparse
+import itertools
+import json
+import subprocess
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from comparison_store import mean_test_dice, print_comparison, record_comparison
+from dataset_json import MODALITY_NAMES
+from dataset_view import assemble_view, get_variant_name, list_variants
+from executors import LOCAL_DIR, LOCAL_GPUS, MAX_LOCAL_JOBS, activate_local_executor, get_executor
+from step_timings import load_timings
+
+# region ### CONSTANTS ###
+SWEEPS_DIR = "sweeps" # per-sweep node logs and state, plus the comparison store shared by all sweeps
+STATE_FILE = "sweep_state.json" # which nodes of a sweep have finished, so an interrupted sweep resumes where it stopped
+PRESETS_DIR = "automation_presets_v2"
+PRESET_EXTENSION = ".config"
+PRESET_FIELDS = ["dcan_path", "task_path", "synth_path", "raw_data_base_path", "results_path", "trained_models_path",
+                 "modality", "task_number", "distribution", "synth_img_amt", "dataset_name", "model_type"] # the pipeline's positional arguments, in order
+GRID_FIELDS = ("modality", "distribution", "synth_img_amt") # preset fields a sweep can vary, everything upstream of SynthSeg is shared by all variants
+PIPELINE_STEPS = ["resize_images", "min_max", "SynthSeg_img", "copy_SynthSeg", "create_json", "p_and_p", "model_training", "inference"] # trainer_pipeline_v2 run_list order
+PREPARE_STEPS = ["resize_images", "min_max"]
+SYNTHSEG_STEPS = ["SynthSeg_img", "copy_SynthSeg"]
+VARIANT_STEPS = ["create_json", "p_and_p", "model_training", "inference"]
+MAX_PARALLEL = 4 # variants trained at the same time (their GPU jobs are still limited by the GPU governor)
+# endregion
+
+# region ### SWEEP DEFINITION ###
+
+def load_preset(script_dir: Path, name):
+    # Reads a v2 preset (key=value lines, as saved by the GUI) into a dictionary
+    preset_path = Path(script_dir) / PRESETS_DIR / f"{name}{PRESET_EXTENSION}"
+    if not preset_path.exists():
+        raise ValueError(f"preset {name} doesn't exist ({preset_path})")
+    preset = {}
+    with open(preset_path) as f:
+        for line in f:
+            if "=" in line:
+                key, value = line.strip().split("=", 1)
+                preset[key] = value
+    return preset
+
+def load_sweep(sweep_path: Path, script_dir: Path):
+    '''
+    Reads a sweep definition: a JSON file with the v2 preset the sweep starts from ("preset", optionally overridden by "base"), a grid of values for some of its fields ("grid") and the first task number given to the variants ("first_task_number"), e.g.
+        {"preset": "infant_t1t2", "grid": {"synth_img_amt": ["100", "500"], "distribution": ["uniform", "normal"]}, "first_task_number": 700}
+    Args:
+        sweep_path: the sweep definition file, its name (without .json) is the sweep name
+        script_dir: the path to the directory where this script lives (for the presets folder)
+    Out: dictionary with "name", "base" (all preset fields), "grid" and "first_task_number". Raises ValueError if the definition is incomplete
+    '''
+    with open(sweep_path) as f:
+        definition = json.load(f)
+    base = {**(load_preset(script_dir, definition["preset"]) if "preset" in definition else {}), **definition.get("base", {})}
+    missing = [field for field in PRESET_FIELDS if not str(base.get(field, "")).strip()]
+    if missing:
+        raise ValueError(f"the sweep's preset/base is missing {', '.join(missing)}")
+    grid = definition.get("grid", {})
+    unsupported = [field for field in grid if field not in GRID_FIELDS]
+    if unsupported or not grid:
+        raise ValueError(f"the grid must vary some of {', '.join(GRID_FIELDS)} (got {', '.join(grid) or 'nothing'})")
+    if "first_task_number" not in definition:
+        raise ValueError("first_task_number is required, every variant gets its own nnUNet dataset")
+    return {"name": Path(sweep_path).stem, "base": {k: str(v) for k, v in base.items()}, "grid": {k: [str(v) for v in values] for k, values in grid.items()},
+            "first_task_number": int(definition["first_task_number"])}
+
+def expand_variants(sweep):
+    '''
+    Expands the sweep's grid into one variant per combination, each with its own task number, dataset name and task folder in nnUNet_raw
+    Args:
+        sweep: the loaded sweep definition
+    Out: list of variant dictionaries (all preset fields plus "variant", the short name used in logs and the comparison store)
+    '''
+    base = sweep["base"]
+    fields = list(sweep["grid"])
+    variants = []
+    for number, values in enumerate(itertools.product(*(sweep["grid"][f] for f in fields))):
+        variant = {**base, **dict(zip(fields, values))}
+        name = get_variant_name(variant["modality"], variant["distribution"], variant["synth_img_amt"])
+        variant.update({
+            "variant": name,
+            "task_number": str(sweep["first_task_number"] + number),
+            "dataset_name": f"{base['dataset_name']}_{name}",
+        })
+        variant["task_path"] = str(Path(base["raw_data_base_path"]) / "nnUNet_raw" / f"Dataset{variant['task_number']}_{variant['dataset_name']}")
+        variants.append(variant)
+    return variants
+
+def check_task_numbers(variants, base):
+    # Variant task numbers must not collide with the base task or another dataset in nnUNet_raw (nnUNet finds datasets by their number)
+    raw = Path(base["raw_data_base_path"]) / "nnUNet_raw"
+    for variant in variants:
+        if variant["task_number"] == base["task_number"]:
+            raise ValueError(f"variant {variant['variant']} would reuse the base task number {base['task_number']}")
+        others = [p.name for p in raw.glob(f"Dataset{variant['task_number']}_*") if p.name != Path(variant["task_path"]).name] if raw.exists() else []
+        if others:
+            raise ValueError(f"task number {variant['task_number']} for {variant['variant']} is already used by {others[0]}")
+
+# endregion
+
+# region ### DAG ###
+
+def build_dag(sweep, variants):
+    '''
+    Turns the variants into a DAG of pipeline runs where identical upstream work runs once: resizing and min maxes on the base task for the whole sweep,
+    SynthSeg generation once per (modality, distribution, image count) set, stored in the base task's sources/synthseg/, then one training run per variant
+    Args:
+        sweep: the loaded sweep definition
+        variants: the expanded variants
+    Out: dictionary of node name -> {"deps", "lock", "fields", "steps", "variant"} in a valid run order
+    '''
+    base = sweep["base"]
+    dag = {"prepare": {"deps": [], "lock": "base", "fields": base, "steps": PREPARE_STEPS, "variant": None}}
+    for variant in variants:
+        synthseg = f"synthseg/{variant['variant']}"
+        if synthseg not in dag: # generation writes SynthSeg_generated/ in the base task, so these nodes share a lock
+            fields = {**base, **{f: variant[f] for f in GRID_FIELDS}}
+            dag[synthseg] = {"deps": ["prepare"], "lock": "base", "fields": fields, "steps": SYNTHSEG_STEPS, "variant": None}
+        dag[f"train/{variant['variant']}"] = {"deps": ["prepare", synthseg], "lock": None, "fields": variant, "steps": VARIANT_STEPS, "variant": variant}
+    return dag
+
+def print_dag(dag, state):
+    # Prints every node with its dependencies and whether it already ran
+    for name, node in dag.items():
+        status = state.get(name, {}).get("status", "pending")
+        print(f"{name:<40} {status:<8} steps: {', '.join(node['steps'])}{'  after: ' + ', '.join(node['deps']) if node['deps'] else ''}")
+
+def load_state(sweep_dir: Path):
+    # Reads which nodes of the sweep have already run
+    state_path = Path(sweep_dir) / STATE_FILE
+    if not state_path.exists():
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+def save_state(sweep_dir: Path, state):
+    # Writes the node states atomically
+    state_path = Path(sweep_dir) / STATE_FILE
+    tmp_path = state_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    tmp_path.replace(state_path)
+
+# endregion
+
+# region ### RUNNING NODES ###
+
+def get_channels(base_modality, modality):
+    # The base task's image channels a variant uses, e.g. [1] for a t2 variant of a t1t2 task, None if it uses all of them
+    if modality == base_modality:
+        return None
+    base_names, names = MODALITY_NAMES[base_modality], MODALITY_NAMES[modality]
+    if not set(names) <= set(base_names):
+        raise ValueError(f"a {modality} variant can't be made from a {base_modality} task")
+    return [base_names.index(name) for name in names]
+
+def get_logs_path(script_dir: Path, fields):
+    # The pipeline's log folder for a task, e.g. logs/Dataset700_AnomalousInfant_t1t2_uniform_100
+    return Path(script_dir) / "logs" / f"Dataset{fields['task_number']}_{fields['dataset_name']}"
+
+def pipeline_command(script_dir: Path, fields, steps):
+    # trainer_pipeline_v2.py command running only the given steps, with the step list encoded the way the GUI does it
+    selections = str([1 if step in steps else 0 for step in PIPELINE_STEPS])
+    return ["python", str(Path(script_dir) / "trainer_pipeline_v2.py"), *[fields[f] for f in PRESET_FIELDS], selections]
+
+def cancel_jobs(logs_path: Path):
+    # Cancels the jobs a pipeline run still has listed in its active jobs file (like the GUI's cancel button)
+    active_jobs_path = Path(logs_path) / "active_jobs.txt"
+    if not active_jobs_path.exists():
+        return
+    for job_id in active_jobs_path.read_text().split():
+        get_executor().cancel(job_id)
+
+def record_variant(script_dir: Path, sweep_name, variant, status):
+    # Scores a variant's inference output against its test labels and adds it to the comparison store
+    dice, cases = mean_test_dice(Path(variant["results_path"]) / f"Dataset{variant['task_number']}_{variant['dataset_name']}_infer",
+                                 Path(variant["task_path"]) / "labelsTs") if status == "done" else (None, 0)
+    seconds = sum(float(r["seconds"]) for r in load_timings(get_logs_path(script_dir, variant)))
+    record_comparison(Path(script_dir) / SWEEPS_DIR, {
+        **{f: variant[f] for f in ("variant", "task_number", "dataset_name", "modality", "distribution", "synth_img_amt", "model_type")},
+        "sweep": sweep_name, "status": status, "test_dice": round(dice, 4) if dice is not None else "", "test_cases": cases,
+        "compute_hours": round(seconds / 3600, 2)
+    })
+
+def run_node(script_dir: Path, sweep_dir: Path, name, node, processes):
+    '''
+    Runs one DAG node: a training node first links its task folder to the base task's resized cases and its SynthSeg set, then the pipeline runs the node's steps in its own process (output goes to sweeps/<sweep>/<node>.log)
+    Args:
+        script_dir: the path to the directory where this script lives
+        sweep_dir: the sweep's folder
+        name: the node name
+        node: the node
+        processes: dictionary of running node -> (process, logs path), used to cancel them on interrupt
+    Out: the pipeline's exit code
+    '''
+    fields = node["fields"]
+    if node["variant"] is not None:
+        base_task = node["variant"]["base_task_path"]
+        channels = get_channels(node["variant"]["base_modality"], fields["modality"])
+        view = assemble_view(fields["task_path"], fields["model_type"], fields["variant"], source_path=base_task, channels=channels)
+        print(f"[{name}] linked {view['links']} files from {base_task} ({view['base']} + {fields['variant']})")
+    log_path = Path(sweep_dir) / f"{name.replace('/', '_')}.log"
+    with open(log_path, "a") as log:
+        process = subprocess.Popen(pipeline_command(script_dir, fields, node["steps"]), stdout=log, stderr=subprocess.STDOUT, cwd=script_dir)
+        processes[name] = (process, get_logs_path(script_dir, fields))
+        process.wait()
+    processes.pop(name, None)
+    return process.returncode
+
+def run_sweep(sweep, script_dir: Path, max_parallel=MAX_PARALLEL, dry_run=False):
+    '''
+    Runs a sweep's DAG: each node starts as soon as its dependencies have finished (nodes sharing a lock run one at a time), nodes that finished in an earlier run are skipped and nodes depending on a failed node are not run.
+    Every finished or failed training node is scored and recorded in the comparison store (sweeps/comparisons.csv)
+    Args:
+        sweep: the loaded sweep definition
+        script_dir: the path to the directory where this script lives
+        max_parallel: maximum number of nodes running at the same time
+        dry_run: only print the DAG
+    Out: True if every node finished
+    '''
+    variants = expand_variants(sweep)
+    check_task_numbers(variants, sweep["base"])
+    for variant in variants:
+        get_channels(sweep["base"]["modality"], variant["modality"]) # fail before anything is queued
+        variant.update({"base_task_path": sweep["base"]["task_path"], "base_modality": sweep["base"]["modality"]})
+    dag = build_dag(sweep, variants)
+    sweep_dir = Path(script_dir) / SWEEPS_DIR / sweep["name"]
+    sweep_dir.mkdir(parents=True, exist_ok=True)
+    state = {n: s for n, s in load_state(sweep_dir).items() if s["status"] == "done"} # failed nodes are retried
+    for variant in list_variants(sweep["base"]["task_path"]): # SynthSeg sets stored by earlier sweeps or runs are reused
+        if f"synthseg/{variant}" in dag and f"synthseg/{variant}" not in state:
+            state[f"synthseg/{variant}"] = {"status": "done", "finished": round(time.time()), "reused": True}
+    print(f"--- Sweep {sweep['name']}: {len(variants)} variant(s), {len(dag)} node(s) ---")
+    print_dag(dag, state)
+    if dry_run:
+        return True
+
+    processes = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+        try:
+            while True:
+                # The DAG is in run order, so one pass also blocks the nodes after a newly blocked one
+                for name, node in dag.items():
+                    if name in state or name in running:
+                        continue
+                    if any(state.get(dep, {}).get("status") in ("failed", "blocked") for dep in node["deps"]):
+                        state[name] = {"status": "blocked", "finished": round(time.time())}
+                        print(f"[{name}] not run, a node it depends on failed")
+                        if node["variant"] is not None:
+                            record_variant(script_dir, sweep["name"], node["variant"], "blocked")
+                        continue
+                    locked = node["lock"] is not None and any(dag[r]["lock"] == node["lock"] for r in running)
+                    if all(state.get(dep, {}).get("status") == "done" for dep in node["deps"]) and not locked and len(running) < max_parallel:
+                        print(f"[{name}] started: {', '.join(node['steps'])}")
+                        running[name] = pool.submit(run_node, script_dir, sweep_dir, name, node, processes)
+                save_state(sweep_dir, state)
+                if not running:
+                    break
+                finished, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+                for name in [n for n, future in running.items() if future in finished]:
+                    future = running.pop(name)
+                    try:
+                        status = "done" if future.result() == 0 else "failed"
+                    except Exception as e:
+                        print(f"[{name}] {type(e).__name__}: {e}")
+                        status = "failed"
+                    state[name] = {"status": status, "finished": round(time.time())}
+                    print(f"[{name}] {status}")
+                    if dag[name]["variant"] is not None:
+                        record_variant(script_dir, sweep["name"], dag[name]["variant"], status)
+        except KeyboardInterrupt:
+            print("Sweep stopped, cancelling running nodes and their jobs...")
+            for process, logs_path in list(processes.values()):
+                process.terminate()
+                cancel_jobs(logs_path)
+            raise
+        finally:
+            save_state(sweep_dir, state)
+
+    print(f"--- Sweep {sweep['name']} Complete ---")
+    print_comparison(Path(script_dir) / SWEEPS_DIR, sweep["name"])
+    return all(state.get(name, {}).get("status") == "done" for name in dag)
+
+# endregion
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs a grid of nnUNet v2 pipeline variants that share their upstream steps")
+    parser.add_argument('sweep') # the sweep definition (JSON)
+    parser.add_argument('--max_parallel', type=int, default=MAX_PARALLEL) # nodes (pipeline processes) running at the same time
+    parser.add_argument('--dry_run', action='store_true') # print the DAG without running anything
+    parser.add_argument('--compare', action='store_true') # only print the sweep's results from the comparison store
+    parser.add_argument('--executor', default='slurm', choices=['slurm', 'local']) # submit jobs to SLURM, or run them on this machine (the pipelines inherit the choice)
+    parser.add_argument('--local_jobs', type=int, default=MAX_LOCAL_JOBS) # jobs the local executor runs at the same time, across all variants
+    parser.add_argument('--local_gpus', type=int, default=LOCAL_GPUS) # GPUs the local executor hands out to jobs
+    args = parser.parse_args()
+
+    script_dir = Path(__file__).resolve().parent
+    if args.executor == "local":
+        activate_local_executor(script_dir / "logs" / LOCAL_DIR, args.local_jobs, args.local_gpus)
+    sweep = load_sweep(args.sweep, script_dir)
+    if args.compare:
+        print_comparison(script_dir / SWEEPS_DIR, sweep["name"])
+        exit(0)
+    if not run_sweep(sweep, script_dir, args.max_parallel, args.dry_run):
+        exit(1)
+    print("PROGRAM COMPLETE!")
@@ -0,0 +1,40 @@
+import os
+
+import nibabel as nib
+import numpy as np
+
+from dataset_preflight import hash_files, scan_task
+
+def write_image(path, value):
+    nib.save(nib.Nifti1Image(np.full((4, 4, 4), value, dtype=np.uint8), np.eye(4)), str(path))
+
+def make_task(task_path):
+    for folder in ("imagesTr", "labelsTr", "imagesTs"):
+        (task_path / folder).mkdir(parents=True)
+    write_image(task_path / "imagesTr" / "case_a_0000.nii.gz", 1)
+    write_image(task_path / "labelsTr" / "case_a.nii.gz", 1)
+    write_image(task_path / "imagesTs" / "case_b_0000.nii.gz", 2)
+
+def test_scan_reads_headers_without_hashing(tmp_path):
+    # The pre-flight scan records headers and label values, no content hashes
+    make_task(tmp_path / "task")
+    index = scan_task(tmp_path / "task", tmp_path, workers=1)
+    assert index["files"]["imagesTr/case_a_0000.nii.gz"]["shape"] == [4, 4, 4]
+    assert index["files"]["labelsTr/case_a.nii.gz"]["labels"] == [1]
+    assert not any("sha256" in entry for entry in index["files"].values())
+
+def test_hashes_are_added_on_demand_and_kept_until_a_file_changes(tmp_path):
+    # Only the requested folders are hashed, the hashes survive a rescan of unchanged files and are dropped for changed ones
+    task_path = tmp_path / "task"
+    make_task(task_path)
+    index = hash_files(scan_task(task_path, tmp_path, workers=1), tmp_path, ("imagesTr", "labelsTr"), workers=1)
+    assert "sha256" in index["files"]["imagesTr/case_a_0000.nii.gz"]
+    assert "sha256" not in index["files"]["imagesTs/case_b_0000.nii.gz"]
+
+    changed = task_path / "labelsTr" / "case_a.nii.gz"
+    write_image(changed, 2)
+    os.utime(changed, (1, 1))
+    index = scan_task(task_path, tmp_path, workers=1)
+    assert "sha256" in index["files"]["imagesTr/case_a_0000.nii.gz"]
+    assert "sha256" not in index["files"]["labelsTr/case_a.nii.gz"]
+    assert index["rescanned"] == 1
@@ -0,0 +1,36 @@
+import threading
+
+import numpy as np
+
+from gpu_governor import GpuGovernor
+from pipeline_simulator import PipelineSimulation
+
+def test_governor_counts_gpus(tmp_path):
+    # A packed job holds one slot per GPU, so a 2-GPU job waits while a 3-GPU job holds a cap of 4, and starts once it is released
+    (tmp_path / "gpu_limits.config").write_text("a100-4=4\n")
+    governor = GpuGovernor(tmp_path, "Dataset645_X", poll_interval=0.05)
+    packed = governor.acquire("a100-4", 3)
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(GpuGovernor(tmp_path, "Dataset700_Y", poll_interval=0.05).acquire("a100-4", 2)))
+    waiter.start()
+    waiter.join(0.5)
+    assert not acquired
+    governor.release(packed)
+    waiter.join(5)
+    assert len(acquired) == 1
+
+def test_governor_runs_oversized_job_alone(tmp_path):
+    # A job asking for more GPUs than the cap takes the whole partition instead of waiting forever
+    (tmp_path / "gpu_limits.config").write_text("msigpu=2\n")
+    governor = GpuGovernor(tmp_path, "Dataset645_X", poll_interval=0.05)
+    assert governor.acquire("msigpu", 4) is not None
+
+def test_simulator_counts_gpus():
+    # The simulator admits governed jobs the same way, first come first served
+    simulation = PipelineSimulation({}, {"run": {}, "wait": {}}, {"a100-4": 4}, np.random.default_rng(0))
+    started = []
+    simulation.acquire("a100-4", 4, lambda: started.append("packed"))
+    simulation.acquire("a100-4", 1, lambda: started.append("single"))
+    assert started == ["packed"]
+    simulation.release("a100-4", 4)
+    assert started == ["packed", "single"]
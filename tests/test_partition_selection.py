@@ -0,0 +1,88 @@
+import csv
+import os
+import stat
+from datetime import datetime
+
+import pytest
+
+from partition_selection import CHOICES_FILE, choose_partition, fill_actual_starts, log_partition_choice, parse_test_only
+
+# Stand-ins for sbatch and sacct. sbatch answers --test-only with the start time listed for the -p partition in $STUB_STARTS
+# ("msigpu=2030-01-01T10:00:00 a100-4=..."), and rejects partitions that aren't listed. sacct prints the start listed for the -j job in $STUB_SACCT
+SBATCH_STUB = '''#!/bin/bash
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-p" ]; then partition=$2; fi
+    shift
+done
+for entry in $STUB_STARTS; do
+    if [ "${entry%%=*}" = "$partition" ]; then
+        echo "sbatch: Job 3983482 to start at ${entry#*=} using 6 processors on nodes agt01 in partition $partition" >&2
+        exit 0
+    fi
+done
+echo "sbatch: error: Batch job submission failed: Invalid partition name specified" >&2
+exit 1
+'''
+SACCT_STUB = '''#!/bin/bash
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-j" ]; then job=$2; fi
+    shift
+done
+for entry in $STUB_SACCT; do
+    if [ "${entry%%=*}" = "$job" ]; then echo "${entry#*=}"; exit 0; fi
+done
+echo "Unknown"
+'''
+PROFILE = {"partition": "msigpu", "partitions": ["msigpu", "a100-4"], "account": "faird", "time": "24:00:00", "mem": "90g", "gres": "gpu:a100:1"}
+
+@pytest.fixture
+def stubs(tmp_path, monkeypatch):
+    # Puts the stand-ins first on PATH
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name, text in (("sbatch", SBATCH_STUB), ("sacct", SACCT_STUB)):
+        (bin_dir / name).write_text(text)
+        (bin_dir / name).chmod(stat.S_IRWXU)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    return monkeypatch
+
+def test_parse_test_only():
+    output = "sbatch: Job 3983482 to start at 2024-05-01T12:34:56 using 6 processors on nodes agt01 in partition msigpu"
+    assert parse_test_only(output) == datetime(2024, 5, 1, 12, 34, 56)
+    assert parse_test_only("sbatch: error: Batch job submission failed: Requested node configuration is not available") is None
+
+def test_choose_partition_picks_earliest_start(stubs):
+    stubs.setenv("STUB_STARTS", "msigpu=2030-01-01T10:00:00 a100-4=2030-01-01T08:00:00")
+    chosen, estimates = choose_partition(PROFILE)
+    assert chosen == "a100-4"
+    assert estimates == {"msigpu": datetime(2030, 1, 1, 10), "a100-4": datetime(2030, 1, 1, 8)}
+
+def test_choose_partition_prefers_listed_order_on_ties(stubs):
+    stubs.setenv("STUB_STARTS", "msigpu=2030-01-01T10:00:00 a100-4=2030-01-01T10:00:00")
+    assert choose_partition(PROFILE)[0] == "msigpu"
+
+def test_choose_partition_skips_rejected_partitions(stubs):
+    stubs.setenv("STUB_STARTS", "a100-4=2030-01-01T10:00:00")
+    chosen, estimates = choose_partition(PROFILE)
+    assert chosen == "a100-4"
+    assert estimates["msigpu"] is None
+
+def test_choose_partition_falls_back_to_first_candidate(stubs):
+    stubs.setenv("STUB_STARTS", "")
+    assert choose_partition(PROFILE)[0] == "msigpu"
+
+def test_choose_partition_does_not_probe_a_pinned_partition(stubs):
+    stubs.setenv("STUB_STARTS", "")
+    assert choose_partition({**PROFILE, "partition": "msismall"}) == ("msismall", {})
+
+def test_fill_actual_starts(stubs, tmp_path):
+    estimates = {"msigpu": datetime(2030, 1, 1, 10), "a100-4": datetime(2030, 1, 1, 8)}
+    log_partition_choice(tmp_path, "inference", "111", "a100-4", estimates)
+    log_partition_choice(tmp_path, "model_training", "222", "a100-4", estimates)
+    stubs.setenv("STUB_SACCT", "111=2030-01-01T08:30:00")
+    fill_actual_starts(tmp_path)
+    with open(tmp_path / CHOICES_FILE, newline="") as f:
+        rows = {row["job_id"]: row for row in csv.DictReader(f)}
+    assert rows["111"]["actual_start"] == "2030-01-01T08:30:00"
+    assert rows["111"]["estimated_start"] == "2030-01-01T08:00:00"
+    assert rows["222"]["actual_start"] == "" # not started yet, filled in on a later call
@@ -0,0 +1,86 @@
+import argparse
+import os
+import stat
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from smoke_test import SmokeTest, check_predictions
+from trainer_pipeline import inference
+
+# Stand-ins for sbatch and squeue. sbatch "runs" infer_agate.sh at once by copying the batch's images ($7) to the output folder ($8) as
+# predictions and remembers the job under its name ($9 is the batch), squeue finds a job by --name and reports every job as finished
+SBATCH_STUB = '''#!/bin/bash
+shift
+job=$(( $(wc -l < "$STUB_DIR/jobs") + 101 ))
+echo "$job $3_infer_$8" >> "$STUB_DIR/jobs"
+for image in "$6"/*_0000.nii.gz; do
+    name=$(basename "$image")
+    cp "$image" "$7/${name%_0000.nii.gz}.nii.gz"
+done
+echo "Submitted batch job $job"
+'''
+SQUEUE_STUB = '''#!/bin/bash
+if [ "$1" = "--name" ]; then
+    echo "JOBID"
+    while read -r job name; do
+        if [ "$name" = "$2" ]; then echo "$job"; fi
+    done < "$STUB_DIR/jobs"
+fi
+'''
+TASK_NUMBER = "645"
+
+def write_image(path, value):
+    nib.save(nib.Nifti1Image(np.full((4, 4, 4), value, dtype=np.uint8), np.eye(4)), str(path))
+
+@pytest.fixture
+def smoke_root(tmp_path, monkeypatch):
+    # A smoke folder with two test cases, a GPU limit for the inference partition and a no-op plotting script, plus the stand-ins first on PATH
+    bin_dir, stub_dir = tmp_path / "bin", tmp_path / "stub"
+    bin_dir.mkdir()
+    stub_dir.mkdir()
+    (stub_dir / "jobs").write_text("")
+    for name, text in (("sbatch", SBATCH_STUB), ("squeue", SQUEUE_STUB)):
+        (bin_dir / name).write_text(text)
+        (bin_dir / name).chmod(stat.S_IRWXU)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("STUB_DIR", str(stub_dir))
+    monkeypatch.chdir(tmp_path)
+
+    root = tmp_path / "smoke"
+    task_path = root / "nnUNet_raw_data" / f"Task{TASK_NUMBER}"
+    for folder in ("imagesTs", "labelsTs"):
+        (task_path / folder).mkdir(parents=True)
+    for case in ("case_a", "case_b"):
+        write_image(task_path / "imagesTs" / f"{case}_0000.nii.gz", 1)
+        write_image(task_path / "labelsTs" / f"{case}.nii.gz", 1)
+    (tmp_path / "repo").mkdir()
+    (tmp_path / "repo" / "gpu_limits.config").write_text("msigpu=2\n")
+    paper_dir = tmp_path / "synth" / "SynthSeg" / "dcan" / "paper"
+    paper_dir.mkdir(parents=True)
+    (paper_dir / "evaluate_results.py").write_text("")
+    return root
+
+def test_smoke_inference_step_passes(smoke_root, monkeypatch):
+    # The v1 smoke test's last step: every batch job is logged to the active jobs file and each test case gets a prediction
+    tmp_path = smoke_root.parent
+    args = argparse.Namespace(
+        task_number=TASK_NUMBER, priority="normal",
+        task_path=str(smoke_root / "nnUNet_raw_data" / f"Task{TASK_NUMBER}"),
+        raw_data_base_path=str(smoke_root),
+        results_path=str(smoke_root / "results"),
+        trained_models_path=str(smoke_root / "nnUNet_results"),
+        synth_path=str(tmp_path / "synth"),
+    )
+    log_file_path = smoke_root / "active_jobs.txt"
+    log_file_path.write_text("")
+    inferred_dir = smoke_root / "results" / f"{TASK_NUMBER}_infer"
+    cases = {"test": ["case_a", "case_b"]}
+
+    smoke = SmokeTest(tmp_path)
+    passed = smoke.run("inference", lambda: inference(args, smoke_root, log_file_path, tmp_path / "repo", output_dir=inferred_dir),
+                       lambda: check_predictions(inferred_dir, cases))
+    assert passed, smoke.results
+    assert log_file_path.read_text().split() == ["101"]
+    assert sorted(p.name for p in inferred_dir.glob("*.nii.gz")) == ["case_a.nii.gz", "case_b.nii.gz"]
@@ -1,6 +1,7 @@
 import sys
 import os
 import subprocess
+import time
 import psutil
 from pathlib import Path
 
@@ -12,6 +13,7 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtCore import QObject, QThread, pyqtSignal, QTimer, Qt
 import PyQt5_stylesheets
 from custom_widgets import *
+from training_progress import format_progress, read_progress
 
 # region ### CONSTANTS ###
 PRESETS_DIR_V1 = "automation_presets"
@@ -144,7 +146,8 @@ class PipelineWorkerThreadV2(QtCore.QThread):
             self.raw_path, self.results_path, self.trained_path,
             self.modality, self.task_num, self.distribution,
             self.synth_amt, self.dataset_name, self.model_type,
-            self.step_selections
+            self.step_selections,
+            "--fold_layout=auto" # packs or spreads the folds from the queue depth when training starts, which can be days after Run is pressed
         ]
         process = subprocess.Popen(cmd, stdout=None, stderr=None)
         self.processes.append(process)
@@ -200,6 +203,11 @@ class Window(QtWidgets.QMainWindow):
         self.worker_thread = None
         self.is_running = False
         self.step_selections = []
+        self.run_started = 0
+
+        # While a v2 run is going, the status shows each training fold's epoch and ETA from the pipeline's progress file
+        self.progress_timer = QTimer(self)
+        self.progress_timer.timeout.connect(self._show_training_progress)
 
         # Core input fields shared by v1 and v2
         self.input_fields = {
@@ -336,6 +344,13 @@ class Window(QtWidgets.QMainWindow):
         print(message)
         self.ui.menuiuhwuaibfa.setTitle(message)
 
+    def _show_training_progress(self):
+        # Shows the training progress written by this run (older progress files from earlier runs are ignored)
+        dataset_folder = f"Dataset{self.input_fields['task_number'].text().strip()}_{self.input_fields['dataset_name'].text().strip()}"
+        progress = read_progress(self.script_dir / "logs" / dataset_folder)
+        if progress and progress["updated"] >= self.run_started:
+            self.ui.menuiuhwuaibfa.setTitle(format_progress(progress))
+
     def run_program(self):
         #Handles run / cancel button click, starting the pipeline in a new thread if not currently running, or stopping the pipeline if it is currently running
         
@@ -387,6 +402,9 @@ class Window(QtWidgets.QMainWindow):
             self.worker_thread.finished.connect(self.on_pipeline_finished)
             self.worker_thread.start()
             self.is_running = True
+            self.run_started = time.time()
+            if self.pipeline_version == 2:
+                self.progress_timer.start(60000)
             self.ui.pushButton.setText('Cancel')
         # If program is currently running, stop the pipeline and any active jobs
         else:
@@ -395,6 +413,7 @@ class Window(QtWidgets.QMainWindow):
 
     def on_pipeline_finished(self):
         #Pipeline finished behavior
+        self.progress_timer.stop()
         self.is_running = False
         self.step_selections = []
         self.ui.pushButton.setText('Run')
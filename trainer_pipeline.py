@@ -5,6 +5,15 @@ import subprocess
 import time
 from pathlib import Path
 
+from dataset_json import create_dataset_json
+from dataset_preflight import hash_files, run_preflight, scan_task
+from gpu_governor import GpuGovernor
+from inference_manifest import (case_fingerprints, load_manifest, model_fingerprint, plan_inference, record_predictions, save_manifest, update_evaluation,
+                                write_case_dice)
+from smoke_test import (SMOKE_DIR, SMOKE_EPOCHS, SMOKE_MAX_EPOCHS, SMOKE_SYNTH_IMAGES, SmokeTest, build_smoke_task, check_augmented, check_cases,
+                        check_dataset_json, check_file, check_predictions)
+from training_logs import parse_training_log
+
 # region ### SLURM SCRIPTS ###
 SCRIPTS = [
     "SynthSeg_image_generation.sh",
@@ -13,6 +22,17 @@ SCRIPTS = [
     "infer_agate.sh",
     "create_min_maxes.sh"
 ]
+
+# Partition each GPU script requests (must match the -p line in the script), used by the GPU governor
+PLAN_AND_PREPROCESS_PARTITION = "a100-4"
+TRAIN_PARTITION = "msigpu"
+INFER_PARTITION = "msigpu"
+
+# nnUNet v1 best checkpoint files and the final ones nnUNet_predict loads, used to finish a smoke test fold early
+SMOKE_CHECKPOINTS = [
+    ("model_best.model", "model_final_checkpoint.model"),
+    ("model_best.model.pkl", "model_final_checkpoint.model.pkl")
+]
 # endregion
 
 # region ### UTILITY FUNCTIONS ###
@@ -195,6 +215,28 @@ def get_job_id_from_squeue(job_name):
     if len(lines) > 1:
         return lines[1].strip()
     return None
+
+def get_governor(args, script_dir):
+    # Returns the GPU governor shared by every pipeline running from this checkout
+    return GpuGovernor(script_dir, f"Task{args.task_number}", args.priority)
+
+def export_nnunet_paths(args):
+    # Exports the paths SynthSeg, the dcan scripts and nnUNet read from the environment (the SLURM jobs inherit them)
+    os.environ.update({
+        "PYTHONPATH": f"{args.synth_path}:{Path(args.synth_path) / 'SynthSeg'}:{args.dcan_path}:{Path(args.dcan_path) / 'dcan'}",
+        "nnUNet_raw_data_base": args.raw_data_base_path,
+        "nnUNet_preprocessed": str(Path(args.raw_data_base_path) / "nnUNet_preprocessed"),
+        "RESULTS_FOLDER": args.trained_models_path
+    })
+
+def get_lut_path(args):
+    # Returns the look-up table in the dcan repo that label values and names come from
+    return Path(args.dcan_path) / "look_up_tables" / "Freesurfer_LUT_DCAN.txt"
+
+def get_min_max_path(args, script_dir):
+    # Returns where the min maxes for SynthSeg are written, smoke tests keep theirs in the smoke folder
+    folder = Path(args.smoke_root) if args.smoke_root else Path(script_dir) / "min_maxes"
+    return folder / f"mins_maxes_task_{args.task_number}.npy"
 # endregion
 
 #region ### TRAINING FUNCTIONS ###
@@ -210,7 +252,7 @@ def min_max(args, logs_path, log_file_path, script_dir):
     print("--- Now Creating Min Maxes ---")
     os.chdir(logs_path)
     time.sleep(3)
-    output_path = Path(script_dir) / "min_maxes" / f"mins_maxes_task_{args.task_number}.npy"
+    output_path = get_min_max_path(args, script_dir)
     submit_job(["sbatch", "-W", str(logs_path / "create_min_maxes.sh"), args.synth_path, args.task_path, str(output_path)], log_file_path, "min_maxes")
     print("--- Min Maxes Created ---")
 
@@ -219,7 +261,7 @@ def SynthSeg_img(args, logs_path, log_file_path, script_dir):
     print("--- Now Creating Synthetic Images ---")
     os.chdir(logs_path)
     time.sleep(3)
-    output_path = Path(script_dir) / "min_maxes" / f"mins_maxes_task_{args.task_number}.npy"
+    output_path = get_min_max_path(args, script_dir)
     submit_job([
         "sbatch", "-W",
         str(logs_path / "SynthSeg_image_generation.sh"),
@@ -248,35 +290,34 @@ def copy_SynthSeg(args):
         shutil.rmtree(task_path / "SynthSeg_generated")
     print("--- Images Moved ---")
 
+### Checking the Dataset ###
+def check_dataset(args, logs_path):
+    # Checks every image and label header before the json is made or plan and preprocess is queued (index kept in logs/Task<N>/dataset_index.json)
+    problems = run_preflight(args.task_path, logs_path, args.modality, get_lut_path(args))
+    if problems:
+        print(f"ERROR: {len(problems)} dataset problem(s) found, fix them before running the remaining steps")
+        exit(1)
+
 ### Creating Dataset Json ###
-def create_json(args):
+def create_json(args, logs_path, log_file_path, script_dir):
+    # Json gets created from the dataset index in one pass (modality names from the GUI, label names from the LUT)
     print("--- Now Creating Dataset JSON ---")
-    task_path = Path(args.task_path)
-    # Json gets created
-    subprocess.run([
-        "python",
-        str(Path(args.dcan_path) / "dcan" / "dataset_conversion" / "create_json_file.py"),
-        f"Task{args.task_number}",
-        str(Path(args.dcan_path) / "look_up_tables" / "Freesurfer_LUT_DCAN.txt"),
-        f"--modalities={args.modality}"
-    ])
-    # Some errors in json need to be fixed
-    subprocess.run([
-        "python",
-        str(Path(args.dcan_path) / "dcan" / "dataset_conversion" / "fix_json_file.py"),
-        str(task_path / 'dataset.json'), str(task_path / 'dataset2.json'),
-        str(Path(args.dcan_path) / "look_up_tables" / "Freesurfer_LUT_DCAN.txt")
-    ])
-    (task_path / 'dataset.json').unlink()
-    (task_path / 'dataset2.json').rename(task_path / 'dataset.json')
+    try:
+        create_dataset_json(args.task_path, logs_path, 1, f"Task{args.task_number}", args.modality, get_lut_path(args))
+    except ValueError as e:
+        print(f"ERROR: Can't create dataset.json ({e})")
+        exit(1)
     print("--- Dataset json Created ---")
 
 ### Plan and Preprocess ###
 def p_and_p(args, logs_path, log_file_path, script_dir):
     print("--- Now Running Plan and Preprocess ---")
     os.chdir(logs_path)
+    governor = get_governor(args, script_dir)
+    ticket = governor.acquire(PLAN_AND_PREPROCESS_PARTITION)
     time.sleep(3)
     submit_job(["sbatch", "-W", "NnUnet_plan_and_preprocess_agate.sh", args.raw_data_base_path, args.task_number, args.trained_models_path], log_file_path)
+    governor.release(ticket)
     print("--- Finished Plan and Preprocessing ---")
 
 ### Training Model ###
@@ -284,12 +325,23 @@ def model_training(args, logs_path, log_file_path, script_dir):
     print("--- Now Running NnUNet Training ---")
     os.chdir(logs_path)
     job_ids = [None, None, None, None, None]
+    tickets = [None, None, None, None, None]
     complete = [False, False, False, False, False]
+    governor = get_governor(args, script_dir)
+
+    # Waits for a GPU slot from the governor, submits the fold and ties the slot to its SLURM job
+    def _submit_fold(fold, continue_flag=""):
+        tickets[fold] = governor.acquire(TRAIN_PARTITION)
+        cmd = ["sbatch", "-W", "NnUnetTrain_agate.sh", str(fold), "faird", args.task_number, args.raw_data_base_path, args.trained_models_path]
+        if continue_flag:
+            cmd.append(continue_flag)
+        time.sleep(3)
+        submit_job(cmd, log_file_path)
+        job_ids[fold] = get_job_id_from_squeue(f"{args.task_number}_{fold}_Train_nnUNet")
+        governor.attach(tickets[fold], job_ids[fold])
     
     # Start fold 0 training and wait until it finishes the setup to run next folds
-    time.sleep(3)
-    submit_job(["sbatch", "-W", "NnUnetTrain_agate.sh", "0", "faird", args.task_number, args.raw_data_base_path, args.trained_models_path], log_file_path)
-    job_ids[0] = get_job_id_from_squeue(f"{args.task_number}_0_Train_nnUNet")
+    _submit_fold(0)
     wait_fold_0_setup(
         get_training_log_path(logs_path, args.task_number, 0, job_ids[0]),
         get_training_error_path(logs_path, args.task_number, 0, job_ids[0]),
@@ -301,74 +353,185 @@ def model_training(args, logs_path, log_file_path, script_dir):
     # Once setup is ready, start training the next folds
     for i in range(1, 5):
         print(f"Begin training Fold {i}")
-        time.sleep(3)
-        submit_job(["sbatch", "-W", "NnUnetTrain_agate.sh", str(i), "faird", args.task_number, args.raw_data_base_path, args.trained_models_path], log_file_path)
-        job_ids[i] = get_job_id_from_squeue(f"{args.task_number}_{i}_Train_nnUNet")
+        _submit_fold(i)
 
     # If folds finish training due to SLURM time limit, continue training with -c argument
     while not all(complete):
         for i in range(5):
+            if complete[i]:
+                continue
             wait_for_job_to_finish(job_ids[i], i)
+            governor.release(tickets[i])
             err_file = get_training_error_path(logs_path, args.task_number, i, job_ids[i])
             if check_complete(err_file, i):
                 complete[i] = True
             else:
-                time.sleep(3)
-                submit_job(["sbatch", "-W", "NnUnetTrain_agate.sh", str(i), "faird", args.task_number, args.raw_data_base_path, args.trained_models_path, "-c"], log_file_path)
-                job_ids[i] = get_job_id_from_squeue(f"{args.task_number}_{i}_Train_nnUNet")
+                _submit_fold(i, "-c")
     print("--- Training Complete ---")
 
 ### Create Inferred Segmentations and Plots ###
-def inference(args, logs_path):
-    # Created inferred segmentations
+def inference(args, logs_path, log_file_path, script_dir, output_dir=None):
+    # Created inferred segmentations (written to output_dir if given, otherwise to the inferred folder the plots are made from). Only test cases that are new, changed or were predicted with other checkpoints are predicted again (see inference_manifest.py)
     print("--- Starting Inference ---")
     inferred_dir = Path(args.results_path) / f"{args.task_number}_infer"
     inferred_dir.mkdir(parents=True, exist_ok=True)
+    output_dir = Path(output_dir) if output_dir else inferred_dir
+    output_dir.mkdir(parents=True, exist_ok=True)
     submitter_parent_image_dir = Path(args.raw_data_base_path) / "nnUNet_raw_data" / f"Task{args.task_number}" / "imagesTs"
     # can only process 2000 .nii.gz files max
     if len(list(submitter_parent_image_dir.glob("*.nii.gz"))) > 2000:
         print("Error: Too many .nii.gz files to process. Please limit to 2000.")
         return
-    all_files = list(submitter_parent_image_dir.glob("*.nii.gz"))
+    cases = case_fingerprints(hash_files(scan_task(args.task_path, logs_path), logs_path, ("imagesTs", "labelsTs")))
+    checkpoints = [get_fold_dir(args.trained_models_path, args.task_number, f) / "model_final_checkpoint.model" for f in range(5)]
+    model = model_fingerprint(checkpoints, "3d_fullres nnUNetTrainerV2_noMirroring")
+    manifest = load_manifest(output_dir)
+    pending, removed = plan_inference(manifest, cases, model, output_dir)
+    save_manifest(output_dir, manifest)
+    print(f"{len(pending)} of {len(cases)} test case(s) need predicting, the rest are up to date")
+    all_files = [submitter_parent_image_dir / name for case in pending for name in cases[case]["files"]]
     batch_size = 100
-    last_job_id = None
+    governor = get_governor(args, script_dir)
+    batch_jobs = [] # (job id, governor ticket) of every batch
     for batch_index, batch_start in enumerate(range(0, len(all_files), batch_size)):
         batch_files = all_files[batch_start:batch_start + batch_size]
         # create a subdirectory for this batch
         batch_name = f"batch_{batch_index:04d}"
         image_dir = inferred_dir / batch_name
         image_dir.mkdir(parents=True, exist_ok=True)
-        # create a log directory for this batch
-        indv_log_dir = logs_path / "inference" / batch_name
-        indv_log_dir.mkdir(parents=True, exist_ok=True)
         # copy all files in this batch to the subdirectory
         for file in batch_files:
             shutil.copy(file, image_dir)
         # submit one inference job for this batch
         print(f"Processing batch {batch_index} ({len(batch_files)} files)")
         os.chdir(logs_path)
+        ticket = governor.acquire(INFER_PARTITION)
         time.sleep(3)
-        submit_job(["sbatch", "-W", "infer_agate.sh", "faird", args.task_number, args.raw_data_base_path, args.trained_models_path, str(image_dir)], indv_log_dir)
-        last_job_id = get_job_id_from_squeue(f"{args.task_number}_infer")
-    wait_for_job_to_finish(last_job_id, -1)
+        submit_job(["sbatch", "-W", "infer_agate.sh", "faird", args.task_number, args.raw_data_base_path, args.trained_models_path, str(image_dir), str(output_dir), batch_name], log_file_path)
+        job_id = get_job_id_from_squeue(f"{args.task_number}_infer_{batch_name}") # each batch job has its own name, so the slot is tied to this batch's job
+        governor.attach(ticket, job_id)
+        batch_jobs.append((job_id, ticket))
+    for job_id, ticket in batch_jobs:
+        if job_id is not None:
+            wait_for_job_to_finish(job_id, -1)
+        governor.release(ticket)
+    record_predictions(manifest, cases, model, pending, output_dir)
+    save_manifest(output_dir, manifest)
     print("--- Inference Complete ---")
 
-    # Create dice plots
-    print("--- Creating Plots ---")
+    # Per-case Dice, only computed for the predictions (or labels) that changed since the last evaluation
     results_dir = Path(args.results_path) / f"{args.task_number}_results"
-    results_dir.mkdir(parents=True, exist_ok=True)
+    evaluated = update_evaluation(manifest, cases, output_dir, Path(args.task_path) / "labelsTs")
+    save_manifest(output_dir, manifest)
+    write_case_dice(manifest, results_dir)
     # clear batch directories from the inferred directory
     for batch_dir in inferred_dir.glob("batch_*"):
         shutil.rmtree(batch_dir)
+    if not (pending or removed or evaluated):
+        print("Predictions and labels are unchanged, the plots are up to date")
+        return
+
+    # Create dice plots
+    print("--- Creating Plots ---")
     paper_dir = Path(args.synth_path) / "SynthSeg" / "dcan" / "paper"
     os.chdir(paper_dir)
     subprocess.run(["python", "evaluate_results.py",
                     str(Path(args.task_path) / "labelsTs"),
-                    str(inferred_dir),
+                    str(output_dir),
                     str(results_dir)])
     print("--- Plots Created ---")
 # endregion
 
+# region ### SMOKE TEST ###
+
+def get_smoke_args(args, smoke_root: Path):
+    # Copy of the arguments with every path the pipeline writes to pointed into the smoke folder (same task number, so the real json scripts run)
+    return argparse.Namespace(**{
+        **vars(args),
+        "task_path": str(smoke_root / "nnUNet_raw_data" / f"Task{args.task_number}"),
+        "raw_data_base_path": str(smoke_root),
+        "results_path": str(smoke_root / "results"),
+        "trained_models_path": str(smoke_root / "nnUNet_results"),
+        "synth_img_amt": SMOKE_SYNTH_IMAGES,
+        "smoke_root": str(smoke_root)
+    })
+
+### Smoke Test Training ###
+def smoke_training(args, logs_path, log_file_path, script_dir):
+    # Trains fold 0 until SMOKE_EPOCHS epochs have finished and nnUNet has saved a best model, then cancels it and uses the best model as the final one
+    print(f"--- Now Training Fold 0 for {SMOKE_EPOCHS} Epochs ---")
+    os.chdir(logs_path)
+    governor = get_governor(args, script_dir)
+    ticket = governor.acquire(TRAIN_PARTITION)
+    time.sleep(3)
+    submit_job(["sbatch", "-W", "NnUnetTrain_agate.sh", "0", "faird", args.task_number, args.raw_data_base_path, args.trained_models_path], log_file_path)
+    job_id = get_job_id_from_squeue(f"{args.task_number}_0_Train_nnUNet")
+    governor.attach(ticket, job_id)
+
+    fold_dir = get_fold_dir(args.trained_models_path, args.task_number, 0)
+    out_file = get_training_log_path(logs_path, args.task_number, 0, job_id)
+    best, final = fold_dir / SMOKE_CHECKPOINTS[0][0], fold_dir / SMOKE_CHECKPOINTS[0][1]
+    while is_job_running(job_id) and not final.exists():
+        epochs = max(len(parse_training_log(out_file)["epoch_times"]), len(parse_training_log(get_latest_training_log(fold_dir))["epoch_times"]))
+        # Don't stop the trainer while it is still writing the best model
+        if epochs >= SMOKE_EPOCHS and best.exists() and time.time() - best.stat().st_mtime > 15:
+            print(f"Fold 0 finished {epochs} epoch(s), stopping training.")
+            subprocess.run(["scancel", str(job_id)])
+            break
+        if epochs >= SMOKE_MAX_EPOCHS:
+            print(f"Fold 0 has no best model after {epochs} epochs, stopping training.")
+            subprocess.run(["scancel", str(job_id)])
+            break
+        time.sleep(30)
+    wait_for_job_to_finish(job_id, -2, check_interval=10)
+    governor.release(ticket)
+    if not final.exists():
+        if not all((fold_dir / src).exists() for src, _ in SMOKE_CHECKPOINTS):
+            print(f"ERROR: Fold 0 did not save a model (see {out_file} and {get_training_error_path(logs_path, args.task_number, 0, job_id)})")
+            exit(1)
+        for src, dst in SMOKE_CHECKPOINTS:
+            shutil.copyfile(fold_dir / src, fold_dir / dst)
+    print("--- Smoke Test Training Complete ---")
+
+def run_smoke_test(args, logs_path, script_dir):
+    # Runs every step on a small copy of the task under logs/Task<N>/smoke (rebuilt on every run) and stops at the first step that fails. Returns True if all steps passed
+    print("--- Starting Smoke Test ---")
+    smoke_root = Path(logs_path) / SMOKE_DIR
+    if smoke_root.exists():
+        shutil.rmtree(smoke_root)
+    smoke_args = get_smoke_args(args, smoke_root)
+    set_up_slurm_scripts(smoke_root, Path(script_dir) / "scripts" / "slurm_scripts")
+    smoke_log_file_path = smoke_root / "active_jobs.txt"
+    smoke = SmokeTest(logs_path)
+    cases = {}
+    step_args = (smoke_args, smoke_root, smoke_log_file_path, script_dir)
+    inferred_dir = Path(smoke_args.results_path) / f"{args.task_number}_infer"
+    plans = Path(smoke_args.raw_data_base_path) / "nnUNet_preprocessed" / f"Task{args.task_number}" / "nnUNetPlansv2.1_plans_3D.pkl"
+    steps = [
+        ("build_task", lambda: cases.update(build_smoke_task(args.task_path, smoke_args.task_path)), None),
+        ("resize_images", lambda: resize_images(smoke_args), lambda: check_cases(smoke_args.task_path, cases)),
+        ("min_max", lambda: min_max(*step_args), lambda: check_file(get_min_max_path(smoke_args, script_dir))),
+        ("SynthSeg_img", lambda: SynthSeg_img(*step_args), None),
+        ("copy_SynthSeg", lambda: copy_SynthSeg(smoke_args), lambda: check_augmented(smoke_args.task_path, cases)),
+        ("check_dataset", lambda: check_dataset(smoke_args, smoke_root), None),
+        ("create_json", lambda: create_json(*step_args), lambda: check_dataset_json(smoke_args.task_path)),
+        ("p_and_p", lambda: p_and_p(*step_args), lambda: check_file(plans)),
+        ("model_training", lambda: smoke_training(*step_args), None),
+        ("inference", lambda: inference(*step_args, output_dir=inferred_dir), lambda: check_predictions(inferred_dir, cases))
+    ]
+
+    export_nnunet_paths(smoke_args)
+    try:
+        for name, step, check in steps:
+            if not smoke.run(name, step, check):
+                break
+    finally:
+        export_nnunet_paths(args)
+        os.chdir(script_dir)
+    return smoke.report()
+
+# endregion
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('dcan_path')
@@ -382,15 +545,14 @@ if __name__ == '__main__':
     parser.add_argument('distribution')
     parser.add_argument('synth_img_amt')
     parser.add_argument('list')
+    parser.add_argument('--priority', default='normal', choices=['critical', 'normal', 'exploratory']) # Fair-share class used by the GPU governor (not passed by the GUI)
+    parser.add_argument('--smoke', action='store_true') # Run the whole pipeline on a few cases first and only start the full run if it passes
+    parser.add_argument('--smoke_only', action='store_true') # Only run the smoke test
+    parser.set_defaults(smoke_root=None) # Set for the smoke test's copy of the arguments
     args = parser.parse_args()
 
     # Export necessary paths
-    os.environ.update({
-        "PYTHONPATH": f"{args.synth_path}:{Path(args.synth_path) / 'SynthSeg'}:{args.dcan_path}:{Path(args.dcan_path) / 'dcan'}",
-        "nnUNet_raw_data_base": args.raw_data_base_path,
-        "nnUNet_preprocessed": str(Path(args.raw_data_base_path) / "nnUNet_preprocessed"),
-        "RESULTS_FOLDER": args.trained_models_path
-    })
+    export_nnunet_paths(args)
 
     # Some setup stuff
     script_dir = Path(__file__).resolve().parent
@@ -399,6 +561,14 @@ if __name__ == '__main__':
 
     set_up_slurm_scripts(logs_path, script_dir / "scripts" / "slurm_scripts")
 
+    # Smoke test on a few cases before anything is queued for the full run
+    if args.smoke or args.smoke_only:
+        if not run_smoke_test(args, logs_path, script_dir):
+            print("Smoke test failed, the full run was not started.")
+            exit(1)
+        if args.smoke_only:
+            exit(0)
+
     run_list = [
         resize_images,
         min_max,
@@ -413,9 +583,14 @@ if __name__ == '__main__':
     # Figures out what functions user wants to run from selection in GUI and runs only those ones
     flags = [args.list[i * 3 + 1] == '1' for i in range(len(run_list))]
 
+    dataset_checked = False
     for step, should_run in zip(run_list, flags):
         if should_run:
-            if step in [min_max, SynthSeg_img, p_and_p, model_training, inference]: # These functions need extra arguments
+            # The dataset is checked once, before the first step that needs it to be consistent
+            if step in [create_json, p_and_p] and not dataset_checked:
+                check_dataset(args, logs_path)
+                dataset_checked = True
+            if step in [min_max, SynthSeg_img, create_json, p_and_p, model_training, inference]: # These functions need extra arguments
                 step(args, logs_path, log_file_path, script_dir)
             else:
                 step(args)
@@ -5,14 +5,54 @@ import subprocess
 import time
 from pathlib import Path
 
+from da_tuning import best_settings, init_calibration, load_calibration, load_tuning, save_tuning, tuned_resources
+from dataset_json import create_dataset_json
+from dataset_preflight import hash_files, run_preflight, scan_task
+from dataset_view import (COMPLETE_MARKER, DATA_DIRS, SYNTHSEG_DIRS, assemble_view, get_original_dir, get_resized_dir, get_variant_dir, get_variant_name,
+                          mark_complete, migrate_to_sources, read_view)
+from early_stopping import can_finalize, finalize_fold, plateau_status, record_early_stop, total_gpu_hours_saved
+from executors import LOCAL_DIR, LOCAL_GPUS, MAX_LOCAL_JOBS, activate_local_executor, get_executor, parse_options
+from fold_packing import choose_fold_layout, fold_groups, packed_resources
+from fold_splits import create_splits, missing_shared_artifacts
+from gpu_governor import GpuGovernor, is_job_queued
+from inference_manifest import (CASE_DICE_FILE, case_fingerprints, load_manifest, model_fingerprint, plan_inference, record_predictions, save_manifest,
+                                stage_inputs, update_evaluation, write_case_dice)
+from job_watchdog import watchdog_for
+from partition_selection import candidate_partitions, choose_partition, fill_actual_starts, log_partition_choice
+from prediction_service import (get_service_dir, get_service_job, model_settings, record_service_job, service_status, stop_service, submit_cases,
+                                wait_for_results, wait_for_service)
+from preprocess_cache import CACHE_LIMIT_GB, get_cache_dir, preprocess_key, restore, store
+from quick_eval import build_subset, init_quick_eval, print_quick_eval_trend, select_subset
+from retry_policy import RetryPolicy, get_job_end_state
+from smoke_test import (SMOKE_DIR, SMOKE_EPOCHS, SMOKE_MAX_EPOCHS, SMOKE_SYNTH_IMAGES, SmokeTest, build_smoke_task, check_augmented, check_cases,
+                        check_dataset_json, check_file, check_predictions)
+from slurm_templates import TEMPLATE_EXTENSION, gpu_count, load_profiles, render_script, render_scripts, uses_gpu
+from step_timings import init_timings, print_timing_summary, record_timing
+from training_logs import get_latest_training_log, parse_training_log
+from training_progress import TrainingMonitor, format_progress, parse_slurm_time
+
 # region ### SLURM SCRIPTS ###
-# Note: create_min_maxes.sh and SynthSeg_image_generation.sh are unchanged from v1
-SCRIPTS = [
-    "SynthSeg_image_generation_v2.sh",
-    "NnUnet_plan_and_preprocess_v2_agate.sh",
-    "NnUnetTrain_v2_agate.sh",
-    "infer_v2_agate.sh",
-    "create_min_maxes_v2.sh"
+# Each script is rendered from scripts/slurm_templates_v2/<script>.j2 using the resource profile of the step it runs
+SCRIPTS = {
+    "SynthSeg_image_generation_v2.sh": "SynthSeg_img",
+    "NnUnet_fingerprint_v2.sh": "fingerprint",
+    "NnUnet_plan_v2.sh": "plan",
+    "NnUnet_preprocess_v2.sh": "preprocess",
+    "NnUnetTrain_v2_agate.sh": "model_training",
+    "NnUnetTrain_v2_packed.sh": "model_training_packed",
+    "infer_v2_agate.sh": "inference",
+    "create_min_maxes_v2.sh": "min_max",
+    "NnUnet_calibrate_da_v2.sh": "da_calibration",
+    "quick_eval_v2.sh": "quick_eval",
+    "prediction_service_v2.sh": "prediction_service"
+}
+PRESETS_DIR = "automation_presets_v2" # resource_profiles.json overrides are stored alongside the v2 presets
+
+# Plan and preprocess runs as three CPU sub-steps; each entry is (profile/step name, script, file in nnUNet_preprocessed/<dataset> that shows the sub-step succeeded)
+PLAN_AND_PREPROCESS_STEPS = [
+    ("fingerprint", "NnUnet_fingerprint_v2.sh", "dataset_fingerprint.json"),
+    ("plan", "NnUnet_plan_v2.sh", "nnUNetPlans.json"),
+    ("preprocess", "NnUnet_preprocess_v2.sh", "nnUNetPlans_3d_fullres"),
 ]
 # endregion
 
@@ -48,44 +88,57 @@ def write_log(filepath, job_id):
  
 def is_job_running(job_id):
     '''
-    Checks if a job with the given job id is currently running in SLURM.
+    Checks if a job with the given job id is currently pending or running (in SLURM or the local executor).
     Args:
-        job_id: the SLURM job id to check
+        job_id: the job id to check
     Out: True if the job is running, False otherwise
     '''
     
-    result = subprocess.run(['squeue', '--job', str(job_id)], capture_output=True, text=True) # Check squeue output
-    return str(job_id) in result.stdout
+    return get_executor().is_queued(job_id)
  
-def wait_for_job_to_finish(job_id, fold, check_interval=60):
+def wait_for_job_to_finish(job_id, fold, check_interval=60, watchdog=None, on_poll=None):
     '''
     Waits for a SLURM job with the given job id to finish (specifically used for training and inference status updates in this program).
     Args:
         job_id: the SLURM job id to wait for
-        fold: the fold number associated with the job (1-4 for training folds, -1 for inference)
+        fold: the fold number associated with the job (0-4 for training folds, -1 for inference, anything else prints no status updates)
         check_interval: how many seconds to wait between checks
-    Out: None
+        watchdog: optional JobWatchdog the job is registered with; if it reports the job as stalled the job is cancelled
+        on_poll: optional function called on every check while the job is running (e.g. to refresh training progress)
+    Out: True if the job was cancelled by the watchdog, False if it ended on its own
     '''
     print_counter = 0
     while is_job_running(job_id):
+        if watchdog is not None and watchdog.is_stalled(job_id):
+            print(f"Cancelling stalled job {job_id}.")
+            get_executor().cancel(job_id)
+            while is_job_running(job_id):
+                time.sleep(10)
+            watchdog.forget(job_id)
+            return True
+        if on_poll is not None:
+            on_poll()
         if fold >= 0 and print_counter % 1140 == 0:
             print(f"Waiting for fold {fold} to complete training...")
         elif fold == -1 and print_counter % 60 == 0:
             print("Waiting for inference to complete...")
         print_counter += 1
         time.sleep(check_interval)
+    if watchdog is not None:
+        watchdog.forget(job_id)
+    return False
  
-def monitor_log_file(file_path, process):
+def monitor_log_file(file_path, job_id):
     '''
     Monitors the output of a log file (meant for printing output of SLURM scripts to terminal)
     Args:
         file_path: path to the log file to monitor
-        process: the subprocess object representing the running SLURM job
+        job_id: the job writing to it, the file is followed until the job ends
     Out: None
     '''
     with open(file_path, 'r') as f: 
         f.seek(0, os.SEEK_END)
-        while process.poll() is None:
+        while is_job_running(job_id):
             line = f.readline()
             if line:
                 print(line, end='')
@@ -94,16 +147,17 @@ def monitor_log_file(file_path, process):
  
 def submit_job(command, log_path, wait_file=""):
     '''
-    Submits a SLURM job given a bunch of parameters
+    Submits a job given a bunch of parameters, through the executor chosen with --executor (SLURM or local)
     Args:
-        command: list of command line arguments to submit the job, e.g. ["sbatch", "script.sh", "arg1", "arg2"]
+        command: list of command line arguments to submit the job, e.g. ["sbatch", "script.sh", "arg1", "arg2"] (with -W this returns once the job has ended)
         log_path: path to the log file where the job id will be written
         wait_file: special use case for certain steps that want to wait for a specific output file to be made before proceeding (e.g. min_maxes and synthseg steps)
     Out: the job id of the submitted job
     '''
     
-    process = subprocess.Popen(command, stdout=subprocess.PIPE) # Start the job and capture the output
-    job_id = process.stdout.readline().strip().split()[-1].decode("utf-8") # Extract the job id from the sbatch output
+    executor = get_executor()
+    options, script, script_args = parse_options(command[1:])
+    job_id = executor.submit(script, script_args, command[1:len(command) - len(script_args) - 1])
     write_log(log_path, job_id)
  
     file = None # Special case bug fixes
@@ -115,10 +169,11 @@ def submit_job(command, log_path, wait_file=""):
     if file:
         if not wait_for_file(file):
             print(f"Timeout waiting for {file}. Canceling job {job_id}.")
-            subprocess.run(["scancel", job_id])
+            executor.cancel(job_id)
             exit(1)
-        monitor_log_file(file, process)
-    process.wait()
+        monitor_log_file(file, job_id)
+    if options.get("wait"):
+        executor.wait(job_id)
     return job_id
  
 def check_complete(err_path, fold):
@@ -154,21 +209,21 @@ def move_matching_files(src: Path, dst: Path, pattern: str):
         if pattern in file:
             shutil.move(Path(src) / file, Path(dst) / file)
  
-def set_up_slurm_scripts(task_logs: Path, all_slurm: Path):
+def set_up_slurm_scripts(task_logs: Path, script_dir: Path, profiles):
     '''
     Sets up SLURM scripts for the training pipeline
     Args:
-        task_logs: the directory where task logs will be stored (and where the SLURM scripts will be copied to)
-        all_slurm: the directory containing all SLURM scripts
+        task_logs: the directory where task logs will be stored (and where the SLURM scripts will be rendered to)
+        script_dir: the path to the directory where this script lives (holds the SLURM script templates and the helpers the jobs run)
+        profiles: the per-step resource profiles used to fill in the templates
     Out: None
     '''
     
-    # Copies SLURM scripts to the correct task log folder
+    # Renders SLURM scripts into the correct task log folder
     task_logs.mkdir(parents=True, exist_ok=True)
-    for script in SCRIPTS:
-        dest = task_logs / script
-        shutil.copyfile(all_slurm / script, dest)
+    render_scripts(get_template_dir(script_dir), task_logs, SCRIPTS, profiles, script_dir=script_dir)
     (task_logs / "active_jobs.txt").write_text("") # Create an empty log file to store active job ids
+    init_timings(task_logs) # Timings are kept across runs so different resource configurations can be compared
  
 def get_dataset_folder(task_number, dataset_name):
     # Returns the v2 dataset folder name, e.g. Dataset645_AnomalousInfant
@@ -181,7 +236,34 @@ def get_nnunet_raw(raw_data_base_path):
 def get_nnunet_preprocessed(raw_data_base_path):
     # In v2, nnUNet_preprocessed lives directly under the base path
     return str(Path(raw_data_base_path) / "nnUNet_preprocessed")
+
+def export_nnunet_paths(args):
+    # Exports the paths SynthSeg, the dcan scripts and nnUNet read from the environment (the SLURM jobs inherit them)
+    os.environ.update({
+        "PYTHONPATH": f"{args.synth_path}:{Path(args.synth_path) / 'SynthSeg'}:{args.dcan_path}:{Path(args.dcan_path) / 'dcan'}",
+        "nnUNet_raw": get_nnunet_raw(args.raw_data_base_path),
+        "nnUNet_preprocessed": get_nnunet_preprocessed(args.raw_data_base_path),
+        "nnUNet_results": args.trained_models_path
+    })
+
+def get_lut_path(args):
+    # Returns the FreeSurfer style look-up table in the dcan repo that label values and names come from
+    return Path(args.dcan_path) / "look_up_tables" / "Freesurfer_LUT_DCAN.txt"
+
+def get_min_max_path(args, script_dir):
+    # Returns where the min maxes for SynthSeg are written, smoke tests keep theirs in the smoke folder so the real ones aren't replaced
+    folder = Path(args.smoke_root) if args.smoke_root else Path(script_dir) / "min_maxes"
+    return folder / f"mins_maxes_{get_dataset_folder(args.task_number, args.dataset_name)}.npy"
  
+def get_preprocess_key(args, logs_path, script_dir):
+    # Key of the task's preprocessed output in the shared cache: the training cases' contents, dataset.json and the plan and preprocess commands, None if there is no dataset.json yet
+    dataset_json_path = Path(args.task_path) / "dataset.json"
+    if not dataset_json_path.exists():
+        return None
+    templates = {script: (get_template_dir(script_dir) / (script + TEMPLATE_EXTENSION)).read_text() for _, script, _ in PLAN_AND_PREPROCESS_STEPS}
+    index = hash_files(scan_task(args.task_path, logs_path), logs_path, ("imagesTr", "labelsTr")) # the training cases are only hashed when the cache needs them
+    return preprocess_key(index, dataset_json_path, {"templates": templates, "nnunet": str(Path(args.dcan_path).resolve())})
+
 def get_training_log_path(logs_path, task_number, fold, job_id):
     # Returns the v2 training log path (the .out file for specific fold and job id)
     return logs_path / f"Train_{fold}_{task_number}_nnUNetv2-{job_id}.out"
@@ -200,16 +282,9 @@ def get_fold_dir(trained_models_path, task_number, dataset_name, fold):
         trained_models_path / dataset_folder / "nnUNetTrainerNoMirroring__nnUNetPlans__3d_fullres" / f"fold_{fold}"
     )
  
-def get_latest_training_log(fold_dir):
-    # Returns the most recently modified training_log file in the dir, used to distinguish the specific training log to check for fold 0 setup completion in case there are multiple training logs in the fold directory for some reason (e.g. from multiple failed training attempts)
-    if not fold_dir.exists():
-        return None
- 
-    logs = [p for p in fold_dir.iterdir() if p.is_file() and p.name.startswith("training_log")]
-    if not logs:
-        return None
- 
-    return max(logs, key=lambda p: p.stat().st_mtime)
+def is_fold_finished(args, fold):
+    # A fold is finished once nnUNet has written its final checkpoint
+    return (get_fold_dir(args.trained_models_path, args.task_number, args.dataset_name, fold) / "checkpoint_final.pth").exists()
  
 def file_has_epoch0(out_file):
     '''
@@ -253,7 +328,7 @@ def is_training_ready(out_file, trained_models_path, task_number, dataset_name):
  
     return False
  
-def wait_fold_0_setup(out_file, err_file, trained_models_path, task_number, dataset_name):
+def wait_fold_0_setup(out_file, err_file, trained_models_path, task_number, dataset_name, job_id=None):
     '''
     Waits for fold 0 to complete its initial setup before allowing the training pipeline to continue (fold 0 has to complete setup before launching training on other folds or else there will be errors)
     Args:
@@ -262,32 +337,103 @@ def wait_fold_0_setup(out_file, err_file, trained_models_path, task_number, data
         trained_models_path: base path to the nnUNet_results directory where fold directories and backup training logs are stored (used as a backup check for fold 0 setup completion in case the training log files aren't being written for some reason)
         task_number: the task number of the dataset
         dataset_name: the name of the dataset
-    Out: None
+        job_id: the fold 0 SLURM job id, used to notice the job ending before setup finished
+    Out: True once setup is complete, False if fold 0 failed during setup (so the caller can apply the retry policy)
     '''
     print_counter = 0
     while not is_training_ready(out_file, trained_models_path, task_number, dataset_name):
         if err_file.exists():
             with err_file.open() as f:
-                if any("Error" in line for line in f): # Check for any error messages in the fold 0 error log and exit if any are found to avoid waiting indefinitely for fold 0 setup to complete
+                if any("Error" in line for line in f): # Check for any error messages in the fold 0 error log to avoid waiting indefinitely for fold 0 setup to complete
                     print("Error detected in training log.")
-                    exit(1)
+                    return False
+        if job_id and not is_job_running(job_id) and not is_training_ready(out_file, trained_models_path, task_number, dataset_name):
+            print("Fold 0 ended before finishing setup.")
+            return False
         if print_counter % 30 == 0:
             print("Setup in progress...")
         print_counter += 1
         time.sleep(60)
+    return True
  
 def get_job_id_from_squeue(job_name):
     '''
-    Gets the job id of a currently running job with the specified name by parsing the output of squeue
+    Gets the job id of a currently queued job with the specified name (from squeue, or the local executor's queue)
     Args:
         job_name: the name of the job to look for in squeue (e.g. "12345_0_Train_nnUNetv2")
     Out: the job id associated with the job name if found, None otherwise
     '''
-    result = subprocess.run(['squeue', '--name', job_name, '--format', '%.18i'], capture_output=True, text=True)
-    lines = result.stdout.strip().splitlines()
-    if len(lines) > 1:
-        return lines[1].strip()
-    return None
+    return get_executor().find_job(job_name)
+ 
+def get_profiles(script_dir):
+    # Returns the per-step resource profiles (defaults plus any overrides saved alongside the v2 presets)
+    return load_profiles(Path(script_dir) / PRESETS_DIR)
+ 
+def staging_steps(step):
+    # Timing rows of a step that can run on node-local scratch: the direct I/O run, then the stage-in, the staged run and the stage-out
+    return [step, f"{step}_stage_in", f"{step}_staged", f"{step}_stage_out"]
+
+def get_template_dir(script_dir):
+    # Returns the folder holding the v2 SLURM script templates
+    return Path(script_dir) / "scripts" / "slurm_templates_v2"
+ 
+def prepare_submission(logs_path, script_dir, script, overrides=None, tuning=None):
+    '''
+    Picks the candidate partition with the earliest estimated start for the step a script runs (sbatch --test-only) and re-renders the script in the task log folder for that partition
+    Args:
+        logs_path: the task log folder the script is submitted from
+        script_dir: the path to the directory where this script lives
+        script: the name of the rendered SLURM script, e.g. "NnUnetTrain_v2_agate.sh"
+        overrides: resource profile fields to change for this submission (e.g. more memory after an out-of-memory retry)
+        tuning: dictionary mapping partition to extra profile fields that only apply once that partition is chosen (e.g. tuned augmentation workers)
+    Out: (the step's resource profile with the chosen partition, dictionary of start estimates per probed partition)
+    '''
+    step = SCRIPTS[script]
+    profile = {**get_profiles(script_dir)[step], **(overrides or {})}
+    partition, estimates = choose_partition(profile)
+    profile = {**profile, "partition": partition, **(tuning or {}).get(partition, {})}
+    render_script(get_template_dir(script_dir), script + TEMPLATE_EXTENSION, Path(logs_path) / script, profile, step=step, script_dir=script_dir)
+    return profile, estimates
+ 
+def get_governor(args, script_dir):
+    # Returns the GPU governor shared by every pipeline running from this checkout, identified by this pipeline's dataset folder
+    return GpuGovernor(script_dir, get_dataset_folder(args.task_number, args.dataset_name), args.priority)
+ 
+def acquire_gpu_slot(governor, profile):
+    # Only steps whose resource profile requests a GPU are held back by the governor, and they hold one slot per GPU (a packed job takes one per fold)
+    return governor.acquire(profile["partition"], gpu_count(profile)) if uses_gpu(profile) else None
+ 
+def submit_with_retries(logs_path, log_file_path, script_dir, script, script_args, governor, wait_file=""):
+    '''
+    Submits a blocking (sbatch -W) step and resubmits it according to the retry policy (more memory after OUT_OF_MEMORY, excluded node after NODE_FAIL, backoff, per-state budgets) until it completes
+    Args:
+        logs_path: the task log folder the script is submitted from
+        log_file_path: the path to the log file where the active job ids are stored
+        script_dir: the path to the directory where this script lives
+        script: the name of the rendered SLURM script
+        script_args: the positional arguments passed to the script
+        governor: the GPU governor (only used if the step's profile requests a GPU)
+        wait_file: passed through to submit_job
+    Out: the job id of the run that completed. Exits the pipeline once the retry budget is used up
+    '''
+    policy = RetryPolicy()
+    step = SCRIPTS[script]
+    while True:
+        profile, estimates = prepare_submission(logs_path, script_dir, script, policy.overrides_for(script))
+        ticket = acquire_gpu_slot(governor, profile)
+        time.sleep(3)
+        job_id = submit_job(["sbatch", "-W", str(Path(logs_path) / script)] + script_args, log_file_path, wait_file)
+        governor.release(ticket) # sbatch -W has already waited for the job to end
+        log_partition_choice(logs_path, step, job_id, profile["partition"], estimates)
+ 
+        end_state = get_job_end_state(job_id)
+        if end_state is None or end_state["state"] == "COMPLETED": # No accounting record means there is nothing to act on, carry on as before
+            return job_id
+        action = policy.next_action(script, end_state, get_profiles(script_dir)[step])
+        if action is None:
+            print(f"ERROR: {step} job {job_id} ended with state {end_state['state']}")
+            exit(1)
+        time.sleep(action["delay"])
  
 # endregion
 
@@ -296,7 +442,8 @@ def get_job_id_from_squeue(job_name):
 ### Resize Images ###
 def resize_images(args):
     '''
-    Resizes images to the correct dimensions for nnUNet v2 training using the resize_images.py script from the dcan repo
+    Resizes images to the correct dimensions for nnUNet v2 training using the resize_images.py script from the dcan repo.
+    The original cases are kept in sources/original and the resized ones are written to sources/resized_<model_type>, then imagesTr/labelsTr/imagesTs/labelsTs are rebuilt as links to them (see dataset_view.py)
     Args:
         args: the command line arguments passed to the program
     Out: None
@@ -305,23 +452,40 @@ def resize_images(args):
     print("--- Now Resizing Images ---")
     task_path = Path(args.task_path)
     resize_script = str(Path(args.dcan_path) / "dcan" / "img_preproc" / "resize_images.py")
-    data_dirs = ["imagesTr", "imagesTs", "labelsTr", "labelsTs"]
- 
-    for dir_name in data_dirs:
-        curr_dir = task_path / dir_name
-        old_dir = task_path / f"Old_{dir_name}"
- 
-        # Rename current dir to Old_xxx
-        curr_dir.rename(old_dir)
-        curr_dir.mkdir(exist_ok=True)
+    original_dir = migrate_to_sources(task_path)
+    resized_dir = get_resized_dir(task_path, args.model_type)
  
-        print(f"Resizing {dir_name}...")
-        subprocess.run(["python", resize_script, str(old_dir), str(curr_dir), f"--model={args.model_type}"])
- 
-        # Remove the Old_ directory once resize is complete
-        shutil.rmtree(old_dir)
+    if (resized_dir / COMPLETE_MARKER).exists():
+        print(f"Images were already resized for {args.model_type} in {resized_dir}, reusing them")
+    else:
+        # Resize into a temporary folder so an interrupted resize is never mistaken for a complete one
+        tmp_dir = resized_dir.with_name(resized_dir.name + ".tmp")
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        for dir_name in DATA_DIRS:
+            if not (original_dir / dir_name).exists():
+                continue
+            (tmp_dir / dir_name).mkdir(parents=True)
+            print(f"Resizing {dir_name}...")
+            result = subprocess.run(["python", resize_script, str(original_dir / dir_name), str(tmp_dir / dir_name), f"--model={args.model_type}"])
+            if result.returncode != 0:
+                print(f"ERROR: resizing {dir_name} failed, the original images in {original_dir} are unchanged")
+                exit(1)
+        if resized_dir.exists():
+            shutil.rmtree(resized_dir)
+        tmp_dir.rename(resized_dir)
+        mark_complete(resized_dir)
  
+    # The SynthSeg images are added back by copy_SynthSeg
+    view = assemble_view(task_path, args.model_type)
+    print(f"Linked {view['links']} resized files into {task_path}")
     print("--- Images Resized ---")
+
+def use_real_cases(args):
+    # Makes sure imagesTr/labelsTr only hold the real cases (no SynthSeg set) before min maxes are computed or new images are generated from them
+    view = read_view(args.task_path)
+    if view is None or view["variant"] is not None:
+        assemble_view(args.task_path, args.model_type)
     
 ### Min Maxes ###
 def min_max(args, logs_path, log_file_path, script_dir):
@@ -335,10 +499,14 @@ def min_max(args, logs_path, log_file_path, script_dir):
     Out: None
         '''
     print("--- Now Creating Min Maxes ---")
+    use_real_cases(args)
     os.chdir(logs_path)
     time.sleep(3)
-    output_path = Path(script_dir) / "min_maxes" / f"mins_maxes_{get_dataset_folder(args.task_number, args.dataset_name)}.npy"
-    submit_job(["sbatch", "-W", str(logs_path / "create_min_maxes_v2.sh"), args.synth_path, args.task_path, str(output_path)], log_file_path, "min_maxes")
+    output_path = get_min_max_path(args, script_dir)
+    submit_with_retries(logs_path, log_file_path, script_dir, "create_min_maxes_v2.sh",
+                        [args.synth_path, args.task_path, str(output_path)], get_governor(args, script_dir), "min_maxes")
+    fill_actual_starts(logs_path)
+    print_timing_summary(logs_path, staging_steps("min_max"))
     print("--- Min Maxes Created ---")
     
 ### SynthSeg Image Creation ###
@@ -353,24 +521,26 @@ def SynthSeg_img(args, logs_path, log_file_path, script_dir):
     Out: None
     '''
     print("--- Now Creating Synthetic Images ---")
+    use_real_cases(args)
     os.chdir(logs_path)
     time.sleep(3)
-    output_path = Path(script_dir) / "min_maxes" / f"mins_maxes_{get_dataset_folder(args.task_number, args.dataset_name)}.npy"
-    submit_job([
-        "sbatch", "-W",
-        str(logs_path / "SynthSeg_image_generation_v2.sh"),
+    output_path = get_min_max_path(args, script_dir)
+    submit_with_retries(logs_path, log_file_path, script_dir, "SynthSeg_image_generation_v2.sh", [
         args.synth_path, args.task_path, str(output_path),
         args.synth_img_amt,
         f"--modalities={args.modality}",
         f"--distribution={args.distribution}",
         args.task_number
-    ], log_file_path, "synthseg")
+    ], get_governor(args, script_dir), "synthseg")
+    fill_actual_starts(logs_path)
+    print_timing_summary(logs_path, staging_steps("SynthSeg_img"))
     print("--- SynthSeg Images Generated ---")
     
 ### Moving Over SynthSeg Images ###
 def copy_SynthSeg(args):
     '''
-    Copies the SynthSeg generated images from the output folder to the correct imagesTr and labelsTr folders for nnUNet training, also moves any files that were misplaced in the wrong folders by the SynthSeg script (bug fixes)
+    Stores the SynthSeg generated images as a generation set in sources/synthseg/<modality>_<distribution>_<synth_img_amt> (also moving any files that were misplaced in the wrong folders by the SynthSeg script, bug fixes),
+    then links that set into imagesTr and labelsTr next to the real cases. If nothing new was generated, switches to a set stored by an earlier run
     Args:
         args: the command line arguments passed to the program
     Out: None
@@ -379,42 +549,85 @@ def copy_SynthSeg(args):
     print("--- Now Moving Over SynthSeg Generated Images ---")
     util_dir = Path(args.dcan_path) / "dcan" / "util"
     task_path = Path(args.task_path)
+    generated_dir = task_path / "SynthSeg_generated"
+    variant = get_variant_name(args.modality, args.distribution, args.synth_img_amt)
+    variant_dir = get_variant_dir(task_path, variant)
+ 
+    if generated_dir.exists():
+        tmp_dir = variant_dir.with_name(variant_dir.name + ".tmp")
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        for dir_name in SYNTHSEG_DIRS:
+            (tmp_dir / dir_name).mkdir(parents=True)
+ 
+        # Initial copy over
+        for source in ("images", "labels"):
+            subprocess.run(["python", str(util_dir / "copy_over_augmented_image_files.py"),
+                str(generated_dir / source),
+                str(tmp_dir / "imagesTr"),
+                str(tmp_dir / "labelsTr")])
  
-    # Initial copy over
-    subprocess.run(["python", str(util_dir / "copy_over_augmented_image_files.py"),
-        str(task_path / "SynthSeg_generated" / "images"),
-        str(task_path / "imagesTr"),
-        str(task_path / "labelsTr")])
-    subprocess.run(["python", str(util_dir / "copy_over_augmented_image_files.py"),
-        str(task_path / "SynthSeg_generated" / "labels"),
-        str(task_path / "imagesTr"),
-        str(task_path / "labelsTr")])
- 
-    # Move any files that were misplaced in the wrong folders by the SynthSeg script (bug fixes)
-    move_matching_files(task_path / "imagesTr", task_path / "labelsTr", "_SynthSeg_generated_0000.nii.gz")
-    move_matching_files(task_path / "imagesTr", task_path / "labelsTr", "_SynthSeg_generated_0001.nii.gz")
- 
-    # Remove the SynthSeg_generated folder once all files have been moved
-    if (task_path / "SynthSeg_generated").exists():
-        shutil.rmtree(task_path / "SynthSeg_generated")
+        # Move any files that were misplaced in the wrong folders by the SynthSeg script (bug fixes)
+        move_matching_files(tmp_dir / "imagesTr", tmp_dir / "labelsTr", "_SynthSeg_generated_0000.nii.gz")
+        move_matching_files(tmp_dir / "imagesTr", tmp_dir / "labelsTr", "_SynthSeg_generated_0001.nii.gz")
+ 
+        # Replace any earlier set with the same settings, then remove the SynthSeg_generated folder once all files have been moved
+        if variant_dir.exists():
+            shutil.rmtree(variant_dir)
+        tmp_dir.rename(variant_dir)
+        shutil.rmtree(generated_dir)
+    else:
+        print(f"No newly generated images in {generated_dir}, using the stored SynthSeg set {variant}")
+ 
+    try:
+        view = assemble_view(task_path, args.model_type, variant)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        exit(1)
+    print(f"Linked {view['links']} files ({view['base']} cases + SynthSeg set {variant}) into {task_path}")
     print("--- Images Moved ---")
     
+### Checking the Dataset ###
+def check_dataset(args, logs_path):
+    '''
+    Pre-flight check of every image and label header in the task (shapes, spacing, orientation, channels for the modality, label values against the LUT) before the dataset JSON is written or plan and preprocess is queued. Results are kept in logs/<Dataset>/dataset_index.json so unchanged files aren't read again
+    Args:
+        args: the command line arguments passed to the program
+        logs_path: the task log folder
+    Out: None, exits if the dataset has problems
+    '''
+    problems = run_preflight(args.task_path, logs_path, args.modality, get_lut_path(args))
+    if problems:
+        print(f"ERROR: {len(problems)} dataset problem(s) found, fix them before running the remaining steps")
+        exit(1)
+ 
 ### Creating Dataset JSON ###
-def create_json(args):
+def create_json(args, logs_path, log_file_path, script_dir):
     '''
-    Creates the dataset JSON file needed for nnUNet training using the dataset conversion script from the dcan repo
+    Creates the dataset JSON file needed for nnUNet training from the dataset index (channels from the modality, label names from the LUT). Datasets whose labels need remapping to consecutive values fall back to their conversion script in the dcan repo
     Args:
         args: the command line arguments passed to the program
+        logs_path: the task log folder (where the dataset index is kept)
+        log_file_path: not used, kept so every SLURM-aware step has the same arguments
+        script_dir: not used, kept so every SLURM-aware step has the same arguments
     Out: None
     '''
     
     print("--- Now Creating Dataset JSON ---")
     dataset_folder = get_dataset_folder(args.task_number, args.dataset_name)
-    conversion_script = Path(args.dcan_path) / "dcan" / "dataset_conversion" / f"{dataset_folder}.py"
+    try:
+        json_path = create_dataset_json(args.task_path, logs_path, 2, dataset_folder, args.modality, get_lut_path(args))
+        print(f"Wrote {json_path}")
+        print("--- Dataset JSON Created ---")
+        return
+    except ValueError as e:
+        error = e
  
+    conversion_script = Path(args.dcan_path) / "dcan" / "dataset_conversion" / f"{dataset_folder}.py"
     if not conversion_script.exists():
-        print(f"ERROR: Dataset conversion script not found: {conversion_script}")
+        print(f"ERROR: Can't create dataset.json ({error}) and there is no dataset conversion script at {conversion_script}")
         exit(1)
+    print(f"Can't create dataset.json directly ({error}), running {conversion_script.name}")
  
     # Don't think this is necassary but just in case, export the nnUNet paths here as well for the conversion script to use
     env = os.environ.copy()
@@ -430,109 +643,425 @@ def create_json(args):
 ### Plan and Preprocess ###
 def p_and_p(args, logs_path, log_file_path, script_dir):
     '''
-    Runs the preliminary plan and preprocess step of nnUNet v2 by submitting a SLURM job to run the NnUnet_plan_and_preprocess_v2_agate.sh script
+    Runs the preliminary plan and preprocess step of nnUNet v2 as three SLURM jobs (fingerprint extraction, experiment planning and preprocessing) so each can run on a CPU partition sized for it. Each sub-step's runtime is recorded in step_timings.csv
     Args:
         args: the command line arguments passed to the program
         logs_path: the path to the logs directory where the SLURM script is located and where the job out and err files will be written
         log_file_path: the path to the log file where the active job ids are stored
-        script_dir: the path to the directory where this script lives (Not actually used in this function but included for consistency with other functions)
+        script_dir: the path to the directory where this script lives (used for the resource profiles and the shared GPU governor state)
     Out: None
     '''
     
     print("--- Now Running Plan and Preprocess ---")
     os.chdir(logs_path)
-    time.sleep(3)
-    submit_job([
-        "sbatch", "-W",
-        str(logs_path / "NnUnet_plan_and_preprocess_v2_agate.sh"),
-        "faird",
-        args.dcan_path,
-        args.task_number,
-        get_nnunet_raw(args.raw_data_base_path),
-        get_nnunet_preprocessed(args.raw_data_base_path),
-        args.trained_models_path
-    ], log_file_path)
+    governor = get_governor(args, script_dir)
+    dataset_folder = get_dataset_folder(args.task_number, args.dataset_name)
+    preprocessed_dir = Path(get_nnunet_preprocessed(args.raw_data_base_path)) / dataset_folder
+    cache_dir = get_cache_dir(args.raw_data_base_path)
+    key = get_preprocess_key(args, logs_path, script_dir) if args.preprocess_cache else None
+ 
+    # The same training cases, dataset.json and nnUNet configuration were already preprocessed (e.g. under another task number), link that output into place
+    if key is not None:
+        start = time.time()
+        entry = restore(cache_dir, key, preprocessed_dir, dataset_folder, Path(args.task_path) / "dataset.json")
+        if entry is not None:
+            record_timing(logs_path, "preprocess_cache", time.time() - start)
+            print(f"Reused the preprocessed data of {entry['dataset']} from {cache_dir / key} ({entry['size'] / 1e9:.1f} GB linked in {time.time() - start:.0f} s)")
+            create_splits(preprocessed_dir)
+            print("--- Finished Plan and Preprocessing ---")
+            return
+ 
+    # The task's folder may hold hard links into a cache entry (restored or stored by an earlier run). nnUNet rewrites the plans, fingerprint and gt_segmentations in place, so start from an empty folder instead of writing through the links into the cache
+    if preprocessed_dir.exists():
+        shutil.rmtree(preprocessed_dir)
+ 
+    for step, script, expected_output in PLAN_AND_PREPROCESS_STEPS:
+        print(f"Running {step}...")
+        submit_with_retries(logs_path, log_file_path, script_dir, script, [
+            args.dcan_path,
+            args.task_number,
+            get_nnunet_raw(args.raw_data_base_path),
+            get_nnunet_preprocessed(args.raw_data_base_path),
+            args.trained_models_path
+        ], governor)
+ 
+        # Stop here instead of letting the next sub-step fail on missing inputs
+        if not (preprocessed_dir / expected_output).exists():
+            print(f"ERROR: {step} did not produce {preprocessed_dir / expected_output}")
+            exit(1)
+ 
+    # Keep the output for tasks with the same inputs before the task specific splits are written
+    if key is not None:
+        evicted = store(cache_dir, key, preprocessed_dir, dataset_folder, args.cache_limit_gb)
+        print(f"Added the preprocessed data to the cache in {cache_dir}{f', evicted {len(evicted)} old entries' if evicted else ''}")
+ 
+    # Write the fold splits now so every training fold can be queued at once
+    create_splits(preprocessed_dir)
+ 
+    fill_actual_starts(logs_path)
+    print_timing_summary(logs_path, [step for step, _, _ in PLAN_AND_PREPROCESS_STEPS] + ["unpack"])
     print("--- Finished Plan and Preprocessing ---")
     
+### Calibrating Augmentation Workers ###
+def calibrate_da(args, logs_path, log_file_path, script_dir):
+    '''
+    Measures training speed for several augmentation worker counts (nnUNet_n_proc_DA) and CPU allocations on each candidate training partition, and caches the fastest setting for this dataset so training jobs request matching CPUs and export the tuned worker count
+    Args:
+        args: the command line arguments passed to the program
+        logs_path: the path to the logs directory where the SLURM script is located and where the job out and err files will be written
+        log_file_path: the path to the log file where the active job ids are stored
+        script_dir: the path to the directory where this script lives
+    Out: None
+    '''
+    print("--- Calibrating Augmentation Workers ---")
+    os.chdir(logs_path)
+    profile = get_profiles(script_dir)["da_calibration"]
+    governor = get_governor(args, script_dir)
+    init_calibration(logs_path)
+ 
+    # One short job per (partition, CPU count); the partition and CPUs given to sbatch override the ones in the script
+    jobs = []
+    for partition in candidate_partitions(profile):
+        for cpus in profile["calibration_cpus"]:
+            ticket = acquire_gpu_slot(governor, {**profile, "partition": partition})
+            job_id = submit_job([
+                "sbatch", "-p", partition, f"--ntasks={cpus}",
+                str(logs_path / "NnUnet_calibrate_da_v2.sh"),
+                args.dcan_path,
+                args.task_number,
+                get_nnunet_raw(args.raw_data_base_path),
+                get_nnunet_preprocessed(args.raw_data_base_path)
+            ], log_file_path)
+            governor.attach(ticket, job_id)
+            jobs.append((job_id, ticket))
+    print(f"Waiting for {len(jobs)} calibration jobs...")
+    for job_id, ticket in jobs:
+        wait_for_job_to_finish(job_id, -2)
+        governor.release(ticket)
+ 
+    settings = best_settings(load_calibration(logs_path))
+    if not settings:
+        print("No calibration run finished, training keeps the default augmentation workers.")
+        return
+    save_tuning(script_dir, get_dataset_folder(args.task_number, args.dataset_name), settings)
+    for partition, setting in settings.items():
+        print(f"{partition} ({setting['gpu']}): {setting['workers']} augmentation workers on {setting['cpus']} CPUs -> {setting['iters_per_sec']:.2f} iterations/s")
+    print("--- Finished Calibrating Augmentation Workers ---")
+ 
 ### Training Model ###
 def model_training(args, logs_path, log_file_path, script_dir):
     '''
-    Runs 5 folds of nnUNet v2 training by submitting SLURM jobs to run the NnUnetTrain_v2_agate.sh script, uses your Tr data folders
+    Runs 5 folds of nnUNet v2 training by submitting SLURM jobs to run the NnUnetTrain_v2_agate.sh script (one fold per job) or the NnUnetTrain_v2_packed.sh script (several folds per multi-GPU job), uses your Tr data folders
     Args:
         args: the command line arguments passed to the program
         logs_path: the path to the logs directory where the SLURM script is located and where the job out and err files will be written
         log_file_path: the path to the log file where the active job ids are stored
-        script_dir: the path to the directory where this script lives (Not actually used in this function but included for consistency with other functions)
+        script_dir: the path to the directory where this script lives (used for the shared GPU governor state)
     Out: None
     '''
     print("--- Now Running NnUNet v2 Training ---")
     os.chdir(logs_path)
-    job_ids = [None, None, None, None, None]
-    complete = [False, False, False, False, False]
+    profiles = get_profiles(script_dir)
+    jobs = {} # (folds trained by the job, ...) -> {"job_id", "ticket"} for every job that is queued or running, including the one the loop is waiting on
+    stopped_early = set() # folds whose EMA pseudo-Dice plateaued and were stopped with their best checkpoint as the final one
+    stalled_jobs = set() # jobs the watchdog cancelled
+    quick_evals = {"last_round": 0, "checkpoints": {}} # when the last round of quick evaluations was submitted, and the checkpoint (name, mtime) each fold was last evaluated on
+    governor = get_governor(args, script_dir)
+    policy = RetryPolicy()
+    watchdog = watchdog_for(profiles["model_training"])
+    layout = args.fold_layout if args.fold_layout != "auto" else choose_fold_layout(profiles)
+    if args.calibrate_da:
+        calibrate_da(args, logs_path, log_file_path, script_dir)
+        os.chdir(logs_path)
+    tuning = load_tuning(script_dir, get_dataset_folder(args.task_number, args.dataset_name)) # tuned augmentation workers/CPUs per partition, if calibrated
+    folds_per_job = profiles["model_training_packed"]["folds_per_job"]
+    monitor = TrainingMonitor(
+        logs_path, args.task_number,
+        {f: get_fold_dir(args.trained_models_path, args.task_number, args.dataset_name, f) for f in range(5)},
+        parse_slurm_time(profiles["model_training"]["time"]) - profiles["model_training"].get("requeue_signal_lead", 0), # jobs save and requeue this long before their time limit
+        lambda: {f: job["job_id"] for folds, job in jobs.items() for f in folds}
+    )
  
     nnunet_raw = get_nnunet_raw(args.raw_data_base_path)
     nnunet_preprocessed = get_nnunet_preprocessed(args.raw_data_base_path)
  
-    # Defines the command to submit a training job for a specific fold, with an optional continue flag for re-submitting folds that hit the time limit
-    def _train_cmd(fold, continue_flag=""):
+    # Defines the command to submit a training job for one fold (or several packed folds), with an optional continue flag for re-submitting folds that hit the time limit
+    def _train_cmd(folds, continue_flag=""):
+        script = "NnUnetTrain_v2_agate.sh" if len(folds) == 1 else "NnUnetTrain_v2_packed.sh"
         cmd = [
             "sbatch", "-W",
-            str(logs_path / "NnUnetTrain_v2_agate.sh"),
-            str(fold),                 # $1 fold
-            "faird",                   # $2 account
-            args.task_number,          # $3 dataset task number
-            args.dcan_path,            # $4 dcan_path
-            nnunet_raw,                # $5 nnUNet_raw
-            nnunet_preprocessed,       # $6 nnUNet_preprocessed
-            args.trained_models_path   # $7 nnUNet_results
+            str(logs_path / script),
+            ",".join(str(f) for f in folds), # $1 fold(s)
+            args.task_number,          # $2 dataset task number
+            args.dcan_path,            # $3 dcan_path
+            nnunet_raw,                # $4 nnUNet_raw
+            nnunet_preprocessed,       # $5 nnUNet_preprocessed
+            args.trained_models_path   # $6 nnUNet_results
         ]
         if continue_flag:
-            cmd.append(continue_flag)  # $8 --c (optional)
+            cmd.append(continue_flag)  # $7 --c (optional)
         return cmd
  
-    # Start fold 0 and wait for initial setup to complete before launching remaining folds
-    time.sleep(3)
-    submit_job(_train_cmd(0), log_file_path)
-    job_ids[0] = get_job_id_from_squeue(f"{args.task_number}_0_Train_nnUNetv2")
-    wait_fold_0_setup(
-        get_training_log_path(logs_path, args.task_number, 0, job_ids[0]),
-        get_training_error_path(logs_path, args.task_number, 0, job_ids[0]),
-        args.trained_models_path,
-        args.task_number,
-        args.dataset_name
-    )
-    print("Begin training Fold 0")
+    # Refreshes the per-fold progress file the GUI reads and prints the ETAs (rate limited by the monitor)
+    def _report_progress():
+        summaries = monitor.update()
+        if summaries is None:
+            return
+        print(format_progress({"folds": summaries}))
+        if args.early_stopping:
+            _stop_plateaued_folds(summaries)
+        if args.quick_eval:
+            _submit_quick_evals()
+        latest = monitor.latest_eta(summaries)
+        if latest is not None:
+            print(f"All folds expected to finish by {time.strftime('%Y-%m-%d %H:%M', time.localtime(latest))}")
  
-    # Launch folds 1-4 after the initial setup, they will be automatically stopped if they hit the time limit and can be re-submitted with the continue flag
-    for i in range(1, 5):
-        print(f"Begin training Fold {i}")
+    # Checks every queued fold job for stalls, not only the one the loop is waiting on, so a quiet job is cancelled when it goes quiet rather than when its turn comes
+    def _cancel_stalled_jobs():
+        for job in list(jobs.values()):
+            if job["job_id"] not in stalled_jobs and watchdog.is_stalled(job["job_id"]):
+                print(f"Cancelling stalled job {job['job_id']}.")
+                get_executor().cancel(job["job_id"])
+                stalled_jobs.add(job["job_id"])
+
+    # Runs on every check while the loop waits on a job
+    def _on_poll():
+        _cancel_stalled_jobs()
+        _report_progress()
+
+    # Cancels jobs whose folds have all plateaued (a packed job is only stopped once every fold in it has) and marks those folds complete
+    def _stop_plateaued_folds(summaries):
+        profile = profiles["model_training"]
+        for folds, job in list(jobs.items()):
+            running = [f for f in folds if not is_fold_finished(args, f)]
+            statuses = {f: plateau_status(summaries[f]["series"], profile["plateau_patience"], profile["plateau_min_delta"], profile["plateau_min_epochs"]) for f in running}
+            if not running or not all(s and s["plateaued"] for s in statuses.values()):
+                continue
+            fold_dirs = {f: get_fold_dir(args.trained_models_path, args.task_number, args.dataset_name, f) for f in running}
+            if not all(can_finalize(d) for d in fold_dirs.values()):
+                continue
+            get_executor().cancel(job["job_id"])
+            while is_job_running(job["job_id"]):
+                time.sleep(10)
+            for f in running:
+                if finalize_fold(fold_dirs[f]):
+                    stopped_early.add(f)
+                    eta = summaries[f]["eta"]
+                    saved = record_early_stop(logs_path, f, job["job_id"], statuses[f], eta["num_epochs"], eta["epoch_time"])
+                    print(f"Fold {f} plateaued (best EMA pseudo-Dice {statuses[f]['best_ema']} at epoch {statuses[f]['best_epoch']}, now epoch {statuses[f]['epoch']}), stopped early saving ~{saved:.1f} GPU hours")
+ 
+    # Every few hours, submits a quick evaluation for each fold that has written a new checkpoint since its last one, and reports the Dice trend so far
+    def _submit_quick_evals():
+        profile = profiles["quick_eval"]
+        if time.time() - quick_evals["last_round"] < profile["interval"]:
+            return
+        quick_evals["last_round"] = time.time()
+        print_quick_eval_trend(logs_path, range(5))
+ 
+        subset_dir = logs_path / "quick_eval_subset"
+        if not (subset_dir / "labelsTs").exists():
+            images_dir = Path(nnunet_raw) / get_dataset_folder(args.task_number, args.dataset_name) / "imagesTs"
+            labels_dir = Path(args.task_path) / "labelsTs"
+            build_subset(subset_dir, images_dir, labels_dir, select_subset(images_dir, labels_dir, profile["subset_size"]))
+        output_dir = logs_path / "quick_eval_predictions"
+        output_dir.mkdir(exist_ok=True)
+        init_quick_eval(logs_path)
+ 
+        for fold in range(5):
+            fold_dir = get_fold_dir(args.trained_models_path, args.task_number, args.dataset_name, fold)
+            checkpoint = next((fold_dir / name for name in ("checkpoint_final.pth", "checkpoint_latest.pth") if (fold_dir / name).exists()), None)
+            if checkpoint is None or quick_evals["checkpoints"].get(fold) == (checkpoint.name, checkpoint.stat().st_mtime):
+                continue
+            quick_evals["checkpoints"][fold] = (checkpoint.name, checkpoint.stat().st_mtime)
+            eval_profile, estimates = prepare_submission(logs_path, script_dir, "quick_eval_v2.sh")
+            ticket = acquire_gpu_slot(governor, eval_profile) # only if the profile was moved onto a GPU
+            job_id = submit_job([
+                "sbatch", str(logs_path / "quick_eval_v2.sh"),
+                args.dcan_path, args.task_number, nnunet_raw, nnunet_preprocessed, args.trained_models_path,
+                str(fold), checkpoint.name, str(subset_dir), str(output_dir)
+            ], log_file_path)
+            governor.attach(ticket, job_id) # freed automatically once the job leaves the queue
+            log_partition_choice(logs_path, f"quick_eval_fold_{fold}", job_id, eval_profile["partition"], estimates)
+            print(f"Submitted quick evaluation of fold {fold} ({checkpoint.name}) as job {job_id}")
+ 
+    # Retry policy key of a job, so each fold (or group of packed folds) has its own retry budget
+    def _policy_key(folds):
+        return "fold_" + "_".join(str(f) for f in folds)
+ 
+    # Submits a job once the GPU governor hands out a slot, and ties the slot to the job's SLURM id so it is freed when the job ends
+    def _submit_folds(folds, continue_flag=""):
+        folds = tuple(folds)
+        if len(folds) == 1:
+            script, overrides = "NnUnetTrain_v2_agate.sh", {}
+        else:
+            script, overrides = "NnUnetTrain_v2_packed.sh", packed_resources(profiles["model_training_packed"], len(folds))
+        profile, estimates = prepare_submission(logs_path, script_dir, script, {**overrides, **policy.overrides_for(_policy_key(folds))},
+                                                tuned_resources(tuning, len(folds)))
+        ticket = acquire_gpu_slot(governor, profile)
         time.sleep(3)
-        submit_job(_train_cmd(i), log_file_path)
-        job_ids[i] = get_job_id_from_squeue(f"{args.task_number}_{i}_Train_nnUNetv2")
- 
-    # Re-submit any folds that hit the SLURM time limit with the --c (continue) flag
-    while not all(complete):
-        for i in range(5):
-            wait_for_job_to_finish(job_ids[i], i)
-            err_file = get_training_error_path(logs_path, args.task_number, i, job_ids[i])
-            if check_complete(err_file, i):
-                complete[i] = True
+        submit_job(_train_cmd(folds, continue_flag), log_file_path)
+        job_id = get_job_id_from_squeue(f"{args.task_number}_{'_'.join(str(f) for f in folds)}_Train_nnUNetv2")
+        governor.attach(ticket, job_id)
+        jobs[folds] = {"job_id": job_id, "ticket": ticket}
+        log_partition_choice(logs_path, f"model_training_fold_{'_'.join(str(f) for f in folds)}", job_id, profile["partition"], estimates)
+        # Progress is any new output in the folds' .out/.err files or their nnUNet training_log
+        fold_dirs = [get_fold_dir(args.trained_models_path, args.task_number, args.dataset_name, f) for f in folds]
+        watchdog.watch(
+            job_id,
+            lambda: [path for f, fold_dir in zip(folds, fold_dirs) for path in (
+                get_training_log_path(logs_path, args.task_number, f, job_id),
+                get_training_error_path(logs_path, args.task_number, f, job_id),
+                get_latest_training_log(fold_dir))],
+            lambda: get_latest_training_log(fold_dirs[0])
+        )
+ 
+    # Resubmits folds whose job ended without finishing according to the retry policy, stopping the pipeline once the retry budget is used up
+    def _retry_folds(folds, end_state):
+        action = policy.next_action(_policy_key(folds), end_state, profiles[SCRIPTS["NnUnetTrain_v2_agate.sh" if len(folds) == 1 else "NnUnetTrain_v2_packed.sh"]])
+        if action is None:
+            print(f"ERROR: Fold(s) {', '.join(str(f) for f in folds)} training could not be completed")
+            exit(1)
+        time.sleep(action["delay"])
+        _submit_folds(folds, "--c" if action["resume"] else "")
+ 
+    # Folds only race on the shared artifacts in nnUNet_preprocessed (splits, plans, unpacked data). If they all exist, every fold is queued at once
+    preprocessed_dir = Path(nnunet_preprocessed) / get_dataset_folder(args.task_number, args.dataset_name)
+    create_splits(preprocessed_dir)
+    missing = missing_shared_artifacts(preprocessed_dir)
+    if not missing:
+        print("Shared preprocessing artifacts are in place, submitting all folds.")
+        remaining_folds = range(5)
+    else:
+        # Otherwise start fold 0 on its own and wait for it to create them (its initial setup) before launching remaining folds
+        print(f"Missing {len(missing)} shared preprocessing artifact(s), e.g. {missing[0]}. Waiting for fold 0 setup before the other folds.")
+        _submit_folds([0])
+        while not wait_fold_0_setup(
+            get_training_log_path(logs_path, args.task_number, 0, jobs[(0,)]["job_id"]),
+            get_training_error_path(logs_path, args.task_number, 0, jobs[(0,)]["job_id"]),
+            args.trained_models_path,
+            args.task_number,
+            args.dataset_name,
+            jobs[(0,)]["job_id"]
+        ):
+            job = jobs.pop((0,))
+            if is_job_running(job["job_id"]):
+                get_executor().cancel(job["job_id"])
+            wait_for_job_to_finish(job["job_id"], 0, check_interval=10)
+            governor.release(job["ticket"])
+            _retry_folds((0,), get_job_end_state(job["job_id"]) or {"state": "FAILED", "nodes": []})
+        remaining_folds = range(1, 5)
+ 
+    # Launch the remaining folds, one per job or packed onto multi-GPU nodes, they will be automatically stopped if they hit the time limit and can be re-submitted with the continue flag
+    for folds in fold_groups(remaining_folds, layout, folds_per_job):
+        print(f"Begin training Fold(s) {', '.join(str(f) for f in folds)}")
+        _submit_folds(folds)
+ 
+    # Re-submit any folds that did not finish (time limit, out of memory, node failure, ...) according to the retry policy
+    while jobs:
+        for folds in list(jobs):
+            # The job stays in jobs until it has ended, so the progress monitor, early stopping and the stall checks all see it
+            job = jobs[folds]
+            wait_for_job_to_finish(job["job_id"], folds[0], on_poll=_on_poll)
+            jobs.pop(folds)
+            watchdog.forget(job["job_id"])
+            stalled = job["job_id"] in stalled_jobs
+            governor.release(job["ticket"])
+            fill_actual_starts(logs_path)
+            end_state = get_job_end_state(job["job_id"])
+            if all(f in stopped_early or is_fold_finished(args, f) for f in folds) and any(f in stopped_early for f in folds):
+                print(f"Fold(s) {', '.join(str(f) for f in folds)} Training Complete (stopped early).")
+                continue
+            # A packed job can end with only some of its folds finished, those are resubmitted together
+            unfinished = tuple(f for f in folds if len(folds) == 1 or not is_fold_finished(args, f))
+            if stalled: # Cancelled by the watchdog, resubmit with the continue flag from the latest checkpoint
+                _retry_folds(unfinished, {"state": "STALLED", "nodes": end_state["nodes"] if end_state else []})
+            elif not unfinished:
+                print(f"Fold(s) {', '.join(str(f) for f in folds)} Training Complete.")
+            elif end_state is None: # No accounting record, fall back to the time limit message in the error file (or the final checkpoints for packed folds)
+                if len(folds) == 1 and check_complete(get_training_error_path(logs_path, args.task_number, folds[0], job["job_id"]), folds[0]):
+                    continue
+                _submit_folds(unfinished, "--c")
+            elif end_state["state"] == "COMPLETED":
+                print(f"Fold(s) {', '.join(str(f) for f in unfinished)} Training Complete.")
             else:
-                time.sleep(3)
-                submit_job(_train_cmd(i, "--c"), log_file_path)
-                job_ids[i] = get_job_id_from_squeue(f"{args.task_number}_{i}_Train_nnUNetv2")
+                _retry_folds(unfinished, end_state)
  
+    monitor.update(force=True)
+    if args.quick_eval:
+        print_quick_eval_trend(logs_path, range(5))
+    if stopped_early:
+        print(f"Early stopping saved ~{total_gpu_hours_saved(logs_path):.1f} GPU hours (see early_stopping.csv)")
     print("--- Training Complete ---")
  
 ### Create Inferred Segmentations and Plots ###
-def inference(args, logs_path, log_file_path, script_dir):
+def predict_with_service(args, logs_path, log_file_path, script_dir, governor, cases, pending, output_dir, folds, model):
     '''
-    Runs inference on the set aside test (Ts) data by submitting a SLURM job to run the infer_v2_agate.sh script, then creates dice plots of the results by running the evaluate_results.py script from the dcan repo
+    Predicts test cases with the warm prediction service (see prediction_service.py) instead of a one-off inference job. If no worker is serving the current model one is submitted with the prediction_service resource profile, and it stays up for the next inference until it has been idle for a while
+    Args:
+        args: the command line arguments passed to the program
+        logs_path: the task log folder the service script is submitted from
+        log_file_path: the path to the log file where the active job ids are stored
+        script_dir: the path to the directory where this script lives
+        governor: the GPU governor the worker's GPU slot is taken from
+        cases: the test case fingerprints
+        pending: the cases to predict
+        output_dir: the inference output folder
+        folds: the folds to ensemble
+        model: the model fingerprint, None if a checkpoint is missing
+    Out: list of cases the service did not predict (left for a normal inference job)
+    '''
+    if model is None:
+        return pending
+    dataset_folder = get_dataset_folder(args.task_number, args.dataset_name)
+    service_dir = get_service_dir(args.results_path, dataset_folder)
+    start = time.time()
+    heartbeat = service_status(service_dir, model)
+    if heartbeat is None:
+        profile = get_profiles(script_dir)["prediction_service"]
+        job_id = get_service_job(service_dir)
+        other = service_status(service_dir) # a worker for other checkpoints or folds
+        if job_id is None or not is_job_queued(job_id) or (other is not None and other["job_id"] == job_id):
+            if other is not None:
+                stop_service(service_dir)
+            profile, estimates = prepare_submission(logs_path, script_dir, "prediction_service_v2.sh")
+            ticket = acquire_gpu_slot(governor, profile)
+            job_id = submit_job([
+                "sbatch", str(logs_path / "prediction_service_v2.sh"),
+                args.dcan_path, str(script_dir), get_nnunet_raw(args.raw_data_base_path), get_nnunet_preprocessed(args.raw_data_base_path),
+                args.trained_models_path, str(get_fold_dir(args.trained_models_path, args.task_number, args.dataset_name, 0).parent),
+                str(service_dir), " ".join(str(f) for f in folds)
+            ], log_file_path)
+            governor.attach(ticket, job_id) # freed automatically once the worker exits
+            record_service_job(service_dir, job_id)
+            log_partition_choice(logs_path, "prediction_service", job_id, profile["partition"], estimates)
+            print(f"Submitted the prediction service as job {job_id}")
+        print(f"Waiting for the prediction service (job {job_id}) to load the model...")
+        heartbeat = wait_for_service(service_dir, model, profile["start_timeout"], lambda: is_job_queued(job_id))
+        if heartbeat is None:
+            print("The prediction service didn't come up, submitting an inference job instead")
+            return pending
+    print(f"Sending {len(pending)} case(s) to the prediction service (job {heartbeat['job_id']} on {heartbeat['host']}, {heartbeat['device']})")
+    requests = submit_cases(service_dir, {case: cases[case]["files"] for case in pending}, Path(args.task_path) / "imagesTs", output_dir)
+    results = wait_for_results(service_dir, requests, model)
+    served = [requests[r] for r, result in results.items() if result["status"] == "ok"]
+    for result in results.values():
+        if result["status"] != "ok":
+            print(f"WARNING: The prediction service failed on {result['output']}: {result['error']}")
+    record_timing(logs_path, "inference_service", time.time() - start, job_id=heartbeat["job_id"] or "")
+    print(f"The prediction service predicted {len(served)} case(s) in {time.time() - start:.0f} s")
+    return sorted(set(pending) - set(served))
+
+def inference(args, logs_path, log_file_path, script_dir, folds=None):
+    '''
+    Runs inference on the set aside test (Ts) data by submitting a SLURM job to run the infer_v2_agate.sh script, then creates dice plots of the results by running the evaluate_results.py script from the dcan repo.
+    An inference manifest in the output folder records which images and checkpoints each prediction came from, so only new or changed cases (or every case, after the model changed) are predicted and evaluated again.
+    With --prediction_service the cases go to a warm worker that keeps the model loaded between runs, and only what it couldn't predict is submitted as a job
     Args:
         args: the command line arguments passed to the program
         logs_path: the path to the logs directory where the SLURM script is located and where the job out and err files will be written
         log_file_path: the path to the log file where the active job ids are stored
-        script_dir: the path to the directory where this script lives (Not actually used in this function but included for consistency with other functions)
+        script_dir: the path to the directory where this script lives (used for the shared GPU governor state)
+        folds: the folds to ensemble (all five if None), e.g. only fold 0 in a smoke test
     Out: None
     '''
     
@@ -540,29 +1069,85 @@ def inference(args, logs_path, log_file_path, script_dir):
     dataset_folder = get_dataset_folder(args.task_number, args.dataset_name)
     inferred_dir = Path(args.results_path) / f"{dataset_folder}_infer"
     inferred_dir.mkdir(parents=True, exist_ok=True)
+    images_dir = Path(args.task_path) / "imagesTs"
+ 
+    # Work out which cases need predicting from the image hashes in the dataset index and the checkpoints of the ensembled folds
+    cases = case_fingerprints(hash_files(scan_task(args.task_path, logs_path), logs_path, ("imagesTs", "labelsTs")))
+    used_folds = list(folds) if folds is not None else list(range(5))
+    checkpoints = [get_fold_dir(args.trained_models_path, args.task_number, args.dataset_name, f) / "checkpoint_final.pth" for f in used_folds]
+    model = model_fingerprint(checkpoints, model_settings(used_folds))
+    manifest = load_manifest(inferred_dir)
+    pending, removed = plan_inference(manifest, cases, model, inferred_dir)
+    save_manifest(inferred_dir, manifest)
+    if removed:
+        print(f"Removed the predictions of {len(removed)} case(s) no longer in imagesTs")
+    print(f"{len(pending)} of {len(cases)} test case(s) need predicting, the rest are up to date")
  
     os.chdir(logs_path)
-    time.sleep(3)
-    submit_job([
-        "sbatch", "-W",
-        str(logs_path / "infer_v2_agate.sh"),
-        "faird",
-        args.task_number,
-        dataset_folder,
-        args.dcan_path,
-        get_nnunet_raw(args.raw_data_base_path),
-        get_nnunet_preprocessed(args.raw_data_base_path),
-        args.trained_models_path,
-        str(inferred_dir)
-    ], log_file_path)
-    job_id = get_job_id_from_squeue(f"{args.task_number}_infer_v2")
-    wait_for_job_to_finish(job_id, -1)
+    governor = get_governor(args, script_dir)
+    # The warm prediction service predicts what it can, whatever it doesn't goes through a normal inference job
+    unserved = predict_with_service(args, logs_path, log_file_path, script_dir, governor, cases, pending, inferred_dir, used_folds, model) if args.prediction_service and pending else pending
+    input_dir = images_dir if len(unserved) == len(cases) else stage_inputs(logs_path / "inference_input", images_dir, cases, unserved)
+ 
+    policy = RetryPolicy()
+    watchdog = watchdog_for(get_profiles(script_dir)["inference"])
+    fold_overrides = {"folds": " ".join(str(f) for f in folds)} if folds is not None else {}
+    while unserved:
+        profile, estimates = prepare_submission(logs_path, script_dir, "infer_v2_agate.sh", {**policy.overrides_for("inference"), **fold_overrides})
+        ticket = acquire_gpu_slot(governor, profile)
+        time.sleep(3)
+        submit_job([
+            "sbatch", "-W",
+            str(logs_path / "infer_v2_agate.sh"),
+            args.task_number,
+            dataset_folder,
+            args.dcan_path,
+            get_nnunet_raw(args.raw_data_base_path),
+            get_nnunet_preprocessed(args.raw_data_base_path),
+            args.trained_models_path,
+            str(inferred_dir),
+            str(input_dir)
+        ], log_file_path)
+        job_id = get_job_id_from_squeue(f"{args.task_number}_infer_v2")
+        governor.attach(ticket, job_id)
+        log_partition_choice(logs_path, "inference", job_id, profile["partition"], estimates)
+        # Progress is new output in the job's log files or new predictions in the output folder
+        watchdog.watch(job_id, lambda: [logs_path / f"infer_v2_{args.task_number}-{job_id}.out",
+                                        logs_path / f"infer_v2_{args.task_number}-{job_id}.err",
+                                        inferred_dir])
+        stalled = wait_for_job_to_finish(job_id, -1, watchdog=watchdog)
+        governor.release(ticket)
+        fill_actual_starts(logs_path)
+ 
+        # Retry failed or stalled inference runs according to the retry policy (nnUNetv2_predict skips cases that were already predicted)
+        end_state = get_job_end_state(job_id)
+        if stalled:
+            end_state = {"state": "STALLED", "nodes": end_state["nodes"] if end_state else []}
+        elif end_state is None or end_state["state"] == "COMPLETED":
+            break
+        action = policy.next_action("inference", end_state, get_profiles(script_dir)["inference"])
+        if action is None:
+            print(f"ERROR: Inference job {job_id} ended with state {end_state['state']}")
+            exit(1)
+        time.sleep(action["delay"])
+    missing = record_predictions(manifest, cases, model, pending, inferred_dir)
+    save_manifest(inferred_dir, manifest)
+    if missing and model is not None:
+        print(f"WARNING: {len(missing)} case(s) were not predicted (e.g. {missing[0]}), they will be retried on the next run")
     print("--- Inference Complete ---")
  
+    # Per-case Dice, only computed for the predictions (or labels) that changed since the last evaluation
+    results_dir = Path(args.results_path) / f"{dataset_folder}_results"
+    evaluated = update_evaluation(manifest, cases, inferred_dir, Path(args.task_path) / "labelsTs")
+    save_manifest(inferred_dir, manifest)
+    mean_dice = write_case_dice(manifest, results_dir)
+    print(f"Evaluated {len(evaluated)} case(s){f', mean Dice over all cases {mean_dice:.4f}' if mean_dice is not None else ''} (see {results_dir / CASE_DICE_FILE})")
+    if not (pending or removed or evaluated):
+        print("Predictions and labels are unchanged, the plots are up to date")
+        return
+ 
     # Create dice plots (still uses the SynthSeg conda env as before)
     print("--- Creating Plots ---")
-    results_dir = Path(args.results_path) / f"{dataset_folder}_results"
-    results_dir.mkdir(parents=True, exist_ok=True)
     paper_dir = Path(args.synth_path) / "SynthSeg" / "dcan" / "paper"
     os.chdir(paper_dir)
     subprocess.run([
@@ -575,6 +1160,124 @@ def inference(args, logs_path, log_file_path, script_dir):
  
 # endregion
 
+# region ### SMOKE TEST ###
+
+def get_smoke_args(args, smoke_root: Path):
+    # Returns a copy of the arguments that points every path the pipeline writes to (task, nnUNet folders, results, min maxes) into the smoke folder, keeping the task number and dataset name so the real dataset conversion script runs
+    return argparse.Namespace(**{
+        **vars(args),
+        "task_path": str(Path(get_nnunet_raw(smoke_root)) / get_dataset_folder(args.task_number, args.dataset_name)),
+        "raw_data_base_path": str(smoke_root),
+        "results_path": str(smoke_root / "results"),
+        "trained_models_path": str(smoke_root / "nnUNet_results"),
+        "synth_img_amt": SMOKE_SYNTH_IMAGES,
+        "smoke_root": str(smoke_root),
+        "fold_layout": "spread",
+        "quick_eval": False,
+        "early_stopping": False,
+        "calibrate_da": False,
+        "preprocess_cache": False,
+        "prediction_service": False
+    })
+
+### Smoke Test Training ###
+def smoke_training(args, logs_path, log_file_path, script_dir):
+    '''
+    Trains fold 0 of the smoke task with the normal training script for a couple of epochs: the job is cancelled once SMOKE_EPOCHS epochs have finished and nnUNet has saved a best checkpoint, which is then used as the final one so inference can run on it
+    Args:
+        args: the smoke test arguments
+        logs_path: the smoke folder where the SLURM script is located and where the job out and err files will be written
+        log_file_path: the path to the log file where the active job ids are stored
+        script_dir: the path to the directory where this script lives (used for the shared GPU governor state)
+    Out: None, exits if the fold fails before getting there
+    '''
+    print(f"--- Now Training Fold 0 for {SMOKE_EPOCHS} Epochs ---")
+    os.chdir(logs_path)
+    governor = get_governor(args, script_dir)
+    profile, estimates = prepare_submission(logs_path, script_dir, "NnUnetTrain_v2_agate.sh")
+    ticket = acquire_gpu_slot(governor, profile)
+    time.sleep(3)
+    submit_job([
+        "sbatch", "-W",
+        str(logs_path / "NnUnetTrain_v2_agate.sh"),
+        "0",
+        args.task_number,
+        args.dcan_path,
+        get_nnunet_raw(args.raw_data_base_path),
+        get_nnunet_preprocessed(args.raw_data_base_path),
+        args.trained_models_path
+    ], log_file_path)
+    job_id = get_job_id_from_squeue(f"{args.task_number}_0_Train_nnUNetv2")
+    governor.attach(ticket, job_id)
+    log_partition_choice(logs_path, "smoke_training", job_id, profile["partition"], estimates)
+
+    fold_dir = get_fold_dir(args.trained_models_path, args.task_number, args.dataset_name, 0)
+    out_file = get_training_log_path(logs_path, args.task_number, 0, job_id)
+    while is_job_running(job_id) and not is_fold_finished(args, 0):
+        epochs = max(len(parse_training_log(out_file)["epoch_times"]), len(parse_training_log(get_latest_training_log(fold_dir))["epoch_times"]))
+        # Don't stop the trainer while it is still writing the best checkpoint
+        if epochs >= SMOKE_EPOCHS and can_finalize(fold_dir) and time.time() - (fold_dir / "checkpoint_best.pth").stat().st_mtime > 15:
+            print(f"Fold 0 finished {epochs} epoch(s), stopping training.")
+            get_executor().cancel(job_id)
+            break
+        if epochs >= SMOKE_MAX_EPOCHS:
+            print(f"Fold 0 has no best checkpoint after {epochs} epochs, stopping training.")
+            get_executor().cancel(job_id)
+            break
+        time.sleep(30)
+    wait_for_job_to_finish(job_id, -2, check_interval=10)
+    governor.release(ticket)
+    if not finalize_fold(fold_dir):
+        print(f"ERROR: Fold 0 did not save a checkpoint (see {out_file} and {get_training_error_path(logs_path, args.task_number, 0, job_id)})")
+        exit(1)
+    print("--- Smoke Test Training Complete ---")
+
+def run_smoke_test(args, logs_path, script_dir):
+    '''
+    Runs every pipeline step end to end on a small copy of the task (a few training and test cases, one SynthSeg image per age group, fold 0 trained for a couple of epochs, inference with that fold) so broken paths, modality channels or dataset conversion scripts show up in minutes instead of after hours in the queue.
+    Everything the smoke test writes goes to logs/<Dataset>/smoke, which is rebuilt on every run
+    Args:
+        args: the command line arguments passed to the program
+        logs_path: the task log folder (per-step timings go to its step_timings.csv and the outcome to smoke_test.json)
+        script_dir: the path to the directory where this script lives
+    Out: True if every step passed, False at the first step that failed
+    '''
+    print("--- Starting Smoke Test ---")
+    smoke_root = Path(logs_path) / SMOKE_DIR
+    if smoke_root.exists():
+        shutil.rmtree(smoke_root)
+    smoke_args = get_smoke_args(args, smoke_root)
+    set_up_slurm_scripts(smoke_root, script_dir, get_profiles(script_dir))
+    smoke_log_file_path = smoke_root / "active_jobs.txt"
+    smoke = SmokeTest(logs_path)
+    cases = {}
+    step_args = (smoke_args, smoke_root, smoke_log_file_path, script_dir)
+    inferred_dir = Path(smoke_args.results_path) / f"{get_dataset_folder(args.task_number, args.dataset_name)}_infer"
+    steps = [
+        ("build_task", lambda: cases.update(build_smoke_task(get_original_dir(args.task_path), smoke_args.task_path)), None),
+        ("resize_images", lambda: resize_images(smoke_args), lambda: check_cases(smoke_args.task_path, cases)),
+        ("min_max", lambda: min_max(*step_args), lambda: check_file(get_min_max_path(smoke_args, script_dir))),
+        ("SynthSeg_img", lambda: SynthSeg_img(*step_args), None),
+        ("copy_SynthSeg", lambda: copy_SynthSeg(smoke_args), lambda: check_augmented(smoke_args.task_path, cases)),
+        ("check_dataset", lambda: check_dataset(smoke_args, smoke_root), None),
+        ("create_json", lambda: create_json(*step_args), lambda: check_dataset_json(smoke_args.task_path)),
+        ("p_and_p", lambda: p_and_p(*step_args), None),
+        ("model_training", lambda: smoke_training(*step_args), None),
+        ("inference", lambda: inference(*step_args, folds=[0]), lambda: check_predictions(inferred_dir, cases))
+    ]
+
+    export_nnunet_paths(smoke_args)
+    try:
+        for name, step, check in steps:
+            if not smoke.run(name, step, check):
+                break
+    finally:
+        export_nnunet_paths(args)
+        os.chdir(script_dir)
+    return smoke.report()
+
+# endregion
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="nnUNet v2 training pipeline with SynthSeg augmentation")
  
@@ -597,22 +1300,44 @@ if __name__ == '__main__':
     
     parser.add_argument('list')
     
+    # Optional arguments (not passed by the GUI)
+    parser.add_argument('--priority', default='normal', choices=['critical', 'normal', 'exploratory']) # fair-share class used by the GPU governor
+    parser.add_argument('--quick_eval', action='store_true') # periodically evaluate the latest checkpoints on a few test cases while training
+    parser.add_argument('--early_stopping', action='store_true') # stop folds whose EMA pseudo-Dice has plateaued
+    parser.add_argument('--calibrate_da', action='store_true') # measure and cache the best augmentation worker count before training
+    parser.add_argument('--fold_layout', default='auto', choices=['auto', 'spread', 'packed']) # one fold per job or several folds per 4-GPU job, auto picks from the queue depth
+    parser.add_argument('--smoke', action='store_true') # run the whole pipeline on a few cases first and only start the full run if it passes
+    parser.add_argument('--smoke_only', action='store_true') # only run the smoke test
+    parser.add_argument('--no_preprocess_cache', dest='preprocess_cache', action='store_false') # always run plan and preprocess instead of reusing cached output
+    parser.add_argument('--cache_limit_gb', type=float, default=CACHE_LIMIT_GB) # size of the shared preprocessed cache before old entries are evicted
+    parser.add_argument('--prediction_service', action='store_true') # predict test cases with a warm worker that keeps the model loaded instead of a job per inference
+    parser.add_argument('--executor', default='slurm', choices=['slurm', 'local']) # submit jobs to SLURM, or run the same job scripts on this machine
+    parser.add_argument('--local_jobs', type=int, default=MAX_LOCAL_JOBS) # jobs the local executor runs at the same time
+    parser.add_argument('--local_gpus', type=int, default=LOCAL_GPUS) # GPUs the local executor hands out to jobs
+    parser.set_defaults(smoke_root=None) # set for the smoke test's copy of the arguments
+    
     args = parser.parse_args()
  
     # Export necessary paths
-    os.environ.update({
-        "PYTHONPATH": f"{args.synth_path}:{Path(args.synth_path) / 'SynthSeg'}:{args.dcan_path}:{Path(args.dcan_path) / 'dcan'}",
-        "nnUNet_raw": str(Path(args.raw_data_base_path) / "nnUNet_raw"),
-        "nnUNet_preprocessed": str(Path(args.raw_data_base_path) / "nnUNet_preprocessed"),
-        "nnUNet_results": args.trained_models_path
-    })
+    export_nnunet_paths(args)
  
     # Some setup stuff - create logs folder, copy over SLURM scripts, set up log file path
     script_dir = Path(__file__).resolve().parent
     logs_path = script_dir / "logs" / get_dataset_folder(args.task_number, args.dataset_name)
     log_file_path = logs_path / "active_jobs.txt"
+    if args.executor == "local":
+        activate_local_executor(script_dir / "logs" / LOCAL_DIR, args.local_jobs, args.local_gpus)
  
-    set_up_slurm_scripts(logs_path, script_dir / "scripts" / "slurm_scripts_v2")
+    set_up_slurm_scripts(logs_path, script_dir, get_profiles(script_dir))
+
+    # Smoke test on a few cases before anything is queued for the full run
+    if args.smoke or args.smoke_only:
+        if not run_smoke_test(args, logs_path, script_dir):
+            print("Smoke test failed, the full run was not started.")
+            exit(1)
+        if args.smoke_only:
+            print("PROGRAM COMPLETE!")
+            exit(0)
  
     # List of all the steps in the pipeline in the order they should be run
     run_list = [
@@ -629,9 +1354,14 @@ if __name__ == '__main__':
     # Decode which steps to run from the GUI's encoded list
     flags = [args.list[i * 3 + 1] == '1' for i in range(len(run_list))]
  
+    dataset_checked = False
     for step, should_run in zip(run_list, flags):
         if should_run:
-            if step in [min_max, SynthSeg_img, p_and_p, model_training, inference]:
+            # The dataset is checked once, before the first step that needs it to be consistent
+            if step in [create_json, p_and_p] and not dataset_checked:
+                check_dataset(args, logs_path)
+                dataset_checked = True
+            if step in [min_max, SynthSeg_img, create_json, p_and_p, model_training, inference]:
                 step(args, logs_path, log_file_path, script_dir)
             else:
                 step(args)
@@ -0,0 +1,50 @@
+import re
+from pathlib import Path
+
+# region ### CONSTANTS ###
+# nnUNet writes "Epoch 12" (v2) or "epoch:  12" (v1) at the start of each epoch and "Epoch time: 301.5 s" (v2) / "This epoch took 301.5 s" (v1) at the end
+EPOCH_PATTERN = re.compile(r"\bepoch:?\s+(\d+)\s*$", re.IGNORECASE)
+EPOCH_TIME_PATTERN = re.compile(r"(?:Epoch time:|This epoch took)\s*([\d.]+)\s*s", re.IGNORECASE)
+# endregion
+
+# region ### TRAINING LOG PARSING ###
+
+def get_latest_training_log(fold_dir: Path):
+    # Returns the most recently modified training_log file in a nnUNet fold directory, None if there isn't one yet
+    fold_dir = Path(fold_dir)
+    if not fold_dir.exists():
+        return None
+    logs = [p for p in fold_dir.iterdir() if p.is_file() and p.name.startswith("training_log")]
+    if not logs:
+        return None
+    return max(logs, key=lambda p: p.stat().st_mtime)
+
+def parse_training_log(log_path):
+    '''
+    Reads the epoch markers and per-epoch durations out of a nnUNet training log (or a SLURM .out file that contains the same lines)
+    Args:
+        log_path: path to the log file
+    Out: dictionary with "epoch" (latest epoch started, None if training hasn't started) and "epoch_times" (list of epoch durations in seconds, oldest first)
+    '''
+    progress = {"epoch": None, "epoch_times": []}
+    if log_path is None or not Path(log_path).exists():
+        return progress
+    with open(log_path, errors="replace") as f:
+        for line in f:
+            epoch_match = EPOCH_PATTERN.search(line)
+            if epoch_match:
+                progress["epoch"] = int(epoch_match.group(1))
+                continue
+            time_match = EPOCH_TIME_PATTERN.search(line)
+            if time_match:
+                progress["epoch_times"].append(float(time_match.group(1)))
+    return progress
+
+def typical_epoch_time(epoch_times, recent=10):
+    # Median of the most recent epoch durations (robust to the slow first epoch and to validation epochs), None if no epoch has finished
+    if not epoch_times:
+        return None
+    recent_times = sorted(epoch_times[-recent:])
+    return recent_times[len(recent_times) // 2]
+
+# endregion
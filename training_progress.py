@@ -0,0 +1,278 @@
+import json
+import math
+import re
+import subprocess
+import time
+from pathlib import Path
+
+from training_logs import EPOCH_PATTERN, EPOCH_TIME_PATTERN, typical_epoch_time
+
+# region ### CONSTANTS ###
+PROGRESS_FILE = "training_progress.json" # written to the task log folder for the GUI
+DEFAULT_NUM_EPOCHS = 1000 # nnUNet's default, used when the fold's debug.json can't be read
+LOST_EPOCHS = 0.5 # a requeued job saves checkpoint_latest.pth when it is signalled, so it only repeats the epoch that was in progress (half of one on average)
+RESUBMIT_OVERHEAD = 1800 # seconds of queueing and startup assumed for each resubmission
+SLOW_FOLD_FACTOR = 1.5 # a fold whose epochs take this much longer than the median fold's is reported as slow
+
+# Lines of the nnUNet v2 training log (also printed to the SLURM .out file), optionally prefixed with "2024-05-01 12:00:00.123456: "
+TIMESTAMP_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})(?:\.\d+)?:\s*")
+NUMBER = r"(-?\d+(?:\.\d+)?(?:e-?\d+)?)"
+TRAIN_LOSS_PATTERN = re.compile(r"train_loss:?\s+" + NUMBER)
+VAL_LOSS_PATTERN = re.compile(r"val_loss:?\s+" + NUMBER)
+PSEUDO_DICE_PATTERN = re.compile(r"Pseudo dice\s*\[(.*)\]", re.IGNORECASE)
+# endregion
+
+# region ### UTILITY FUNCTIONS ###
+
+def parse_slurm_time(value):
+    # Converts a SLURM duration ("24:00:00", "1-02:03:04", "45:10") to seconds
+    days, _, clock = value.strip().rpartition("-")
+    parts = [int(p) for p in clock.split(":")]
+    while len(parts) < 3:
+        parts.insert(0, 0)
+    return int(days or 0) * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+def get_job_elapsed(job_id):
+    # Seconds a queued job has been running in its current run, 0 if it is pending or unknown
+    if not job_id:
+        return 0
+    result = subprocess.run(["squeue", "-h", "-j", str(job_id), "-o", "%M"], capture_output=True, text=True)
+    lines = result.stdout.strip().splitlines()
+    try:
+        return parse_slurm_time(lines[0]) if lines else 0
+    except ValueError:
+        return 0
+
+def get_num_epochs(fold_dir: Path):
+    # Total epochs the fold trains for, read from the debug.json nnUNet writes into the fold folder
+    debug_path = Path(fold_dir) / "debug.json"
+    try:
+        with open(debug_path) as f:
+            return int(json.load(f).get("num_epochs", DEFAULT_NUM_EPOCHS))
+    except (OSError, ValueError, TypeError):
+        return DEFAULT_NUM_EPOCHS
+
+# endregion
+
+# region ### PROGRESS PARSER ###
+
+class FoldProgress:
+    '''
+    Incrementally reads a fold's nnUNet training logs (training_log_*.txt in the fold folder) and its SLURM .out files, remembering how far each file has been read.
+    Builds a per-epoch time series of train/val loss, mean pseudo-Dice and epoch duration; the same epoch seen in several files (or again after resuming from a checkpoint) keeps its latest values.
+    '''
+
+    def __init__(self, fold, fold_dir, out_glob):
+        self.fold = fold
+        self.fold_dir = Path(fold_dir)
+        self.out_glob = out_glob # (folder, pattern) of the fold's SLURM .out files
+        self.offsets = {}
+        self.current = {}
+        self.series = {}
+
+    def _files(self):
+        # Oldest first, so epochs repeated after a resume end up with the values of the latest run
+        files = list(self.fold_dir.glob("training_log*.txt")) if self.fold_dir.exists() else []
+        folder, pattern = self.out_glob
+        files += list(Path(folder).glob(pattern))
+        return sorted(files, key=lambda p: p.stat().st_mtime if p.exists() else 0)
+
+    def _parse_line(self, path, line):
+        timestamp_match = TIMESTAMP_PATTERN.match(line)
+        message = line[timestamp_match.end():] if timestamp_match else line
+        current = self.current.setdefault(path, None)
+
+        epoch_match = EPOCH_PATTERN.search(message)
+        if epoch_match:
+            epoch = int(epoch_match.group(1))
+            self.current[path] = epoch
+            self.series.setdefault(epoch, {"epoch": epoch})
+            if timestamp_match:
+                self.series[epoch]["started"] = timestamp_match.group(1)
+            return
+        if current is None or current not in self.series:
+            return
+        entry = self.series[current]
+        for field, pattern in (("train_loss", TRAIN_LOSS_PATTERN), ("val_loss", VAL_LOSS_PATTERN), ("epoch_time", EPOCH_TIME_PATTERN)):
+            match = pattern.search(message)
+            if match:
+                entry[field] = float(match.group(1))
+                return
+        dice_match = PSEUDO_DICE_PATTERN.search(message)
+        if dice_match:
+            values = [float(v) for v in re.findall(r"-?\d+\.\d+(?:e-?\d+)?", dice_match.group(1))]
+            if values:
+                entry["pseudo_dice"] = round(sum(values) / len(values), 4)
+
+    def update(self):
+        # Reads whatever has been appended to the fold's log files since the last call
+        for path in self._files():
+            key = str(path)
+            try:
+                size = path.stat().st_size
+            except OSError:
+                continue
+            offset = self.offsets.get(key, 0)
+            if size < offset: # file was replaced, read it again
+                offset = 0
+            with open(path, "rb") as f:
+                f.seek(offset)
+                for raw in f:
+                    if not raw.endswith(b"\n"): # leave a partly written last line for the next call
+                        break
+                    offset += len(raw)
+                    self._parse_line(key, raw.decode(errors="replace").strip())
+            self.offsets[key] = offset
+        return self
+
+    def completed_epochs(self):
+        # Epochs that have finished (have a duration), in order
+        return [self.series[e] for e in sorted(self.series) if "epoch_time" in self.series[e]]
+
+    def latest_epoch(self):
+        # Latest epoch that has started, None before training starts
+        return max(self.series) if self.series else None
+
+# endregion
+
+# region ### ETA ###
+
+def estimate_eta(progress: FoldProgress, num_epochs, time_limit, job_elapsed=0, resubmit_overhead=RESUBMIT_OVERHEAD):
+    '''
+    Estimates when a fold will finish, including the resubmissions still needed to get through the remaining epochs under the job time limit
+    Args:
+        progress: the fold's parsed progress
+        num_epochs: total epochs the fold trains for
+        time_limit: seconds each training job runs before it saves and requeues
+        job_elapsed: how long the fold's current job has been running (0 if it is pending)
+        resubmit_overhead: seconds of queueing and startup per resubmission
+    Out: dictionary with "epoch", "num_epochs", "epoch_time", "remaining_seconds", "resubmissions" and "eta" (unix time), or None until the first epoch has finished
+    '''
+    done = progress.completed_epochs()
+    epoch_time = typical_epoch_time([e["epoch_time"] for e in done])
+    if epoch_time is None:
+        return None
+    remaining_epochs = max(num_epochs - (done[-1]["epoch"] + 1), 0)
+    work = remaining_epochs * epoch_time
+    left_in_job = max(time_limit - job_elapsed, 0)
+
+    # Every resubmission restarts from the checkpoint saved on the time limit signal (repeating the unfinished epoch) and waits in the queue again
+    resubmissions = 0
+    if work > left_in_job:
+        per_job = max(time_limit - LOST_EPOCHS * epoch_time, epoch_time)
+        resubmissions = math.ceil((work - left_in_job) / per_job)
+    remaining = work + resubmissions * (resubmit_overhead + LOST_EPOCHS * epoch_time)
+    return {
+        "epoch": done[-1]["epoch"], "num_epochs": num_epochs, "epoch_time": round(epoch_time, 1),
+        "remaining_seconds": round(remaining), "resubmissions": resubmissions, "eta": round(time.time() + remaining),
+    }
+
+def find_slow_folds(summaries):
+    # Folds whose typical epoch time is well above the median fold's
+    epoch_times = sorted(s["eta"]["epoch_time"] for s in summaries.values() if s.get("eta"))
+    if len(epoch_times) < 2:
+        return []
+    median = epoch_times[len(epoch_times) // 2]
+    return [fold for fold, s in summaries.items() if s.get("eta") and s["eta"]["epoch_time"] > SLOW_FOLD_FACTOR * median]
+
+# endregion
+
+# region ### MONITOR ###
+
+class TrainingMonitor:
+    '''
+    Keeps the progress of every fold of a training run up to date while the pipeline waits on the fold jobs: parses new log lines, refreshes the ETAs, writes training_progress.json for the GUI and reports slow folds
+    '''
+
+    def __init__(self, logs_path, task_number, fold_dirs, time_limit, job_ids, update_interval=600):
+        '''
+        Args:
+            logs_path: the task log folder (where the SLURM .out files are and the progress file is written)
+            task_number: the dataset task number, used in the .out file names
+            fold_dirs: dictionary mapping fold to its nnUNet fold folder
+            time_limit: seconds a training job runs before it saves and requeues (its time limit minus the requeue signal lead)
+            job_ids: callable returning a dictionary mapping fold to its current SLURM job id
+            update_interval: minimum seconds between updates
+        '''
+        self.logs_path = Path(logs_path)
+        self.time_limit = time_limit
+        self.job_ids = job_ids
+        self.update_interval = update_interval
+        self.last_update = 0
+        self.reported_slow = set()
+        self.folds = {fold: FoldProgress(fold, fold_dir, (self.logs_path, f"Train_{fold}_{task_number}_nnUNetv2-*.out")) for fold, fold_dir in fold_dirs.items()}
+
+    def update(self, force=False):
+        '''
+        Refreshes every fold's progress (at most once per update interval unless forced) and writes the progress file
+        Args:
+            force: update even if the last update was recent
+        Out: dictionary mapping fold to {"series", "eta", "job_id"}, None if skipped
+        '''
+        if not force and time.time() - self.last_update < self.update_interval:
+            return None
+        self.last_update = time.time()
+        job_ids = self.job_ids()
+        summaries = {}
+        for fold, progress in self.folds.items():
+            progress.update()
+            job_id = job_ids.get(fold)
+            summaries[fold] = {
+                "job_id": job_id,
+                "series": progress.completed_epochs(),
+                "eta": estimate_eta(progress, get_num_epochs(progress.fold_dir), self.time_limit, get_job_elapsed(job_id) if job_id else 0),
+            }
+        write_progress(self.logs_path, summaries)
+        for fold in find_slow_folds(summaries):
+            if fold not in self.reported_slow:
+                self.reported_slow.add(fold)
+                print(f"WARNING: Fold {fold} is training slowly ({summaries[fold]['eta']['epoch_time']} s per epoch)")
+        return summaries
+
+    def latest_eta(self, summaries):
+        # When the last fold is expected to finish (unix time), None until every fold has an estimate
+        etas = [s["eta"]["eta"] if s["eta"] else None for s in summaries.values()]
+        return None if not etas or None in etas else max(etas)
+
+# endregion
+
+# region ### PROGRESS FILE ###
+
+def write_progress(logs_path: Path, summaries):
+    '''
+    Writes every fold's time series and ETA to training_progress.json in the task log folder
+    Args:
+        logs_path: the task log folder
+        summaries: dictionary mapping fold to {"series": [...], "eta": {...} or None, "job_id": ...}
+    Out: path to the progress file
+    '''
+    progress_path = Path(logs_path) / PROGRESS_FILE
+    tmp_path = progress_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"updated": round(time.time()), "folds": {str(k): v for k, v in summaries.items()}}, f)
+    tmp_path.replace(progress_path)
+    return progress_path
+
+def read_progress(logs_path: Path):
+    # Reads training_progress.json, None if training hasn't reported progress yet
+    progress_path = Path(logs_path) / PROGRESS_FILE
+    if not progress_path.exists():
+        return None
+    try:
+        with open(progress_path) as f:
+            return json.load(f)
+    except ValueError: # caught mid-write on a shared filesystem, try again next time
+        return None
+
+def format_progress(progress):
+    # One-line summary for the GUI status, e.g. "Fold 0: 412/1000 ETA 05-02 13:10 | Fold 1: ..."
+    parts = []
+    for fold, summary in sorted(progress["folds"].items()):
+        eta = summary.get("eta")
+        if eta is None:
+            parts.append(f"Fold {fold}: starting")
+        else:
+            parts.append(f"Fold {fold}: {eta['epoch'] + 1}/{eta['num_epochs']} ETA {time.strftime('%m-%d %H:%M', time.localtime(eta['eta']))}")
+    return " | ".join(parts)
+
+# endregion